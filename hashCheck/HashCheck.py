@@ -3,18 +3,31 @@ sys.path.append('hashCheck/')
 import os
 import sqlite3
 import logging
+import hashlib
+import time
+import json
 from utility.dateTime import parse_date, get_current_datetime_string as currentDateTime
 from utility.util import determine_file_type, get_file_hash as fileHash, get_configurations as getConfig 
+from utility.exclusionMatcher import ExclusionMatcher
+from utility.fileWalker import scan_directory as scanDirectory, get_directory_key as getDirectoryKey
+from utility.logSetup import configure_logger as configureLogger, PER_FILE
 import threading
-import queue
+# Block manifests, distributed scans, the metadata cache and the thread pools are imported by the methods that use them,
+# so reports and summaries don't pay for them at startup
+
+# Version of the summary and block manifest schema kept in PRAGMA user_version, raise it whenever
+# hash_db_summary.sql or hash_db_blocks.sql changes so existing dbs get the new tables and triggers
+DB_SCHEMA_VERSION = 1
 
 class HashCheck:
 
-    def __init__(self, config_path="../default_config.json"):
+    def __init__(self, config_path="../default_config.json", config_overrides=None):
         # Load configuration from the given path
         self.config = getConfig(config_path)
         if not self.config:
             return
+        # Settings given on the command line win over the config file
+        self.config.update(config_overrides or {})
         # Get the log file path and name from the config file and setup logger
         self.log_file = os.path.join(self.config.get('logFolderParentFolderPath', None), self.config.get('logFileName', None))
 
@@ -24,13 +37,47 @@ class HashCheck:
 
         self.root_directories = self.config.get('rootFolderList', [])
         self.exclusions = self.config.get('exclusions',{})
+        self.exclusion_matcher = ExclusionMatcher(self.exclusions)
         self.db_file_name = self.config.get('dbFile','hash.db')
         self.db_folder_path = self.config.get('dbFileParentFolderPath','./')
         self.root_dir = None
 
-        self.directoryQueue = queue.Queue()
+        # Created by each scan
+        self.directoryQueue = None
         self.thread_count = self.config.get('processing_threads',1)
 
+        # Optionally split the db into one shard per root (or per group of roots) so writers never share a lock
+        self.shard_databases = self.config.get('shardDatabases', False)
+        self.roots_per_shard = max(1, self.config.get('rootsPerShard', 1))
+        self.shard_map = self._build_shard_map()
+        self.shard_locks = {}
+        self.shard_locks_guard = threading.Lock()
+        # Dbs whose summary and block manifest tables were checked by this run
+        self.prepared_dbs = set()
+        self.prepared_dbs_lock = threading.Lock()
+        self.logger.debug('Database shards: {0}'.format(self.shard_map))
+
+        # Distributed scans: the coordinator writes the shard manifests and the lease db to the shard folder, workers on any host claim them
+        self.scan_shard_folder = self.config.get('scanShardFolder', None) or './shards'
+        self.scan_shard_count = max(1, self.config.get('scanShardCount', 8))
+        self.scan_shard_lease_seconds = max(3, self.config.get('scanShardLeaseSeconds', 300))
+        self.scan_shard_max_attempts = self.config.get('scanShardMaxAttempts', 3)
+
+        # Optional block manifests of large files: a hash per block, so a mismatch tells which bytes changed and files can be spot checked
+        self.block_manifests = self.config.get('blockManifests', False)
+        self.block_size = max(1, self.config.get('blockSizeMiB', 8)) * 1024 * 1024
+        self.block_manifest_min_size = self.config.get('blockManifestMinSizeMiB', 256) * 1024 * 1024
+
+        # Optional metadata cache shared with the converters, the file types of new files are read from it.
+        # It is opened by the first scan that finds a new file, reports never read it
+        self.metadata_cache = None
+        self.metadata_cache_path = None
+        self.metadata_cache_lock = threading.Lock()
+        metadata_cache_file = self.config.get('metadataCacheFile', None)
+        if metadata_cache_file:
+            self.metadata_cache_path = os.path.join(self.config.get('metadataCacheFileParentFolderPath', None) or './', metadata_cache_file)
+            self.logger.debug('Metadata Cache: {0}'.format(self.metadata_cache_path))
+
     def _configure_logger(self):
         # dump all log levels to file
         log_level = self.config.get('logLevel', "INFO")
@@ -39,8 +86,6 @@ class HashCheck:
         if not isinstance(numeric_log_level, int):
             raise ValueError("Invalid log level: %s" % log_level)
 
-        self.logger.setLevel(numeric_log_level)
-
         # create a file handler to log to a file
         file_handler = None
 
@@ -61,16 +106,139 @@ class HashCheck:
         console_formatter = logging.Formatter('%(asctime)s - %(process)d - %(thread)d - %(funcName)s - %(lineno)d - %(levelname)s - %(message)s')
         file_handler.setFormatter(file_formatter)
         console_handler.setFormatter(console_formatter)
-        # add the file handler to the logger
-        self.logger.addHandler(file_handler)
-        self.logger.addHandler(console_handler)
+        # The handlers are written by a listener thread, per-file info lines can be sampled
+        configureLogger(self.logger, numeric_log_level, [file_handler, console_handler],
+                        self.config.get('perFileLogEvery', 1), self.config.get('perFileLogIntervalSeconds', 0))
+
+    def _build_shard_map(self):
+        """
+        Maps every root directory to the db file that stores its records.
+        Without sharding every root maps to the configured dbFile.
+        """
+        default_db_path = os.path.join(self.db_folder_path, self.db_file_name)
+        shard_map = {}
+
+        if not self.shard_databases:
+            for root in self.root_directories:
+                shard_map[os.path.normpath(root)] = default_db_path
+            return shard_map
+
+        # Roots keep the shard they were first given, the assignments are kept in a file next to the shards, so
+        # reordering, adding or removing roots never moves the records of another root to a different shard
+        name, extension = os.path.splitext(self.db_file_name)
+        shard_map_file = os.path.join(self.db_folder_path, f'{name}-shards.json')
+        assignments = {}
+        if os.path.exists(shard_map_file):
+            try:
+                with open(shard_map_file, 'r') as file:
+                    assignments = json.load(file)
+            except (OSError, ValueError) as e:
+                self.logger.error('Error reading the shard map %s: %s', shard_map_file, e)
+                raise
+
+        roots = list(dict.fromkeys(os.path.normpath(root) for root in self.root_directories))
+        new_roots = [root for root in roots if root not in assignments]
+        if new_roots:
+            if not assignments:
+                # The first map keeps the shards an older version named after each group of the root list
+                for index in range(0, len(roots), self.roots_per_shard):
+                    group = roots[index:index + self.roots_per_shard]
+                    shard_id = hashlib.sha1('\n'.join(group).encode('utf-8')).hexdigest()[:10]
+                    for root in group:
+                        assignments[root] = f'{name}-{shard_id}{extension}'
+            else:
+                # New roots fill the shard with the fewest roots, a new shard is named after its first root
+                for root in new_roots:
+                    counts = {}
+                    for shard_file in assignments.values():
+                        counts[shard_file] = counts.get(shard_file, 0) + 1
+                    shard_file = min(sorted(counts), key=counts.get)
+                    if counts[shard_file] >= self.roots_per_shard:
+                        shard_file = '{0}-{1}{2}'.format(name, hashlib.sha1(root.encode('utf-8')).hexdigest()[:10], extension)
+                    assignments[root] = shard_file
+            # Written to a temporary file first so another process never reads half a map
+            temp_file = shard_map_file + '.tmp'
+            with open(temp_file, 'w') as file:
+                json.dump(assignments, file, indent=4, sort_keys=True)
+            os.replace(temp_file, shard_map_file)
+
+        for root in roots:
+            shard_map[root] = os.path.join(self.db_folder_path, assignments[root])
+
+        return shard_map
+
+    def get_db_paths(self):
+        """
+        Returns the path of every db shard that queries need to fan out to
+        """
+        default_db_path = os.path.join(self.db_folder_path, self.db_file_name)
+        db_paths = []
+        for db_path in self.shard_map.values():
+            if db_path not in db_paths:
+                db_paths.append(db_path)
+
+        # Paths outside of the configured roots are stored in the default db
+        if default_db_path not in db_paths and (not db_paths or os.path.exists(default_db_path)):
+            db_paths.append(default_db_path)
+
+        return db_paths
+
+    def _get_db_path(self, path):
+        """
+        Returns the db shard that holds the records for the given file or directory path
+        """
+        path = os.path.normpath(path)
+        matched_root = None
+        for root in self.shard_map:
+            if path == root or path.startswith(root.rstrip(os.sep) + os.sep):
+                if not matched_root or len(root) > len(matched_root):
+                    matched_root = root
+
+        if matched_root:
+            return self.shard_map[matched_root]
+        return os.path.join(self.db_folder_path, self.db_file_name)
+
+    def _get_shard_lock(self, db_path):
+        """
+        Returns the writer lock of a db shard, each shard is written by one thread at a time
+        """
+        with self.shard_locks_guard:
+            if db_path not in self.shard_locks:
+                self.shard_locks[db_path] = threading.Lock()
+            return self.shard_locks[db_path]
 
-    def create_db(self):
+    def _federated_fetch(self, query, params=()):
+        """
+        Runs a read query against every db shard in parallel and merges the rows
+        """
+        db_paths = self.get_db_paths()
+
+        def fetch(db_path):
+            conn = self.connect_db(db_path)
+            try:
+                cursor = conn.cursor()
+                cursor.execute(query, params)
+                return cursor.fetchall()
+            finally:
+                conn.close()
+
+        if len(db_paths) == 1:
+            return fetch(db_paths[0])
+
+        from concurrent.futures import ThreadPoolExecutor
+        results = []
+        with ThreadPoolExecutor(max_workers=len(db_paths)) as executor:
+            for rows in executor.map(fetch, db_paths):
+                results.extend(rows)
+        return results
+
+    def create_db(self, dbFilePath = None):
         """
         Creates the 'file_db.db' file in the root directory and creates the
         'files' table.
         """
-        dbFilePath = os.path.join(self.db_folder_path, self.db_file_name)
+        if not dbFilePath:
+            dbFilePath = os.path.join(self.db_folder_path, self.db_file_name)
         conn = None
         # check if the database file already exists
         if os.path.exists(dbFilePath):
@@ -102,6 +270,61 @@ class HashCheck:
         self.logger.info(f"Database file created successfully at {dbFilePath}")
         return conn
 
+    def _prepare_db(self, conn, db_path):
+        """
+        Adds the file_size column, the summary table and the block manifest table to a db written by an older version
+        and rebuilds the summary when it is new or the root directories changed since it was built. Checked once
+        per run, a db that is up to date is only read, so reports don't write to it or wait for a running scan.
+        """
+        with self.prepared_dbs_lock:
+            if db_path in self.prepared_dbs:
+                return
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(files)")]
+            if not columns:
+                return
+            has_summary = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='file_summary'").fetchone()
+
+            if conn.execute("PRAGMA user_version").fetchone()[0] < DB_SCHEMA_VERSION:
+                summary_schema = ''
+                try:
+                    for schema_file in ("hashCheck/hash_db_summary.sql", "hashCheck/hash_db_blocks.sql"):
+                        with open(schema_file, "r") as f:
+                            summary_schema += f.read()
+                except Exception as e:
+                    self.logger.error(f"Error reading schema file: {e}")
+                    return
+
+                with self._get_shard_lock(db_path):
+                    if 'file_size' not in columns:
+                        try:
+                            conn.execute("ALTER TABLE files ADD COLUMN file_size INTEGER")
+                        except sqlite3.OperationalError:
+                            # Another process added it first
+                            pass
+                    # Tables and triggers are replaced in one transaction, together with the version
+                    conn.executescript("BEGIN IMMEDIATE;\n{0}\nPRAGMA user_version = {1:d};\nCOMMIT;".format(summary_schema, DB_SCHEMA_VERSION))
+
+            roots = {os.path.normpath(root) for root in self.root_directories}
+            summary_roots = {root for (root,) in conn.execute("SELECT root FROM summary_roots")}
+            if not has_summary or roots != summary_roots:
+                with self._get_shard_lock(db_path):
+                    self.logger.info("Building the summary of %s", db_path)
+                    self._rebuild_summary(conn, roots)
+                    conn.commit()
+            self.prepared_dbs.add(db_path)
+
+    def _rebuild_summary(self, conn, roots):
+        # The triggers keep the summary up to date from here on, this is the one full pass over the files
+        conn.execute("DELETE FROM summary_roots")
+        conn.executemany("INSERT INTO summary_roots (root, prefix) VALUES (?, ?)", [(root, root.rstrip(os.sep) + os.sep) for root in roots])
+        conn.execute("DELETE FROM file_summary")
+        conn.execute("""INSERT INTO file_summary (root, file_type, files, bytes, missing, mismatched)
+                        SELECT file_root, file_type, COUNT(*), SUM(COALESCE(file_size, 0)), SUM(missing_date IS NOT NULL), SUM(mismatch_date IS NOT NULL)
+                        FROM (SELECT COALESCE((SELECT root FROM summary_roots WHERE files.file_path = root OR substr(files.file_path, 1, length(prefix)) = prefix
+                                               ORDER BY length(root) DESC LIMIT 1), '') AS file_root,
+                                     COALESCE(file_type, '') AS file_type, file_size, missing_date, mismatch_date FROM files)
+                        GROUP BY file_root, file_type""")
+
     def scan_and_hash_files(self, directories = None):
         """
         Loops through all root directories
@@ -110,8 +333,12 @@ class HashCheck:
         gets their hashes, and saves the information to db.
         """
 
+        import queue
         # Create the directory queue
         self.directoryQueue = queue.Queue()
+        # Folders already queued by this scan, by device and inode
+        self.visited_directories = set()
+        self.visited_lock = threading.Lock()
 
         # If no directory paths are in the config exit
         if self.root_directories:
@@ -122,9 +349,12 @@ class HashCheck:
                 self.directoryQueue.put(root_path)
         else:
             return
+        for root_path in list(self.directoryQueue.queue):
+            self.visited_directories.add(getDirectoryKey(root_path))
 
-        # Creates a DB with the name provided, if one is not found at the file path
-        self.create_db()
+        # Creates a DB for every shard with the name provided, if one is not found at the file path
+        for db_path in self.get_db_paths():
+            self.create_db(db_path)
 
 
         # Start the directory workers
@@ -136,12 +366,15 @@ class HashCheck:
 
         # wait for all items to be processed
         self.directoryQueue.join()
+        # Every folder is done, the workers stop now instead of waiting out their queue timeout
+        for t in threads:
+            self.directoryQueue.put(None)
         for t in threads:
             t.join()   
 
     def directory_worker(self):
         """
-            Worker keeps grabbing directories from the queue, if none are found it waits 60 seconds and terminates
+            Worker keeps grabbing directories from the queue until the scan is done, or no directory came for 60 seconds
         """
         path = None
         while True:
@@ -150,22 +383,30 @@ class HashCheck:
                 path = self.directoryQueue.get(timeout=60)
             except Exception as e:
                 break
+            if path is None:
+                break
             
-            # Scan Hash files in directory
-            self._scan_and_hash_files(path)
-
-            # Let the queue know the task has be finished
-            self.directoryQueue.task_done()
+            # Scan Hash files in directory, an error in one directory doesn't stop the worker or leave the scan waiting on it
+            try:
+                self._scan_and_hash_files(path)
+            except Exception as e:
+                self.logger.error('Error scanning %s: %s', path, e)
+            finally:
+                # Let the queue know the task has be finished
+                self.directoryQueue.task_done()
     
     def _crud_db(self, conn, db_actions):
         # Bulk Inserting Updated and Deleting from the database
-        self.logger.debug(f'Preforming transaction on the following paths: {db_actions}')
+        self.logger.debug('Preforming transaction on the following paths: %s', db_actions)
         self._delete_file_record(conn, db_actions["delete_file_record"])
         self._clear_missing_date(conn, db_actions["clear_missing_date"])
         self._update_missing_date(conn, db_actions["update_missing_date"])
         self._update_mismatch_date(conn, db_actions["update_mismatch_date"])
         self._clear_mismatch_date(conn, db_actions["clear_mismatch_date"])
         self._insert_file_record(conn, db_actions["insert_file_record"])
+        self._update_file_size(conn, db_actions["update_file_size"])
+        self._insert_block_manifest(conn, db_actions["insert_block_manifest"])
+        self._update_block_ranges(conn, db_actions["update_block_ranges"])
         self.logger.info('Database Updated')
     
     def _get_db_actions_skeleton(self):
@@ -176,6 +417,9 @@ class HashCheck:
             "clear_mismatch_date" : [],
             "insert_file_record" : [],
             "delete_file_record" : [],
+            "update_file_size" : [],
+            "insert_block_manifest" : [],
+            "update_block_ranges" : [],
         }
 
     def _scan_and_hash_files(self, path):
@@ -183,122 +427,174 @@ class HashCheck:
         Scans all files in the root directory and nested subdirectories, 
         gets their hashes, and saves the information to db.
         """
-        conn = self.connect_db()
         # Check if root directory is specified and exists
         if not path or not os.path.exists(path):
             self.logger.error('path not found')
             return
 
+        # Scan directory without the excluded folders and files, queue the sub directories and collect the files
+        dir_entries, file_entries = scanDirectory(path, self.exclusion_matcher, follow_symlinks=True)
+        for entry in dir_entries:
+            # Add to queue for another worker to process, folders reached again through a symlink are skipped so loops end
+            if self._mark_visited(entry):
+                self.directoryQueue.put(entry.path)
+
+        self.hash_files(path, [entry.name for entry in file_entries], file_entries=file_entries)
+
+    def _mark_visited(self, entry):
+        key = getDirectoryKey(entry)
+        if key is None:
+            return False
+        with self.visited_lock:
+            if key in self.visited_directories:
+                return False
+            self.visited_directories.add(key)
+            return True
+
+    def hash_files(self, path, file_names, db_path=None, file_entries=None):
+        """
+        Hashes the given files of a single directory and saves the information to the db shard of the directory,
+        or to db_path when one is given. Used by the directory workers, the shard workers and by the media pipeline.
+        file_entries are the DirEntry objects of the files from the listing. A file's size is only read when it is needed,
+        through the stat its DirEntry caches, so the checks that need it share a single stat.
+        """
+        # Each root writes to its own shard
+        db_path = db_path or self._get_db_path(path)
+        conn = self.connect_db(db_path)
+
         # Create a list of transactions the db needs to do, so that the db is not bogged down by constant transactions
         db_action_lists = self._get_db_actions_skeleton()
+        entries = {entry.name: entry for entry in file_entries} if file_entries else {}
+        # Checked once per directory instead of building a debug line for every file
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+
+        for file in file_names:
+            # Get the full file path
+            file_path = os.path.join(path, file)
+
+            # Log the current file being processed
+            if debug:
+                self.logger.debug('Processing file: %s', file_path)
 
-        # Scan directory and loop through all files and folders
-        with os.scandir(path) as items:
-            for item in items:
-                if item.is_dir():
-                    # check if directory on exclusion list
-                    if self._is_directory_excluded(item):
-                        continue
-
-                    # Add to queue for another worker to process
-                    self.directoryQueue.put(os.path.join(path, item))
-                elif item.is_file():
-                    # Get the full file path
-                    file_path = os.path.join(path, item)
-
-                    # Log the current file being processed
-                    self.logger.debug(f'Processing file: {file_path}')
-
-                    # Process the file
-                    self._process_file(item.name, file_path, conn, db_action_lists) 
+            # Process the file
+            self._process_file(file, file_path, conn, db_action_lists, entries.get(file))
+
+        # The type and size of new files are looked up once, before the db lock is taken, so other workers don't wait behind ffprobe or the cache
+        if db_action_lists["insert_file_record"]:
+            db_action_lists["insert_file_record"] = self._describe_new_files(db_action_lists["insert_file_record"], entries)
                 
         # Only update the DB if there are transactions that need to process
-        if not self._is_empty_actions(db_action_lists):
-            self._crud_db(conn, db_action_lists)
+        with self._get_shard_lock(db_path):
+            if not self._is_empty_actions(db_action_lists):
+                self._crud_db(conn, db_action_lists)
 
-        # Commit changes and close the database connection
-        conn.commit()
+            # Commit changes and close the database connection
+            conn.commit()
         self.logger.debug('Committed changes to the database')
         conn.close()
         self.logger.debug('Closed database connection')
 
     def _is_empty_actions(self, actions):
-        if not actions.get("clear_missing_date", None) and not actions.get("update_mismatch_date", None) and not actions.get("clear_mismatch_date", None) and not actions.get("insert_file_record", None) and not actions.get("delete_file_record", None):
+        if not any(actions.get(action, None) for action in self._get_db_actions_skeleton()):
             self.logger.debug("No updates to the database.")
             return True
         return False
 
-    def _process_file(self,file,file_path, conn, db_action):
+    def _process_file(self,file,file_path, conn, db_action, entry=None):
         if self._skip_file(file, file_path):
             return
 
         # Check if the file is already in the database
         result = self._check_existing_file_in_db(conn,file_path)
-        # Check if the file still exists
-        if os.path.exists(file_path):
-            # Get the file's hash
-            file_hash = fileHash(file_path)
+        # The file was just listed, so it is hashed straight away and only counts as missing when it is gone by then
+        block_hashes = None
+        try:
+            if self._uses_block_manifest(file_path, entry):
+                from utility.blockManifest import get_file_hashes as getFileHashes
+                # Blocks are hashed with the size of the stored manifest, so the two can be compared
+                manifest = self._get_block_manifest(conn, file_path)
+                block_size = manifest['block_size'] if manifest else self.block_size
+                file_hash, block_hashes, file_size = getFileHashes(file_path, block_size)
+            else:
+                file_hash = self._hash_file(file_path)
+        except FileNotFoundError:
+            file_hash = None
 
+        if file_hash is not None:
             if result: 
-                self.logger.debug("File found in database")
                 missing_date = result[3]
                 hash_value = result[1]
                 mismatch_date = result[4]
-                self.logger.debug(f"missing_date: {missing_date}, hash_value: {hash_value}, mismatch_date: {mismatch_date}")
+                # Records written before sizes were stored get theirs the next time the file is seen
+                if len(result) > 6 and result[6] is None:
+                    db_action["update_file_size"].append((file_path, self._get_listed_size(file_path, entry)))
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug("File found in database")
+                    self.logger.debug("missing_date: %s, hash_value: %s, mismatch_date: %s", missing_date, hash_value, mismatch_date)
                 # Clear missing date if exists
                 if missing_date:
-                    self.logger.info(f"Clearing existing missing date for  {file_path}")
+                    self.logger.info("Clearing existing missing date for  %s", file_path, extra=PER_FILE)
                     db_action["clear_missing_date"].append(file_path)
 
                 # Check if the hash has changed
                 if file_hash != hash_value:
                     # update the mismatch date
-                    self.logger.info(f'Hash mismatch for {file_path}')
+                    self.logger.info('Hash mismatch for %s', file_path)
                     db_action["update_mismatch_date"].append(file_path)
                 else:
                     if mismatch_date:
                         # Clear the mismatch date
-                        self.logger.info(f'Clearing mismatch date for {file_path}')
+                        self.logger.info('Clearing mismatch date for %s', file_path, extra=PER_FILE)
                         db_action["clear_mismatch_date"].append(file_path)
             else:
-                self.logger.info(f'New file added {file_path}')
+                self.logger.info('New file added %s', file_path, extra=PER_FILE)
                 db_action["insert_file_record"].append((file_path, file_hash))
+
+            if block_hashes is not None:
+                self._add_block_actions(db_action, file_path, result, file_hash, manifest, block_size, block_hashes, file_size)
                 
         else:
             # If File is missing
             if result:
                 # Update the database with the missing date
-                self.logger.info(f'File missing for {file_path}')
+                self.logger.info('File missing for %s', file_path)
                 db_action["update_missing_date"].append(file_path)
 
+    def _hash_file(self, file_path):
+        return fileHash(file_path)
+
+    def _uses_block_manifest(self, file_path, entry=None):
+        if not self.block_manifests:
+            return False
+        file_size = self._get_listed_size(file_path, entry)
+        return file_size is not None and file_size >= self.block_manifest_min_size
+
+    def _get_block_manifest(self, conn, file_path):
+        cursor = conn.execute("SELECT file_path, file_size, block_size, block_hashes, verified_date, mismatch_ranges FROM block_manifests WHERE file_path=?", (file_path,))
+        row = cursor.fetchone()
+        return dict(zip([column[0] for column in cursor.description], row)) if row else None
+
+    def _add_block_actions(self, db_action, file_path, result, file_hash, manifest, block_size, block_hashes, file_size):
+        from utility.blockManifest import get_changed_ranges as getChangedRanges
+        if not result or file_hash == result[1]:
+            # The blocks are those of the recorded content, a file that matches again loses the ranges of its old mismatch
+            if not manifest:
+                db_action["insert_block_manifest"].append((file_path, file_size, block_size, block_hashes, currentDateTime()))
+            elif manifest['mismatch_ranges']:
+                db_action["update_block_ranges"].append((None, file_path))
+        elif manifest:
+            ranges = getChangedRanges(block_size, manifest['block_hashes'], manifest['file_size'], block_hashes, file_size)
+            self.logger.info('Changed bytes of %s: %s', file_path, ranges)
+            db_action["update_block_ranges"].append((json.dumps(ranges), file_path))
+
     def _skip_file(self, file, file_path):
         """
         Check if file should be skipped.
         """
-        # Check if file extension is in the exclusion list
-        if any(file.endswith(ext) for ext in self.exclusions.get("extensions", [])):
-            self.logger.debug(f"Skipping file {file}. File extension is in exclusion list.")
-            return True
-        # Check if file name is in the exclusion list
-        if file in self.exclusions.get("fileNames", []):
-            self.logger.debug(f"Skipping file {file}. File name is in exclusion list.")
+        if self.exclusion_matcher.is_file_excluded(file, file_path):
+            self.logger.debug("Skipping file %s. File is in exclusion list.", file)
             return True
-        # Check if file path is in the exclusion list
-        for path in self.exclusions.get("paths", []):
-            if os.path.commonpath([path, file_path]) == path:
-                self.logger.debug(f"Skipping file {file}. File path is in exclusion list.")
-                return True
         # If no exclusions apply, file is not skipped
-        self.logger.debug(f"File {file} is not in the exclusion list.")
-        return False
-
-    def _is_directory_excluded(self,item):
-        """
-        Check if directory should be skipped
-        """
-        if item.name in self.exclusions.get("folderNames",[]):
-            return True
-        
         return False
 
     def get_flagged_files(self, flag = None):
@@ -306,29 +602,26 @@ class HashCheck:
         Returns the records that have either missing or mismatched dates based on the flag passed in. 
         flag = 'missing' or 'mismatch'
         """
-        conn = self.connect_db()
-        cursor = conn.cursor()
         # Log the start of the function with an info log
         self.logger.info("Getting flagged files from database")
 
         # Get the records based on the flag
         if flag == "missing":
-            cursor.execute("SELECT * FROM files WHERE missing_date IS NOT NULL")
+            query = "SELECT * FROM files WHERE missing_date IS NOT NULL"
         elif flag == "mismatch":
-            cursor.execute("SELECT * FROM files WHERE mismatch_date IS NOT NULL")
+            query = "SELECT * FROM files WHERE mismatch_date IS NOT NULL"
         elif flag == None:
-            cursor.execute("SELECT * FROM files WHERE mismatch_date IS NOT NULL OR missing_date IS NOT NULL")
+            query = "SELECT * FROM files WHERE mismatch_date IS NOT NULL OR missing_date IS NOT NULL"
         else:
             # Log an error if an invalid flag is passed in
             self.logger.error("Invalid flag. Please use 'missing' or 'mismatch'.")
             raise ValueError("Invalid flag. Please use 'missing' or 'mismatch'.")
-            
-        results = cursor.fetchall()
+
+        # Fan out over every shard and merge the records
+        results = self._federated_fetch(query)
         
         # Log the number of results retrieved
         self.logger.debug(f"{len(results)} results retrieved")
-        
-        conn.close()
 
         report = self._get_report(results)
         return report
@@ -337,18 +630,8 @@ class HashCheck:
         """
         Returns all files in the database
         """
-        conn = self.connect_db()
-        cursor = conn.cursor()
-
-        # Check if database is connected
-        if not conn:
-            self.logger.error("Failed to connect to database")
-            return
-
         self.logger.debug("Fetching all files from database")
-        cursor.execute("SELECT * FROM files")
-        results = cursor.fetchall()
-        conn.close()
+        results = self._federated_fetch("SELECT * FROM files")
 
         # Log the result of the query execution
         if results:
@@ -360,33 +643,136 @@ class HashCheck:
 
         return report
 
+    def get_summary(self):
+        """
+        Returns the number of files, bytes, missing and mismatched files by root and file type. The counts come from
+        the summary table the db triggers keep up to date, so no file record is read.
+        Files outside of every root and files without a type are under None.
+        """
+        results = self._federated_fetch("SELECT root, file_type, files, bytes, missing, mismatched FROM file_summary WHERE files > 0")
+
+        summary = {"total" : self._get_summary_counts(), "roots" : {}}
+        for root, file_type, files, bytes, missing, mismatched in results:
+            root_summary = summary["roots"].setdefault(root or None, {"total" : self._get_summary_counts(), "file_types" : {}})
+            # Several db shards can hold files outside of the roots
+            for counts in (summary["total"], root_summary["total"], root_summary["file_types"].setdefault(file_type or None, self._get_summary_counts())):
+                counts["files"] += files
+                counts["bytes"] += bytes
+                counts["missing"] += missing
+                counts["mismatched"] += mismatched
+        return summary
+
+    def _get_summary_counts(self):
+        return {"files" : 0, "bytes" : 0, "missing" : 0, "mismatched" : 0}
+
+    def verify_blocks(self, paths=None, sample_blocks=4, seed=None):
+        """
+        Spot checks the files that have a block manifest by reading sample_blocks random blocks of each. A file with a
+        block that differs is read in full to find every range that changed, flagged as mismatched and its ranges are
+        stored. paths limits the check to those files and folders.
+        Returns {'files', 'blocks', 'mismatches' : {file_path : [[start, end], ...]}}.
+        """
+        import random
+        from concurrent.futures import ThreadPoolExecutor
+        from utility.blockManifest import get_block_count as getBlockCount
+        generator = random.Random(seed)
+        paths = [os.path.normpath(path) for path in paths or []]
+        report = {"files" : 0, "blocks" : 0, "mismatches" : {}}
+
+        for db_path in self.get_db_paths():
+            conn = self.connect_db(db_path)
+            verified = []
+            mismatches = {}
+            try:
+                cursor = conn.execute("SELECT file_path, file_size, block_size, block_hashes FROM block_manifests")
+                with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
+                    while True:
+                        # Manifests are read in batches, a 20 GB file has a few thousand blocks
+                        rows = cursor.fetchmany(1000)
+                        if not rows:
+                            break
+                        checks = []
+                        for row in rows:
+                            if paths and not any(row[0] == path or row[0].startswith(path.rstrip(os.sep) + os.sep) for path in paths):
+                                continue
+                            block_count = getBlockCount(row[3])
+                            checks.append((row, sorted(generator.sample(range(block_count), min(sample_blocks, block_count)))))
+                        for file_path, checked_blocks, ranges in executor.map(self._verify_block_sample, checks):
+                            if not checked_blocks:
+                                continue
+                            report["files"] += 1
+                            report["blocks"] += checked_blocks
+                            verified.append(file_path)
+                            if ranges:
+                                self.logger.info('Hash mismatch for %s, changed bytes: %s', file_path, ranges)
+                                mismatches[file_path] = ranges
+
+                with self._get_shard_lock(db_path):
+                    conn.executemany("UPDATE block_manifests SET verified_date=? WHERE file_path=?", [(currentDateTime(), path) for path in verified])
+                    self._update_mismatch_date(conn, list(mismatches))
+                    self._update_block_ranges(conn, [(json.dumps(ranges), path) for path, ranges in mismatches.items()])
+                    conn.commit()
+            finally:
+                conn.close()
+            report["mismatches"].update(mismatches)
+
+        self.logger.info('Verified %d blocks of %d files, %d files changed', report["blocks"], report["files"], len(report["mismatches"]))
+        return report
+
+    def _verify_block_sample(self, check):
+        from utility.blockManifest import get_file_hashes as getFileHashes, get_block_hash as getBlockHash, get_changed_ranges as getChangedRanges, DIGEST_SIZE
+        (file_path, file_size, block_size, block_hashes), indexes = check
+        try:
+            if os.path.getsize(file_path) == file_size and all(getBlockHash(file_path, index, block_size) == block_hashes[index * DIGEST_SIZE:(index + 1) * DIGEST_SIZE]
+                                                               for index in indexes):
+                return file_path, len(indexes), None
+            # A sampled block differs, the whole file is read once to tell every range that changed
+            file_hash, actual_hashes, actual_size = getFileHashes(file_path, block_size)
+        except FileNotFoundError:
+            # Missing files are flagged by the scan
+            return file_path, 0, None
+        except OSError as e:
+            self.logger.error('Error verifying %s: %s', file_path, e)
+            return file_path, 0, None
+        return file_path, len(indexes), getChangedRanges(block_size, block_hashes, file_size, actual_hashes, actual_size) or None
+
+    def get_block_mismatches(self):
+        """
+        Returns the byte ranges that changed of every mismatched file that has a block manifest
+        """
+        results = self._federated_fetch("SELECT file_path, file_size, block_size, verified_date, mismatch_ranges FROM block_manifests WHERE mismatch_ranges IS NOT NULL")
+        report = {}
+        for file_path, file_size, block_size, verified_date, mismatch_ranges in results:
+            report[file_path] = {
+                                "file_path" : file_path,
+                                "file_size" : file_size,
+                                "block_size" : block_size,
+                                "verified_date" : verified_date,
+                                "mismatch_ranges" : json.loads(mismatch_ranges)
+                                }
+        return report
+
     def custom_query_execute(self, query):
         """
         Executes a custom query and returns the results as a report (json format)
         """
-        # Connect to the database and return if the connection was unsuccessful
-        conn = self.connect_db
-        cursor = conn.cursor()
-        
         # Log the start of the function execution
         self.logger.debug(f"Executing query: {query}")
-        results = None
-        # Execute the query to retrieve the file records
+        results = []
+        # Execute the query to retrieve the file records from every shard
         try:
-            cursor.execute(query)
-            results = cursor.fetchall()
+            results = self._federated_fetch(query)
         except Exception as e:
             self.logger.error(f'An error occured when trying to execute the following query: {query} \n Error: {e}')
         
         # Log the result of the query execution
         if results:
-            self.logger.info(f"Found {len(results)} files of type {file_type}")
+            self.logger.info(f"Found {len(results)} files")
         else:
-            self.logger.warning(f"No files found of type: {file_type}")
+            self.logger.warning(f"No files found for query: {query}")
         
         # Call the function to get the report from the results
         report = self._get_report(results)
-        conn.close()
         # Return the report
         return report
 
@@ -394,15 +780,11 @@ class HashCheck:
         """
         Returns the records that have the file type that is passed in
         """
-        # Connect to the database and return if the connection was unsuccessful
-        conn = self.connect_db()
-        cursor = conn.cursor()
         # Log the start of the function execution
         self.logger.debug(f"Getting files of type: {file_type}")
         
-        # Execute the query to retrieve the file records
-        cursor.execute("SELECT * FROM files WHERE file_type=?", (file_type,))
-        results = cursor.fetchall()
+        # Execute the query to retrieve the file records from every shard
+        results = self._federated_fetch("SELECT * FROM files WHERE file_type=?", (file_type,))
         
         # Log the result of the query execution
         if results:
@@ -412,7 +794,6 @@ class HashCheck:
         
         # Call the function to get the report from the results
         report = self._get_report(results)
-        conn.close()
         # Return the report
         return report
 
@@ -423,10 +804,6 @@ class HashCheck:
         # Log a debug message indicating the start of the function
         self.logger.debug("Getting files by initial date: %s", initial_date)
 
-        # Check if the database connection is established
-        conn = self.connect_db()
-        cursor = conn.cursor()
-
         # Log an info message indicating the parsing of the initial date
         self.logger.info("Parsing initial date: %s", initial_date)
 
@@ -437,10 +814,8 @@ class HashCheck:
         # Log a debug message indicating the execution of the SQL query
         self.logger.debug("Executing SQL query: SELECT * FROM files WHERE initial_date = %s", initial_date)
 
-        # Execute the SQL query to retrieve the matching records
-        cursor.execute("SELECT * FROM files WHERE initial_date = ?", (initial_date,))
-        results = self.cursor.fetchall()
-        conn.close()
+        # Execute the SQL query to retrieve the matching records from every shard
+        results = self._federated_fetch("SELECT * FROM files WHERE initial_date = ?", (initial_date,))
 
         # Log a debug message indicating the start of the `_get_report` function
         self.logger.debug("Getting report from results")
@@ -457,17 +832,21 @@ class HashCheck:
         """
         Resets all the fields of the db and re-scan all files
         """
-        conn = self.connect_db()
-        cursor = conn.cursor()
+        for db_path in self.get_db_paths():
+            conn = self.connect_db(db_path)
+            cursor = conn.cursor()
 
-        try:
-            cursor.execute("DELETE FROM files")
-            conn.commit()
-            self.logger.info("Successfully deleted all records from the database")
-        except Exception as e:
-            self.logger.error("An error occurred while deleting the records from the database: {}".format(e))
-            return
-        conn.close()
+            try:
+                with self._get_shard_lock(db_path):
+                    cursor.execute("DELETE FROM files")
+                    cursor.execute("DELETE FROM block_manifests")
+                    conn.commit()
+                self.logger.info("Successfully deleted all records from the database: %s", db_path)
+            except Exception as e:
+                self.logger.error("An error occurred while deleting the records from the database: {}".format(e))
+                return
+            finally:
+                conn.close()
         self.logger.info("Starting to re-scan all the files")
         self.scan_and_hash_files()
 
@@ -478,7 +857,8 @@ class HashCheck:
         scan_list should include full paths to the folder or files
         """
 
-        db_actions = self._get_db_actions_skeleton()
+        # Records are deleted from the shard that owns each path
+        shard_db_actions = {}
         valid_directories = set()
         # Walk through all files and directories in the scan list
         for item in scan_list:
@@ -488,10 +868,10 @@ class HashCheck:
             if os.path.isdir(item):
                 for subdir, dirs, files in os.walk(item):
                     # Skip any directories in the skip list
-                    dirs = self._skip_directories(dirs)
+                    self.exclusion_matcher.prune_dirnames(subdir, dirs)
                     self.logger.debug("Removed directories from iteration")
                     
-                    valid_directories.add(item.path)
+                    valid_directories.add(item)
 
                     for file in files:
                         # Get the full file path
@@ -503,22 +883,238 @@ class HashCheck:
                             continue
 
                         # Re-initialize the record with the file path
-                        db_actions["delete_file_record"].append(file_path)
+                        self._get_shard_actions(shard_db_actions, file_path)["delete_file_record"].append(file_path)
                         self.logger.info("Record for file %s has been re-initialized", file)
             elif os.path.isfile(item):
                 # Re-initialize the record with the file path
                 valid_directories.add(os.path.dirname(item))
-                db_actions["delete_file_record"].append(item.path)
+                self._get_shard_actions(shard_db_actions, item)["delete_file_record"].append(item)
                 self.logger.info("Record for file %s has been re-initialized", item)
             else:
                 self.logger.warning("%s is not a valid file or directory. Skipping...", item)
         
-        conn = self.connect_db
-        self._crud_db(conn, db_actions)
-        conn.close()
+        for db_path, db_actions in shard_db_actions.items():
+            conn = self.connect_db(db_path)
+            with self._get_shard_lock(db_path):
+                self._crud_db(conn, db_actions)
+            conn.close()
 
         self.scan_and_hash_files(list(valid_directories))
 
+    def _get_shard_actions(self, shard_db_actions, path):
+        """
+        Returns the db action lists of the shard that owns the path
+        """
+        db_path = self._get_db_path(path)
+        if db_path not in shard_db_actions:
+            shard_db_actions[db_path] = self._get_db_actions_skeleton()
+        return shard_db_actions[db_path]
+
+    def plan_shards(self, shard_folder=None, shard_count=None, replace=False):
+        """
+        Coordinator of a distributed scan: splits the root directories into shards of about the same size, writes a
+        manifest for every shard and registers them in the lease db of the shard folder. Returns the shards, None
+        when the folder holds shards of a previous plan that are claimed or hashed but not merged yet (unless replace).
+        """
+        from utility.distributedScan import plan_shards as planShards, write_manifest as writeManifest, ShardLeases, CLAIMED, DONE
+        shard_folder = shard_folder or self.scan_shard_folder
+        if not self.root_directories:
+            self.logger.error('No rootFolderList in the config, there is nothing to split into shards')
+            return None
+        os.makedirs(shard_folder, exist_ok=True)
+
+        leases = ShardLeases(shard_folder, self.scan_shard_lease_seconds, self.scan_shard_max_attempts)
+        try:
+            counts = leases.get_counts()
+            unfinished = counts.get(CLAIMED, 0) + counts.get(DONE, 0)
+            if unfinished and not replace:
+                self.logger.error('%s has %d shards that are claimed or not merged yet, merge them first or plan again with replace', shard_folder, unfinished)
+                return None
+
+            # Only the sizes of the files are read here, the workers do the hashing
+            shards = planShards(self.root_directories, shard_count or self.scan_shard_count, self.exclusion_matcher)
+
+            # Manifests and partial dbs of the previous plan
+            for name in os.listdir(shard_folder):
+                if name.startswith('shard-'):
+                    os.remove(os.path.join(shard_folder, name))
+
+            records = []
+            for index, shard in enumerate(shards, 1):
+                shard_id = 'shard-{0:04d}'.format(index)
+                shard.update(shard_id=shard_id, planned_date=currentDateTime())
+                # Folder names are relative to the shard folder, which every host may mount at a different path
+                writeManifest(shard, os.path.join(shard_folder, shard_id + '.json'))
+                records.append({"shard_id" : shard_id, "manifest_file" : shard_id + '.json', "partial_db" : shard_id + '.db',
+                                "bytes" : shard['bytes'], "files" : shard['files']})
+            leases.add_shards(records)
+        finally:
+            leases.close()
+
+        self.logger.info('Planned %d shards of %d files in %s', len(shards), sum(shard['files'] for shard in shards), shard_folder)
+        return shards
+
+    def scan_shards(self, shard_folder=None):
+        """
+        Worker of a distributed scan: claims shards from the lease db and hashes each into its own partial db until
+        every shard is hashed. Waits while other workers hold shards, so the shard of a worker that died is taken
+        over once its lease runs out. Returns the number of shards this worker hashed.
+        """
+        from utility.distributedScan import ShardLeases, CLAIMED
+        shard_folder = shard_folder or self.scan_shard_folder
+        leases = ShardLeases(shard_folder, self.scan_shard_lease_seconds, self.scan_shard_max_attempts)
+        hashed = 0
+        try:
+            while True:
+                shard = leases.claim()
+                if not shard:
+                    if not leases.get_counts().get(CLAIMED, 0):
+                        break
+                    time.sleep(max(1, self.scan_shard_lease_seconds / 3))
+                    continue
+
+                self.logger.info('Claimed %s: %d files, %.1f MB', shard['shard_id'], shard['files'] or 0, (shard['bytes'] or 0) / (1024 * 1024))
+                if self._scan_shard(shard_folder, leases, shard):
+                    hashed += 1
+        finally:
+            leases.close()
+        self.logger.info('Worker finished after hashing %d shards', hashed)
+        return hashed
+
+    def _scan_shard(self, shard_folder, leases, shard):
+        from utility.distributedScan import read_manifest as readManifest, LeaseKeeper
+        partial_db_path = os.path.join(shard_folder, shard['partial_db'])
+        # Every worker writes its own file, the partial db only appears under its name once it is complete
+        temp_db_path = '{0}.{1}-{2}.tmp'.format(partial_db_path, leases.host, leases.pid)
+        try:
+            manifest = readManifest(os.path.join(shard_folder, shard['manifest_file']))
+            if os.path.exists(temp_db_path):
+                os.remove(temp_db_path)
+            conn = self.create_db(temp_db_path)
+            if conn:
+                conn.close()
+
+            with LeaseKeeper(leases, shard['shard_id']) as keeper:
+                completed = self._hash_shard_units(manifest['units'], temp_db_path, keeper.lost)
+            if not completed or not leases.renew(shard['shard_id']):
+                self.logger.warning('Lost the lease of %s to another worker, its partial db is dropped', shard['shard_id'])
+                os.remove(temp_db_path)
+                return False
+
+            os.replace(temp_db_path, partial_db_path)
+            leases.mark_done(shard['shard_id'])
+            self.logger.info('Hashed %s into %s', shard['shard_id'], partial_db_path)
+            return True
+        except Exception as e:
+            self.logger.error('Error hashing %s: %s', shard['shard_id'], e)
+            leases.mark_failed(shard['shard_id'], str(e))
+            if os.path.exists(temp_db_path):
+                os.remove(temp_db_path)
+            return False
+
+    def _hash_shard_units(self, units, db_path, lost):
+        from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+        from utility.distributedScan import iterate_unit as iterateUnit
+        # The folders of the units are hashed on the processing threads, a few are queued per thread so the walk stays ahead
+        with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
+            pending = set()
+            for unit in units:
+                for dirpath, file_entries in iterateUnit(unit, self.exclusion_matcher):
+                    if lost.is_set():
+                        break
+                    if file_entries:
+                        pending.add(executor.submit(self.hash_files, dirpath, [entry.name for entry in file_entries], db_path, file_entries))
+                    if len(pending) >= self.thread_count * 4:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+            for future in pending:
+                future.result()
+        return not lost.is_set()
+
+    def merge_shards(self, shard_folder=None, batch_size=10000):
+        """
+        Folds the partial dbs of the hashed shards into the files table of the db shard that owns each path, the
+        same way a local scan updates it: new files are added, files seen again lose their missing date, and a
+        changed hash sets the mismatch date (a matching one clears it). Returns the number of shards and files merged.
+        """
+        from utility.distributedScan import ShardLeases, DONE, MERGED
+        shard_folder = shard_folder or self.scan_shard_folder
+        leases = ShardLeases(shard_folder, self.scan_shard_lease_seconds, self.scan_shard_max_attempts)
+        merged = {"shards" : 0, "files" : 0}
+        try:
+            for shard in leases.get_shards(DONE):
+                partial_db_path = os.path.join(shard_folder, shard['partial_db'])
+                merged['files'] += self._merge_partial_db(partial_db_path, batch_size)
+                merged['shards'] += 1
+                leases.mark_merged(shard['shard_id'])
+                os.remove(partial_db_path)
+                self.logger.info('Merged %s', shard['shard_id'])
+
+            counts = leases.get_counts()
+            unfinished = {state : count for state, count in counts.items() if state != MERGED}
+            if unfinished:
+                self.logger.warning('Shards that are not merged yet: %s', unfinished)
+        finally:
+            leases.close()
+        return merged
+
+    def _merge_block_manifests(self, partial_conn, connections):
+        # A manifest is kept when it is of the recorded content, and tells the changed ranges of a mismatched file whose manifest is stored
+        cursor = partial_conn.execute("""SELECT block_manifests.file_path, files.file_hash, block_manifests.block_size, block_manifests.block_hashes,
+                                         block_manifests.file_size FROM block_manifests JOIN files ON files.file_path = block_manifests.file_path""")
+        for file_path, file_hash, block_size, block_hashes, file_size in cursor:
+            db_path = self._get_db_path(file_path)
+            if db_path not in connections:
+                connections[db_path] = self.connect_db(db_path)
+            conn = connections[db_path]
+            with self._get_shard_lock(db_path):
+                result = self._check_existing_file_in_db(conn, file_path)
+                manifest = self._get_block_manifest(conn, file_path)
+                if manifest and manifest['block_size'] != block_size:
+                    continue
+                db_action = self._get_db_actions_skeleton()
+                self._add_block_actions(db_action, file_path, result, file_hash, manifest, block_size, block_hashes, file_size)
+                self._insert_block_manifest(conn, db_action["insert_block_manifest"])
+                self._update_block_ranges(conn, db_action["update_block_ranges"])
+
+    def _merge_partial_db(self, partial_db_path, batch_size):
+        # The hash of a changed file is kept and only flagged, as the local scan does
+        upsert = """INSERT INTO files (file_path, file_hash, initial_date, file_type, file_size) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(file_path) DO UPDATE SET missing_date=NULL,
+                    mismatch_date=CASE WHEN files.file_hash = excluded.file_hash THEN NULL ELSE ? END,
+                    file_size=COALESCE(files.file_size, excluded.file_size)"""
+        merge_date = currentDateTime()
+        partial_conn = sqlite3.connect(partial_db_path, timeout=60)
+        connections = {}
+        count = 0
+        try:
+            cursor = partial_conn.execute("SELECT file_path, file_hash, initial_date, file_type, file_size FROM files")
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                count += len(rows)
+                # The paths of one shard can belong to several db shards
+                db_rows = {}
+                for row in rows:
+                    db_rows.setdefault(self._get_db_path(row[0]), []).append(row + (merge_date,))
+                for db_path, values in db_rows.items():
+                    if db_path not in connections:
+                        connections[db_path] = self.connect_db(db_path)
+                    with self._get_shard_lock(db_path):
+                        connections[db_path].executemany(upsert, values)
+            self._merge_block_manifests(partial_conn, connections)
+            # Each db shard takes the whole partial db in one transaction
+            for db_path, conn in connections.items():
+                with self._get_shard_lock(db_path):
+                    conn.commit()
+        finally:
+            partial_conn.close()
+            for conn in connections.values():
+                conn.close()
+        return count
+
     def connect_db(self, dbFilePath = None):
         '''
         Connects to the sqlite database. If it doesn't exist it creates a new db
@@ -530,9 +1126,9 @@ class HashCheck:
         # Check if the database file already exists
         if not os.path.exists(dbFilePath):
             self.logger.info("Creating database since it doesn't exist")
-            conn = self.create_db()
+            conn = self.create_db(dbFilePath)
         try:
-            conn = sqlite3.connect(dbFilePath)
+            conn = sqlite3.connect(dbFilePath, timeout=60)
             self.logger.info("Successfully connected to database")
         except Exception as e:
             self.logger.error("Error connecting to database: %s", e)
@@ -541,6 +1137,7 @@ class HashCheck:
         if conn:
             cursor = conn.cursor()
             self.logger.debug("Cursor created successfully")
+            self._prepare_db(conn, dbFilePath)
         else:
             self.logger.error("Database connection was not established")
             raise Exception("Database connection was not established")
@@ -554,7 +1151,7 @@ class HashCheck:
 
         # Loop through each record in the database results
         for row in db_results:
-            file_path, file_hash, initial_date, missing_date, mismatch_date, file_type = row
+            file_path, file_hash, initial_date, missing_date, mismatch_date, file_type = row[:6]
 
             # Add each record to the report dictionary
             report[file_path] = {
@@ -563,7 +1160,8 @@ class HashCheck:
                                 "initial_date" : initial_date,
                                 "missing_date" : missing_date,
                                 "mismatch_date" : mismatch_date,
-                                "file_type" : file_type
+                                "file_type" : file_type,
+                                "file_size" : row[6] if len(row) > 6 else None
                                 }
 
         self.logger.info("Generated report from database results")
@@ -578,7 +1176,7 @@ class HashCheck:
         cursor = conn.cursor()
         if len(paths) > 0: 
             sqlite_update_query = """UPDATE files SET missing_date=NULL WHERE file_path=?"""
-            columnValues = [(x)for x in paths]
+            columnValues = [(x,) for x in paths]
             cursor.executemany(sqlite_update_query, columnValues)
             conn.commit()
 
@@ -602,7 +1200,7 @@ class HashCheck:
         cursor = conn.cursor()
         if len(paths) > 0: 
             sqlite_update_query = """UPDATE files SET mismatch_date=NULL WHERE file_path=?"""
-            columnValues = [(x)for x in paths]
+            columnValues = [(x,) for x in paths]
             cursor.executemany(sqlite_update_query, columnValues)
             conn.commit()
 
@@ -611,17 +1209,58 @@ class HashCheck:
         if len(paths) > 0: 
             columnValues = []
 
-            for path, hashValue in paths:
+            for path, hashValue, file_type, file_size in paths:
                 # Get the initial date
                 initial_date = currentDateTime()
 
-                # Get File Type
-                file_type = determine_file_type(path)
-
-                columnValues.append((path,hashValue,initial_date,file_type))
+                columnValues.append((path,hashValue,initial_date,file_type,file_size))
 
             # Add the file's information to the database
-            sqlite_update_query = """INSERT INTO files (file_path, file_hash, initial_date, file_type) VALUES (?, ?, ?, ?)"""
+            sqlite_update_query = """INSERT INTO files (file_path, file_hash, initial_date, file_type, file_size) VALUES (?, ?, ?, ?, ?)"""
+            cursor.executemany(sqlite_update_query, columnValues)
+            conn.commit()
+
+    def _describe_new_files(self, new_files, entries):
+        # Returns (path, hash, file type, file size) of new files, the file type comes from the metadata cache when there is one
+        stats = {}
+        for path, hashValue in new_files:
+            entry = entries.get(os.path.basename(path))
+            try:
+                stats[path] = entry.stat() if entry else os.stat(path)
+            except OSError:
+                stats[path] = None
+        metadata_cache = self._get_metadata_cache()
+        metadata = metadata_cache.get_many([(path, stat) for path, stat in stats.items() if stat]) if metadata_cache else {}
+
+        described = []
+        for path, hashValue in new_files:
+            if path in metadata:
+                described.append((path, hashValue, metadata[path]['file_type'], metadata[path]['size']))
+            else:
+                described.append((path, hashValue, determine_file_type(path), stats[path].st_size if stats[path] else None))
+        return described
+
+    def _get_metadata_cache(self):
+        if self.metadata_cache_path and self.metadata_cache is None:
+            with self.metadata_cache_lock:
+                if self.metadata_cache is None:
+                    from utility.metadataCache import MetadataCache
+                    self.metadata_cache = MetadataCache(self.metadata_cache_path, self.config.get('ffprobeBinary', None) or 'ffprobe',
+                                                        self.config.get('metadata_threads', 4))
+        return self.metadata_cache
+
+    def _get_listed_size(self, path, entry=None):
+        try:
+            # The stat of a DirEntry is cached, so every check of the same file shares it
+            return entry.stat().st_size if entry else os.path.getsize(path)
+        except OSError:
+            return None
+
+    def _update_file_size(self, conn, paths):
+        cursor = conn.cursor()
+        if len(paths) > 0: 
+            sqlite_update_query = """UPDATE files SET file_size=? WHERE file_path=?"""
+            columnValues = [(size, path) for path, size in paths]
             cursor.executemany(sqlite_update_query, columnValues)
             conn.commit()
 
@@ -629,7 +1268,23 @@ class HashCheck:
         cursor = conn.cursor()
         if len(paths) > 0: 
             sqlite_update_query = """DELETE FROM files WHERE file_path=?"""
-            columnValues = [(x)for x in paths]
+            columnValues = [(x,) for x in paths]
+            cursor.executemany(sqlite_update_query, columnValues)
+            cursor.executemany("""DELETE FROM block_manifests WHERE file_path=?""", columnValues)
+            conn.commit()
+
+    def _insert_block_manifest(self, conn, manifests):
+        cursor = conn.cursor()
+        if len(manifests) > 0: 
+            sqlite_update_query = """INSERT OR REPLACE INTO block_manifests (file_path, file_size, block_size, block_hashes, verified_date) VALUES (?, ?, ?, ?, ?)"""
+            cursor.executemany(sqlite_update_query, manifests)
+            conn.commit()
+
+    def _update_block_ranges(self, conn, ranges):
+        cursor = conn.cursor()
+        if len(ranges) > 0: 
+            sqlite_update_query = """UPDATE block_manifests SET mismatch_ranges=?, verified_date=? WHERE file_path=?"""
+            columnValues = [(file_ranges, currentDateTime(), path) for file_ranges, path in ranges]
             cursor.executemany(sqlite_update_query, columnValues)
             conn.commit()
         
\ No newline at end of file
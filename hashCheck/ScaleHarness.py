@@ -0,0 +1,242 @@
+import sys
+sys.path.append('hashCheck/')
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+import tracemalloc
+from hashCheck.HashCheck import HashCheck
+from utility.dateTime import get_current_datetime_string as currentDateTime
+try:
+    import resource
+except ImportError:
+    # Peak RSS is only read on unix
+    resource = None
+
+# Default regression thresholds, every metric in it is an upper limit
+DEFAULT_THRESHOLDS_FILE = 'hashCheck/scale_thresholds.json'
+
+# Extensions and types of the synthetic files, one in every RARE_TYPE_EVERY rows gets the rare type so type queries return few rows
+SYNTHETIC_TYPES = [('jpg', 'image/jpeg'), ('heic', 'image/heic'), ('mov', 'video/quicktime'), ('mp4', 'video/mp4')]
+RARE_TYPE = ('png', 'image/png')
+RARE_TYPE_EVERY = 1000
+
+
+def _get_synthetic_type(index):
+    return RARE_TYPE if index % RARE_TYPE_EVERY == 0 else SYNTHETIC_TYPES[index % len(SYNTHETIC_TYPES)]
+
+
+class SyntheticTree:
+    """
+    Folder structure that only exists as names: every folder has fanout sub folders down to depth levels below the
+    root and files_per_folder files. With wide_files the root also has a 'wide' folder holding that many files.
+    """
+
+    def __init__(self, root, fanout=10, depth=3, files_per_folder=100, wide_files=0):
+        self.root = os.path.normpath(root)
+        self.fanout = fanout
+        self.depth = depth
+        self.files_per_folder = files_per_folder
+        self.wide_files = wide_files
+        self.wide_folder = os.path.join(self.root, 'wide')
+
+    def list(self, path):
+        """
+        Returns (sub folder paths, file names) of a folder of the tree
+        """
+        if path == self.wide_folder:
+            return [], self._get_file_names(self.wide_files)
+        level = 0 if path == self.root else path[len(self.root) + 1:].count(os.sep) + 1
+        folders = [os.path.join(path, 'd{0:03d}'.format(index)) for index in range(self.fanout)] if level < self.depth else []
+        if path == self.root and self.wide_files:
+            folders.append(self.wide_folder)
+        return folders, self._get_file_names(self.files_per_folder)
+
+    def _get_file_names(self, count):
+        return ['f{0:06d}.{1}'.format(index, _get_synthetic_type(index)[0]) for index in range(count)]
+
+    def get_folder_count(self):
+        return sum(self.fanout ** level for level in range(self.depth + 1)) + (1 if self.wide_files else 0)
+
+    def get_file_count(self):
+        return sum(self.fanout ** level for level in range(self.depth + 1)) * self.files_per_folder + self.wide_files
+
+
+class SyntheticHashCheck(HashCheck):
+    """
+    HashCheck that walks a SyntheticTree instead of the disk and hashes the path of a file instead of its content,
+    so the queue, the per folder action lists and the db writes of a scan run at any size without files
+    """
+
+    def __init__(self, tree, **kwargs):
+        self.tree = tree
+        super().__init__(**kwargs)
+
+    def _scan_and_hash_files(self, path):
+        folders, file_names = self.tree.list(path)
+        for folder in folders:
+            self.directoryQueue.put(folder)
+        self.hash_files(path, file_names)
+
+    def _hash_file(self, file_path):
+        return hashlib.sha256(file_path.encode('utf-8')).hexdigest()
+
+
+class _QueueMonitor:
+    # Samples the length of the directory queue of a running scan
+    def __init__(self, hash_check, interval=0.05):
+        self.hash_check = hash_check
+        self.interval = interval
+        self.max_queued = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            # The queue only exists once the scan started
+            if self.hash_check.directoryQueue is not None:
+                self.max_queued = max(self.max_queued, self.hash_check.directoryQueue.qsize())
+
+
+def _get_peak_rss_mb():
+    if not resource:
+        return None
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def _mb(size):
+    return round(size / (1024 * 1024), 1)
+
+
+class ScaleHarness:
+    """
+    Measures HashCheck at archive scale without an archive: fills a db with synthetic rows, times the report queries
+    against it, traces the memory of building a report and of a scan over a synthetic folder tree, and compares the
+    metrics with regression thresholds. Everything is written to work_folder.
+    """
+
+    def __init__(self, work_folder, config_path="hashCheck/default_config.json", config_overrides=None):
+        self.work_folder = work_folder
+        os.makedirs(work_folder, exist_ok=True)
+        self.db_file = 'scale.db'
+        # The harness db is the default db, synthetic paths are outside of every root, and only warnings are logged
+        self.config_kwargs = {"config_path" : config_path,
+                              "config_overrides" : dict(config_overrides or {}, rootFolderList=[], shardDatabases=False, dbFile=self.db_file,
+                                                        dbFileParentFolderPath=work_folder, metadataCacheFile='', logLevel='WARNING',
+                                                        singleFileLog=True, logFileName='scale.log', logFolderParentFolderPath=work_folder)}
+        self.db_path = os.path.join(work_folder, self.db_file)
+        self.metrics = {}
+
+    def run(self, rows=1000000, fanout=10, depth=3, files_per_folder=100, wide_files=100000, report_rows=1000000, missing_every=100, mismatch_every=1000):
+        """
+        Runs every measurement and returns the metrics
+        """
+        if os.path.exists(self.db_path):
+            os.remove(self.db_path)
+        hash_check = HashCheck(**self.config_kwargs)
+
+        self._fill_db(hash_check, rows, missing_every, mismatch_every)
+        self._time_queries(hash_check, rows)
+        self._measure_report(hash_check, min(report_rows, rows))
+        self._measure_walk(SyntheticTree('/synthetic/walk', fanout, depth, files_per_folder, wide_files))
+        self.metrics['peak_rss_mb'] = _get_peak_rss_mb()
+        return self.metrics
+
+    def _fill_db(self, hash_check, rows, missing_every, mismatch_every, batch_size=100000):
+        conn = hash_check.connect_db(self.db_path)
+        # The fill only sets up the db, so it doesn't wait for the disk
+        conn.execute("PRAGMA synchronous=OFF")
+        date = currentDateTime()
+        generator = random.Random(0)
+        started = time.perf_counter()
+        for start in range(0, rows, batch_size):
+            values = []
+            for index in range(start, min(start + batch_size, rows)):
+                extension, file_type = _get_synthetic_type(index)
+                values.append(('/synthetic/db/d{0:07d}/f{1:04d}.{2}'.format(index // 1000, index % 1000, extension), '%064x' % generator.getrandbits(256),
+                               date, date if index % missing_every == 0 else None, date if index % mismatch_every == 1 else None, file_type,
+                               generator.randint(100000, 50000000)))
+            conn.executemany("""INSERT INTO files (file_path, file_hash, initial_date, missing_date, mismatch_date, file_type, file_size)
+                                VALUES (?, ?, ?, ?, ?, ?, ?)""", values)
+            conn.commit()
+        conn.close()
+
+        db_bytes = os.path.getsize(self.db_path)
+        self.metrics.update(rows=rows, fill_seconds=round(time.perf_counter() - started, 3), db_mb=_mb(db_bytes),
+                            db_bytes_per_row=round(db_bytes / max(rows, 1), 1))
+
+    def _time_queries(self, hash_check, rows):
+        # Per million rows, so the thresholds hold for any fill size
+        scale = 1000000 / max(rows, 1)
+        queries = {"missing" : lambda: hash_check.get_flagged_files('missing'),
+                   "mismatch" : lambda: hash_check.get_flagged_files('mismatch'),
+                   "type" : lambda: hash_check.get_files_by_type(RARE_TYPE[1]),
+                   "count_flagged" : lambda: hash_check._federated_fetch("SELECT COUNT(*) FROM files WHERE missing_date IS NOT NULL OR mismatch_date IS NOT NULL"),
+                   "summary" : hash_check.get_summary}
+        for name, query in queries.items():
+            started = time.perf_counter()
+            query()
+            seconds = time.perf_counter() - started
+            self.metrics['{0}_query_seconds'.format(name)] = round(seconds, 3)
+            self.metrics['{0}_query_seconds_per_million_rows'.format(name)] = round(seconds * scale, 3)
+
+    def _measure_report(self, hash_check, report_rows):
+        # get_all_files builds one dict of every row, a slice of the table shows what a row costs
+        tracemalloc.start()
+        started = time.perf_counter()
+        report = hash_check.custom_query_execute("SELECT * FROM files LIMIT {0:d}".format(report_rows))
+        seconds = time.perf_counter() - started
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del report
+        self.metrics.update(report_rows=report_rows, report_seconds=round(seconds, 3), report_traced_peak_mb=_mb(peak),
+                            report_traced_bytes_per_row=round(peak / max(report_rows, 1), 1))
+
+    def _measure_walk(self, tree):
+        hash_check = SyntheticHashCheck(tree, **self.config_kwargs)
+        tracemalloc.start()
+        started = time.perf_counter()
+        with _QueueMonitor(hash_check) as monitor:
+            hash_check.scan_and_hash_files([tree.root])
+        seconds = time.perf_counter() - started
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        files = tree.get_file_count()
+        # The time includes the tracing, it is only compared with runs that traced as well
+        self.metrics.update(walk_folders=tree.get_folder_count(), walk_files=files, walk_seconds=round(seconds, 3),
+                            walk_seconds_per_thousand_files=round(seconds * 1000 / max(files, 1), 4), walk_traced_peak_mb=_mb(peak),
+                            walk_max_queued_folders=monitor.max_queued)
+
+
+def load_thresholds(thresholds_file=None):
+    with open(thresholds_file or DEFAULT_THRESHOLDS_FILE, 'r') as file:
+        return json.load(file)
+
+
+def check_thresholds(metrics, thresholds, baseline=None, tolerance=0.25):
+    """
+    Returns a line for every metric above its threshold, and with a baseline (the metrics of an earlier run) for
+    every thresholded metric that grew by more than tolerance over it
+    """
+    failures = []
+    for name, limit in thresholds.items():
+        value = metrics.get(name)
+        if value is None:
+            continue
+        if value > limit:
+            failures.append('{0} is {1}, the threshold is {2}'.format(name, value, limit))
+        if baseline and baseline.get(name) and value > baseline[name] * (1 + tolerance):
+            failures.append('{0} is {1}, {2:.0%} above the baseline of {3}'.format(name, value, value / baseline[name] - 1, baseline[name]))
+    return failures
@@ -0,0 +1,8 @@
+CREATE TABLE IF NOT EXISTS block_manifests (
+    file_path TEXT PRIMARY KEY,
+    file_size INTEGER,
+    block_size INTEGER,
+    block_hashes BLOB,
+    verified_date TIMESTAMP,
+    mismatch_ranges TEXT
+);
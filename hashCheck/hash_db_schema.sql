@@ -4,5 +4,6 @@ CREATE TABLE files (
     initial_date TIMESTAMP,
     missing_date TIMESTAMP,
     mismatch_date TIMESTAMP,
-    file_type TEXT
+    file_type TEXT,
+    file_size INTEGER
 );
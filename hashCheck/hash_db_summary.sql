@@ -0,0 +1,50 @@
+CREATE TABLE IF NOT EXISTS summary_roots (
+    root TEXT PRIMARY KEY,
+    prefix TEXT
+);
+
+CREATE TABLE IF NOT EXISTS file_summary (
+    root TEXT,
+    file_type TEXT,
+    files INTEGER DEFAULT 0,
+    bytes INTEGER DEFAULT 0,
+    missing INTEGER DEFAULT 0,
+    mismatched INTEGER DEFAULT 0,
+    PRIMARY KEY (root, file_type)
+);
+
+-- The triggers are created again whenever the db's user_version is older than DB_SCHEMA_VERSION, in the transaction
+-- HashCheck._prepare_db wraps this file in, so no write of another process slips in between. Rows are only inserted
+-- when missing instead of with OR IGNORE, because the conflict clause of an upsert on files would replace the one of the trigger.
+DROP TRIGGER IF EXISTS file_summary_insert;
+DROP TRIGGER IF EXISTS file_summary_delete;
+DROP TRIGGER IF EXISTS file_summary_update;
+
+CREATE TRIGGER file_summary_insert AFTER INSERT ON files BEGIN
+    INSERT INTO file_summary (root, file_type) SELECT COALESCE((SELECT root FROM summary_roots WHERE NEW.file_path = root OR substr(NEW.file_path, 1, length(prefix)) = prefix ORDER BY length(root) DESC LIMIT 1), ''), COALESCE(NEW.file_type, '')
+    WHERE NOT EXISTS (SELECT 1 FROM file_summary WHERE root = COALESCE((SELECT root FROM summary_roots WHERE NEW.file_path = root OR substr(NEW.file_path, 1, length(prefix)) = prefix ORDER BY length(root) DESC LIMIT 1), '') AND file_type = COALESCE(NEW.file_type, ''));
+    UPDATE file_summary SET files = files + 1, bytes = bytes + COALESCE(NEW.file_size, 0),
+        missing = missing + (NEW.missing_date IS NOT NULL), mismatched = mismatched + (NEW.mismatch_date IS NOT NULL)
+    WHERE root = COALESCE((SELECT root FROM summary_roots WHERE NEW.file_path = root OR substr(NEW.file_path, 1, length(prefix)) = prefix ORDER BY length(root) DESC LIMIT 1), '')
+        AND file_type = COALESCE(NEW.file_type, '');
+END;
+
+CREATE TRIGGER file_summary_delete AFTER DELETE ON files BEGIN
+    UPDATE file_summary SET files = files - 1, bytes = bytes - COALESCE(OLD.file_size, 0),
+        missing = missing - (OLD.missing_date IS NOT NULL), mismatched = mismatched - (OLD.mismatch_date IS NOT NULL)
+    WHERE root = COALESCE((SELECT root FROM summary_roots WHERE OLD.file_path = root OR substr(OLD.file_path, 1, length(prefix)) = prefix ORDER BY length(root) DESC LIMIT 1), '')
+        AND file_type = COALESCE(OLD.file_type, '');
+END;
+
+CREATE TRIGGER file_summary_update AFTER UPDATE OF file_path, missing_date, mismatch_date, file_type, file_size ON files BEGIN
+    UPDATE file_summary SET files = files - 1, bytes = bytes - COALESCE(OLD.file_size, 0),
+        missing = missing - (OLD.missing_date IS NOT NULL), mismatched = mismatched - (OLD.mismatch_date IS NOT NULL)
+    WHERE root = COALESCE((SELECT root FROM summary_roots WHERE OLD.file_path = root OR substr(OLD.file_path, 1, length(prefix)) = prefix ORDER BY length(root) DESC LIMIT 1), '')
+        AND file_type = COALESCE(OLD.file_type, '');
+    INSERT INTO file_summary (root, file_type) SELECT COALESCE((SELECT root FROM summary_roots WHERE NEW.file_path = root OR substr(NEW.file_path, 1, length(prefix)) = prefix ORDER BY length(root) DESC LIMIT 1), ''), COALESCE(NEW.file_type, '')
+    WHERE NOT EXISTS (SELECT 1 FROM file_summary WHERE root = COALESCE((SELECT root FROM summary_roots WHERE NEW.file_path = root OR substr(NEW.file_path, 1, length(prefix)) = prefix ORDER BY length(root) DESC LIMIT 1), '') AND file_type = COALESCE(NEW.file_type, ''));
+    UPDATE file_summary SET files = files + 1, bytes = bytes + COALESCE(NEW.file_size, 0),
+        missing = missing + (NEW.missing_date IS NOT NULL), mismatched = mismatched + (NEW.mismatch_date IS NOT NULL)
+    WHERE root = COALESCE((SELECT root FROM summary_roots WHERE NEW.file_path = root OR substr(NEW.file_path, 1, length(prefix)) = prefix ORDER BY length(root) DESC LIMIT 1), '')
+        AND file_type = COALESCE(NEW.file_type, '');
+END;
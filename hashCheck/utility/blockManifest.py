@@ -0,0 +1,77 @@
+import hashlib
+
+# Block hashes are stored as the raw sha256 digests joined in one blob
+DIGEST_SIZE = hashlib.sha256().digest_size
+
+# Bytes read at once, a block is hashed from several reads
+READ_SIZE = 1024 * 1024
+
+
+def get_file_hashes(file_path, block_size):
+    """
+    Hashes a file and every block_size block of it from the same reads. Returns (sha256 hex digest of the file,
+    sha256 digests of the blocks joined in one bytes object, file size); the file hash is the one get_file_hash returns.
+    """
+    file_hash = hashlib.sha256()
+    block_hash = hashlib.sha256()
+    block_hashes = []
+    block_filled = 0
+    file_size = 0
+    with open(file_path, 'rb') as file:
+        while True:
+            # Reads never cross a block boundary
+            chunk = file.read(min(READ_SIZE, block_size - block_filled))
+            if not chunk:
+                break
+            file_hash.update(chunk)
+            block_hash.update(chunk)
+            block_filled += len(chunk)
+            file_size += len(chunk)
+            if block_filled == block_size:
+                block_hashes.append(block_hash.digest())
+                block_hash = hashlib.sha256()
+                block_filled = 0
+    if block_filled:
+        block_hashes.append(block_hash.digest())
+    return file_hash.hexdigest(), b''.join(block_hashes), file_size
+
+
+def get_block_hash(file_path, index, block_size):
+    """
+    Returns the sha256 digest of one block of a file, reading only that block
+    """
+    block_hash = hashlib.sha256()
+    remaining = block_size
+    with open(file_path, 'rb') as file:
+        file.seek(index * block_size)
+        while remaining:
+            chunk = file.read(min(READ_SIZE, remaining))
+            if not chunk:
+                break
+            block_hash.update(chunk)
+            remaining -= len(chunk)
+    return block_hash.digest()
+
+
+def get_block_count(block_hashes):
+    return len(block_hashes) // DIGEST_SIZE
+
+
+def get_changed_ranges(block_size, expected_hashes, expected_size, actual_hashes, actual_size):
+    """
+    Returns the byte ranges [start, end) of the blocks whose hashes differ, adjacent blocks joined into one range.
+    A file that grew or shrank differs from the end of the shorter version on.
+    """
+    ranges = []
+    end_of_file = max(expected_size, actual_size)
+    for index in range(max(get_block_count(expected_hashes), get_block_count(actual_hashes))):
+        position = slice(index * DIGEST_SIZE, (index + 1) * DIGEST_SIZE)
+        if expected_hashes[position] == actual_hashes[position]:
+            continue
+        start = index * block_size
+        end = min(start + block_size, end_of_file)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    return ranges
@@ -0,0 +1,290 @@
+import os
+import json
+import time
+import heapq
+import socket
+import sqlite3
+import threading
+from utility.dateTime import get_current_datetime_string as currentDateTime
+from utility.fileWalker import walk, scan_directory
+
+LEASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shards (
+    shard_id TEXT PRIMARY KEY,
+    manifest_file TEXT,
+    partial_db TEXT,
+    bytes INTEGER,
+    files INTEGER,
+    state TEXT,
+    attempts INTEGER DEFAULT 0,
+    host TEXT,
+    pid INTEGER,
+    lease_expires REAL,
+    error TEXT,
+    updated_date TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS shards_state ON shards (state);
+"""
+
+# Name of the lease db in the shard folder
+LEASE_DB = 'shards.db'
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+MERGED = 'merged'
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        # The pid exists but belongs to someone else
+        return True
+    return True
+
+
+def measure_tree(roots, matcher=None, follow_symlinks=True):
+    """
+    Walks the roots like the hash scan does and returns {folder : [bytes, files, sub folders]} of the files directly in
+    every folder. Only the size of the files is read, nothing is hashed.
+    """
+    tree = {}
+    for root in roots:
+        root = os.path.normpath(root)
+        if root in tree:
+            continue
+        for dirpath, dir_entries, file_entries in walk(root, matcher, follow_symlinks):
+            size = 0
+            for entry in file_entries:
+                try:
+                    size += entry.stat().st_size
+                except OSError:
+                    pass
+            tree[dirpath] = [size, len(file_entries), []]
+            # Folders reached twice through a symlink are only yielded once, so every folder has one parent
+            if dirpath != root and os.path.dirname(dirpath) in tree:
+                tree[os.path.dirname(dirpath)][2].append(dirpath)
+    return tree
+
+
+def _get_subtree_sizes(tree):
+    # Children are always longer paths than their parent, so going from the longest path sums every subtree bottom up
+    sizes = {}
+    for path in sorted(tree, key=len, reverse=True):
+        size, files, children = tree[path]
+        sizes[path] = [size + sum(sizes[child][0] for child in children), files + sum(sizes[child][1] for child in children)]
+    return sizes
+
+
+def plan_shards(roots, shard_count, matcher=None, follow_symlinks=True):
+    """
+    Splits the roots into at most shard_count shards of about the same number of bytes. Subtrees larger than an
+    even share are split into their sub folders and the files directly in them, then the pieces (units) are handed
+    to the smallest shard, largest first. Returns a list of {'units' : [{'path', 'recursive'}], 'bytes', 'files'}.
+    """
+    tree = measure_tree(roots, matcher, follow_symlinks)
+    sizes = _get_subtree_sizes(tree)
+    roots = [root for root in dict.fromkeys(os.path.normpath(root) for root in roots) if root in tree]
+    total = sum(sizes[root][0] for root in roots)
+    target = total / max(1, shard_count)
+
+    units = []
+    stack = [root for root in roots]
+    while stack:
+        path = stack.pop()
+        size, files = sizes[path]
+        children = tree[path][2]
+        if size > target and children:
+            # The folder's own files stay together, its sub folders are split further
+            if tree[path][1]:
+                units.append({"path" : path, "recursive" : False, "bytes" : tree[path][0], "files" : tree[path][1]})
+            stack.extend(children)
+        else:
+            units.append({"path" : path, "recursive" : True, "bytes" : size, "files" : files})
+
+    # Largest unit first into the shard with the fewest bytes so far
+    shards = [{"units" : [], "bytes" : 0, "files" : 0} for index in range(max(1, shard_count))]
+    heap = [(0, index) for index in range(len(shards))]
+    for unit in sorted(units, key=lambda unit: (-unit['bytes'], unit['path'])):
+        size, index = heapq.heappop(heap)
+        shard = shards[index]
+        shard['units'].append({"path" : unit['path'], "recursive" : unit['recursive']})
+        shard['bytes'] += unit['bytes']
+        shard['files'] += unit['files']
+        heapq.heappush(heap, (shard['bytes'], index))
+    return [shard for shard in shards if shard['units']]
+
+
+def iterate_unit(unit, matcher=None, threads=1):
+    """
+    Yields (folder, file entries) of every folder a shard unit covers: the whole subtree of a recursive unit,
+    only the folder itself otherwise
+    """
+    if unit.get('recursive', True):
+        for dirpath, dir_entries, file_entries in walk(unit['path'], matcher, True, threads=threads):
+            yield dirpath, file_entries
+    else:
+        dir_entries, file_entries = scan_directory(unit['path'], matcher, True)
+        yield unit['path'], file_entries
+
+
+def write_manifest(manifest, manifest_path):
+    # Written to a temporary file first so a worker never reads half a manifest
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(manifest, file, indent=4)
+    os.replace(temp_path, manifest_path)
+
+
+def read_manifest(manifest_path):
+    with open(manifest_path, 'r') as file:
+        return json.load(file)
+
+
+class ShardLeases:
+    """
+    SQLite table of the shards of a distributed scan and who is working on them. A worker claims a pending shard
+    for lease_seconds and renews the lease while it hashes, a shard whose lease ran out (or whose worker on this
+    host is gone) is claimed again by the next worker. The db lives in the shard folder that every host mounts,
+    so the filesystem has to support SQLite locking and the hosts' clocks have to agree to well within a lease.
+    """
+
+    def __init__(self, shard_folder, lease_seconds=300, max_attempts=3):
+        self.shard_folder = shard_folder
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        # Autocommit, claims take the write lock themselves with BEGIN IMMEDIATE
+        self.conn = sqlite3.connect(os.path.join(shard_folder, LEASE_DB), timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.executescript(LEASE_SCHEMA)
+
+    def add_shards(self, shards):
+        """
+        Replaces the shards of the previous plan with the given {'shard_id', 'manifest_file', 'partial_db', 'bytes', 'files'}
+        """
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute("DELETE FROM shards")
+            self.conn.executemany("""INSERT INTO shards (shard_id, manifest_file, partial_db, bytes, files, state, updated_date)
+                                     VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                                  [(shard['shard_id'], shard['manifest_file'], shard['partial_db'], shard['bytes'], shard['files'],
+                                    PENDING, currentDateTime()) for shard in shards])
+            self.conn.execute("COMMIT")
+
+    def claim(self):
+        """
+        Leases the largest shard that is pending or whose lease ran out to this process, None when there is none left
+        """
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.conn.execute("""SELECT shard_id, host, pid, lease_expires, state FROM shards WHERE state IN (?, ?)
+                                            ORDER BY bytes DESC""", (PENDING, CLAIMED)).fetchall()
+                now = time.time()
+                for shard_id, host, pid, lease_expires, state in rows:
+                    if state == CLAIMED and (lease_expires or 0) > now and not (host == self.host and pid and not _is_process_alive(pid)):
+                        continue
+                    self.conn.execute("""UPDATE shards SET state=?, host=?, pid=?, lease_expires=?, attempts=attempts+1, error=NULL,
+                                         updated_date=? WHERE shard_id=?""",
+                                      (CLAIMED, self.host, self.pid, now + self.lease_seconds, currentDateTime(), shard_id))
+                    self.conn.execute("COMMIT")
+                    return self._get_shard(shard_id)
+                self.conn.execute("COMMIT")
+                return None
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def renew(self, shard_id):
+        """
+        Extends the lease of a shard this process holds, False when the lease was lost to another worker
+        """
+        with self.lock:
+            cursor = self.conn.execute("UPDATE shards SET lease_expires=? WHERE shard_id=? AND state=? AND host=? AND pid=?",
+                                       (time.time() + self.lease_seconds, shard_id, CLAIMED, self.host, self.pid))
+            return cursor.rowcount == 1
+
+    def mark_done(self, shard_id):
+        """
+        Marks a shard this process holds as hashed, False when the lease was lost and another worker owns it now
+        """
+        with self.lock:
+            cursor = self.conn.execute("UPDATE shards SET state=?, lease_expires=NULL, updated_date=? WHERE shard_id=? AND state=? AND host=? AND pid=?",
+                                       (DONE, currentDateTime(), shard_id, CLAIMED, self.host, self.pid))
+            return cursor.rowcount == 1
+
+    def mark_failed(self, shard_id, error=None):
+        # Failed shards are handed out again until they failed max_attempts times
+        with self.lock:
+            self.conn.execute("""UPDATE shards SET state=CASE WHEN attempts >= ? THEN ? ELSE ? END, lease_expires=NULL, error=?, updated_date=?
+                                 WHERE shard_id=? AND state=? AND host=? AND pid=?""",
+                              (self.max_attempts, FAILED, PENDING, error, currentDateTime(), shard_id, CLAIMED, self.host, self.pid))
+
+    def mark_merged(self, shard_id):
+        with self.lock:
+            self.conn.execute("UPDATE shards SET state=?, updated_date=? WHERE shard_id=?", (MERGED, currentDateTime(), shard_id))
+
+    def get_shards(self, state=None):
+        """
+        Returns the shards as dicts, only the ones in the given state when one is given
+        """
+        with self.lock:
+            query = "SELECT shard_id FROM shards" + (" WHERE state=?" if state else "") + " ORDER BY shard_id"
+            shard_ids = [shard_id for (shard_id,) in self.conn.execute(query, (state,) if state else ()).fetchall()]
+            return [self._get_shard(shard_id) for shard_id in shard_ids]
+
+    def _get_shard(self, shard_id):
+        cursor = self.conn.execute("SELECT * FROM shards WHERE shard_id=?", (shard_id,))
+        columns = [column[0] for column in cursor.description]
+        row = cursor.fetchone()
+        return dict(zip(columns, row)) if row else None
+
+    def get_counts(self):
+        """
+        Returns the number of shards in each state
+        """
+        with self.lock:
+            return dict(self.conn.execute("SELECT state, COUNT(*) FROM shards GROUP BY state").fetchall())
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class LeaseKeeper:
+    """
+    Renews the lease of a shard from a background thread while it is hashed. lost is set when the lease could
+    not be renewed, the worker then stops and leaves the shard to whoever claimed it.
+    """
+
+    def __init__(self, leases, shard_id):
+        self.leases = leases
+        self.shard_id = shard_id
+        self.lost = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        # Renewed three times per lease, so one slow renewal doesn't lose it
+        while not self.stopped.wait(max(1, self.leases.lease_seconds / 3)):
+            try:
+                renewed = self.leases.renew(self.shard_id)
+            except sqlite3.Error:
+                continue
+            if not renewed:
+                self.lost.set()
+                return
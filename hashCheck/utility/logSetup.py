@@ -0,0 +1,87 @@
+import time
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+# extra= of the info lines that are written for every file, they can be sampled with perFileLogEvery and perFileLogIntervalSeconds
+PER_FILE = {"per_file" : True}
+
+_listeners_lock = threading.Lock()
+# Logger name -> (queue handler, listener) of every configured logger
+_listeners = {}
+
+
+class PerFileSampler(logging.Filter):
+    """
+    Lets through one in every `every` per-file info records, and at most one every `interval` seconds.
+    Other records always pass. A record that passes after skipped ones tells how many were skipped.
+    """
+
+    def __init__(self, every=1, interval=0):
+        super().__init__()
+        self.every = max(1, every or 1)
+        self.interval = interval or 0
+        self.lock = threading.Lock()
+        self.count = 0
+        self.skipped = 0
+        self.last_passed = 0.0
+
+    def filter(self, record):
+        if record.levelno != logging.INFO or not getattr(record, 'per_file', False):
+            return True
+        with self.lock:
+            self.count += 1
+            now = time.monotonic()
+            if self.count % self.every or (self.interval and now - self.last_passed < self.interval):
+                self.skipped += 1
+                return False
+            self.last_passed = now
+            skipped, self.skipped = self.skipped, 0
+        if skipped and record.args and isinstance(record.args, tuple):
+            record.msg = '{0} (%d similar lines skipped)'.format(record.msg)
+            record.args = record.args + (skipped,)
+        return True
+
+
+class _ThreadQueueHandler(QueueHandler):
+    # The listener runs in the same process, so the record is queued as it is and the message is only
+    # formatted by the listener thread, never by the thread that logged it
+    def prepare(self, record):
+        return record
+
+
+def configure_logger(logger, level, handlers, sample_every=1, sample_interval=0):
+    """
+    Sends the records of the logger through a queue to the handlers, which a listener thread writes, so
+    threads that log never wait on the disk. Configuring a logger again replaces its handlers.
+    """
+    logger.setLevel(level)
+    handler = _ThreadQueueHandler(queue.SimpleQueue())
+    handler.addFilter(PerFileSampler(sample_every, sample_interval))
+    listener = QueueListener(handler.queue, *handlers, respect_handler_level=True)
+
+    with _listeners_lock:
+        previous = _listeners.pop(logger.name, None)
+        if previous:
+            _stop(logger, *previous)
+        logger.addHandler(handler)
+        listener.start()
+        _listeners[logger.name] = (handler, listener)
+
+
+def _stop(logger, handler, listener):
+    # Writes out what is still queued and closes the files
+    logger.removeHandler(handler)
+    listener.stop()
+    for target in listener.handlers:
+        target.close()
+
+
+@atexit.register
+def stop_all():
+    with _listeners_lock:
+        for name, (handler, listener) in list(_listeners.items()):
+            _stop(logging.getLogger(name), handler, listener)
+        _listeners.clear()
@@ -1,19 +1,673 @@
 import sys
-from photoConverter.PhotoConverter import PhotoConverter
 import os
+import json
+import time
+import queue
+import logging
+import argparse
+import cProfile
+import threading
+import multiprocessing
+import contextlib
 
 
+class PipelineStage:
+    """
+    One stage of the media pipeline (photo convert, video convert or hash) with its own
+    bounded work queue and worker threads, so each stage runs at its own concurrency.
+    """
 
-# path = os.path.realpath('config.json')
-    
-imgConverter = PhotoConverter()
-imgConverter.convert()
-# imgConverter.remove_all_converted_files()
-imgConverter.move_missing_files_from_converted_to_actual_directory()
-# videoConverter = VideoConverter(path)
-# videoConverter.convert()
-# hashCheck = HashCheck(path)
-# hashCheck.scan_and_hash_files()
-# flagged_files = hashCheck.get_flagged_files()
-# hashCheck.reinitialize_specific(list(flagged_files.keys()))
+    def __init__(self, name, roots, matcher, accepts_file, handler, worker_count=1, per_directory=False, follow_symlinks=False, queue_size=1000):
+        self.name = name
+        self.roots = [os.path.normpath(root) for root in roots if root]
+        self.matcher = matcher
+        self.accepts_file = accepts_file
+        self.handler = handler
+        self.worker_count = max(1, worker_count)
+        # Per directory stages are handed (dirpath, [DirEntry]), the others (dirpath, file name)
+        self.per_directory = per_directory
+        # Only stages that follow symlinked folders are routed into them, the same as their own walks
+        self.follow_symlinks = follow_symlinks
+        self.work_queue = queue.Queue(maxsize=queue_size)
+        self.threads = []
 
+        # Throughput counters
+        self.stats_lock = threading.Lock()
+        self.items = 0
+        self.files = 0
+        self.bytes = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.start_time = None
+        self.end_time = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        for i in range(self.worker_count):
+            t = threading.Thread(target=self._worker, name=f'{self.name}-{i}')
+            t.start()
+            self.threads.append(t)
+
+    def put(self, item):
+        # Blocks while the stage is behind, which keeps the walk from running ahead of the slowest stage
+        self.work_queue.put(item)
+
+    def stop(self):
+        # One sentinel per worker, queued behind the remaining work
+        for i in range(self.worker_count):
+            self.work_queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.end_time = time.perf_counter()
+
+    def _worker(self):
+        logger = logging.getLogger(__name__)
+        while True:
+            item = self.work_queue.get()
+            if item is None:
+                self.work_queue.task_done()
+                break
+
+            dirpath, entries = item
+            if not self.per_directory:
+                entries = [entries]
+
+            started = time.perf_counter()
+            size = 0
+            failed = False
+            try:
+                for entry in entries:
+                    try:
+                        # The stat is cached on the DirEntry, a handler that reads the size again shares it
+                        size += entry.stat().st_size
+                    except OSError:
+                        pass
+                self.handler(dirpath, item[1] if self.per_directory else item[1].name)
+            except Exception as e:
+                failed = True
+                logger.error('%s stage failed on %s: %s', self.name, dirpath, e)
+            elapsed = time.perf_counter() - started
+
+            with self.stats_lock:
+                self.items += 1
+                self.files += len(entries)
+                self.bytes += size
+                self.busy_seconds += elapsed
+                if failed:
+                    self.errors += 1
+
+            self.work_queue.task_done()
+
+    def summary(self):
+        end_time = self.end_time or time.perf_counter()
+        wall_seconds = max(end_time - (self.start_time or end_time), 1e-9)
+        return {
+            "stage" : self.name,
+            "workers" : self.worker_count,
+            "files" : self.files,
+            "bytes" : self.bytes,
+            "errors" : self.errors,
+            "wall_seconds" : round(wall_seconds, 3),
+            "busy_seconds" : round(self.busy_seconds, 3),
+            "files_per_second" : round(self.files / wall_seconds, 2),
+            "mb_per_second" : round(self.bytes / wall_seconds / (1024 * 1024), 2),
+            "utilization" : round(self.busy_seconds / (wall_seconds * self.worker_count), 3),
+        }
+
+
+class MediaPipeline:
+    """
+    Walks every root once and routes each file to the photo convert, video convert and hash
+    stages, instead of each of them walking the same roots separately.
+
+    A stage is enabled by passing its config path. concurrency maps a stage name
+    ('photo', 'video', 'hash') to its number of workers.
+    """
+
+    def __init__(self, photo_config_path=None, video_config_path=None, hash_config_path=None, concurrency=None, config_overrides=None):
+        self.logger = logging.getLogger(__name__)
+        concurrency = concurrency or {}
+        # Maps a stage name to the config settings that win over its config file
+        config_overrides = config_overrides or {}
+        self.stages = []
+        # Converters whose manifests are saved when the run ends
+        self.converters = []
+
+        # Subsystems are imported on demand so a run only pays for the stages it uses
+        if photo_config_path:
+            from photoConverter.PhotoConverter import PhotoConverter
+            photo = PhotoConverter(photo_config_path, config_overrides=config_overrides.get('photo'))
+            self.converters.append(photo)
+            self.stages.append(PipelineStage('photo', photo.root_directories, photo.exclusion_matcher,
+                                             photo.accepts_file, photo.convert_file,
+                                             worker_count=concurrency.get('photo', 1)))
+        if video_config_path:
+            from videoConverter.VideoConverter import VideoConverter
+            video = VideoConverter(video_config_path, config_overrides=config_overrides.get('video'))
+            self.converters.append(video)
+            self.stages.append(PipelineStage('video', video.root_directories, video.exclusion_matcher,
+                                             video.accepts_file, video.convert_file,
+                                             worker_count=concurrency.get('video', 1)))
+        if hash_config_path:
+            from hashCheck.HashCheck import HashCheck
+            hash_check = HashCheck(hash_config_path, config_overrides=config_overrides.get('hash'))
+            for db_path in hash_check.get_db_paths():
+                hash_check.create_db(db_path)
+            self.stages.append(PipelineStage('hash', hash_check.root_directories, hash_check.exclusion_matcher,
+                                             lambda dirpath, file: not hash_check.exclusion_matcher.is_file_excluded(file, os.path.join(dirpath, file)),
+                                             lambda dirpath, entries: hash_check.hash_files(dirpath, [entry.name for entry in entries], file_entries=entries),
+                                             worker_count=concurrency.get('hash', hash_check.thread_count),
+                                             per_directory=True, follow_symlinks=True))
+
+        # Stages that start at each root, roots nested in another root are reached by the outer walk
+        self.root_stages = {}
+        for stage in self.stages:
+            for root in stage.roots:
+                self.root_stages.setdefault(root, []).append(stage)
+
+    def _get_walk_roots(self):
+        walk_roots = []
+        for root in sorted(self.root_stages):
+            if any(root.startswith(walk_root.rstrip(os.sep) + os.sep) for walk_root in walk_roots):
+                continue
+            walk_roots.append(root)
+        return walk_roots
+
+    def _has_nested_root(self, path):
+        prefix = path.rstrip(os.sep) + os.sep
+        return any(root.startswith(prefix) for root in self.root_stages)
+
+    def run(self):
+        """
+        Runs every enabled stage over a single walk of the roots and returns the per stage throughput summary
+        """
+        if not self.stages:
+            self.logger.error('No pipeline stages enabled')
+            return []
+
+        for stage in self.stages:
+            stage.start()
+
+        try:
+            for root in self._get_walk_roots():
+                if not os.path.exists(root):
+                    self.logger.warning('Root directory not found: %s', root)
+                    continue
+                self._walk(root)
+        finally:
+            for stage in self.stages:
+                stage.stop()
+            # The manifests only commit every few hundred records on their own
+            for converter in self.converters:
+                if converter.manifest:
+                    converter.manifest.commit()
+
+        summary = [stage.summary() for stage in self.stages]
+        for stage_summary in summary:
+            self.logger.info('%(stage)s: %(files)d files, %(mb_per_second).2f MB/s, %(files_per_second).2f files/s, '
+                             '%(errors)d errors, %(workers)d workers at %(utilization).0f%% busy over %(wall_seconds).1f s',
+                             dict(stage_summary, utilization=stage_summary['utilization'] * 100))
+        return summary
+
+    def _walk(self, root):
+        # The shared scandir walker of the subsystems, importable once a stage imported its subsystem
+        from utility.fileWalker import walk as walkTree
+        # Stages that are active in each directory that is still waiting to be visited
+        active_stages = {root: list(self.root_stages.get(root, []))}
+
+        # Every folder is visited once even through symlinks, the stages that don't follow them are dropped below
+        follow_symlinks = any(stage.follow_symlinks for stage in self.stages)
+        for dirpath, dir_entries, file_entries in walkTree(root, follow_symlinks=follow_symlinks):
+            stages = active_stages.pop(dirpath, [])
+            self._route_files(dirpath, file_entries, stages)
+
+            # A folder is only pruned when every stage excludes it and no other root lives underneath it
+            kept = []
+            for entry in dir_entries:
+                child_stages = [stage for stage in stages if not stage.matcher.is_dir_excluded(entry.name, entry.path)
+                                and (stage.follow_symlinks or not entry.is_symlink())]
+                for stage in self.root_stages.get(entry.path, []):
+                    if stage not in child_stages:
+                        child_stages.append(stage)
+                if child_stages or self._has_nested_root(entry.path):
+                    active_stages[entry.path] = child_stages
+                    kept.append(entry)
+            dir_entries[:] = kept
+
+    def _route_files(self, dirpath, file_entries, stages):
+        for stage in stages:
+            if stage.per_directory:
+                accepted = [entry for entry in file_entries if stage.accepts_file(dirpath, entry.name)]
+                if accepted:
+                    stage.put((dirpath, accepted))
+            else:
+                for entry in file_entries:
+                    if stage.accepts_file(dirpath, entry.name):
+                        stage.put((dirpath, entry))
+
+
+class PhaseTimer:
+    """
+    Wall clock time of the named phases of a command line run, written next to the cProfile stats by --profile
+    """
+
+    def __init__(self):
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append({"phase" : name, "seconds" : round(time.perf_counter() - started, 3)})
+
+
+def _get_config_overrides(args, kind):
+    # --jobs sets the workers that use the cpu, --io-limit the threads that read or move files
+    overrides = {}
+    if args.jobs:
+        overrides[{'photo' : 'processing_processes', 'video' : 'ffmpeg_processes', 'hash' : 'processing_threads'}[kind]] = args.jobs
+    if args.io_limit:
+        overrides['metadata_threads'] = args.io_limit
+        if kind in ('photo', 'video'):
+            overrides['walk_threads'] = args.io_limit
+        if kind == 'photo':
+            overrides['reconcile_threads'] = args.io_limit
+        elif kind == 'hash':
+            # Hashing is bound by the disks, so the limit caps its workers too
+            overrides['processing_threads'] = min(args.io_limit, overrides.get('processing_threads', args.io_limit))
+    return overrides
+
+
+def _get_subsystem_kwargs(args, kind):
+    config_kwargs = {"config_overrides" : _get_config_overrides(args, kind)}
+    if args.config:
+        config_kwargs['config_path'] = args.config
+    return config_kwargs
+
+
+def _open_subsystem(args, kind, timer):
+    # Subsystems are imported on demand so a command only pays for the one it uses
+    config_kwargs = _get_subsystem_kwargs(args, kind)
+    with timer.phase('setup'):
+        if kind == 'photo':
+            from photoConverter.PhotoConverter import PhotoConverter
+            return PhotoConverter(**config_kwargs)
+        if kind == 'video':
+            from videoConverter.VideoConverter import VideoConverter
+            return VideoConverter(**config_kwargs)
+        from hashCheck.HashCheck import HashCheck
+        return HashCheck(**config_kwargs)
+
+
+def _print_json(data, output_file=None):
+    if output_file:
+        with open(output_file, 'w') as file:
+            json.dump(data, file, indent=4)
+    else:
+        print(json.dumps(data, indent=4))
+
+
+def _print_plan(plan, noun):
+    print('{0} {1}, {2:.1f} MB in {3} folders, about {4:.0f}s{5}'.format(plan['total_jobs'], noun, plan['total_bytes'] / (1024 * 1024),
+                                                                   len(plan['directories']), plan['estimated_seconds'],
+                                                                   '' if plan['calibrated'] else ' (no timed runs yet, default rate)'))
+
+
+def hash_scan(args, timer):
+    hash_check = _open_subsystem(args, 'hash', timer)
+    roots = hash_check.root_directories or args.roots
+    if args.dry_run:
+        # Walks the roots the way the scan does, with its exclusions and symlink handling, and only counts what would be hashed
+        from utility.fileWalker import walk as walkTree
+        files = 0
+        size = 0
+        with timer.phase('walk'):
+            for root in roots:
+                for dirpath, dir_entries, file_entries in walkTree(root, hash_check.exclusion_matcher, follow_symlinks=True, threads=hash_check.thread_count):
+                    for entry in file_entries:
+                        try:
+                            size += entry.stat().st_size
+                            files += 1
+                        except OSError:
+                            pass
+        print('{0} files, {1:.1f} MB would be hashed'.format(files, size / (1024 * 1024)))
+        return
+    with timer.phase('scan'):
+        hash_check.scan_and_hash_files(args.roots)
+
+
+def hash_report(args, timer):
+    hash_check = _open_subsystem(args, 'hash', timer)
+    with timer.phase('report'):
+        if args.flagged:
+            report = hash_check.get_flagged_files(None if args.flagged == 'any' else args.flagged)
+        elif args.type:
+            report = hash_check.get_files_by_type(args.type)
+        elif args.initial_date:
+            report = hash_check.get_files_by_initial_date(args.initial_date)
+        else:
+            report = hash_check.get_all_files()
+    _print_json(report, args.output)
+
+
+def hash_summary(args, timer):
+    hash_check = _open_subsystem(args, 'hash', timer)
+    with timer.phase('summary'):
+        summary = hash_check.get_summary()
+    _print_json(summary, args.output)
+
+
+def hash_verify_blocks(args, timer):
+    hash_check = _open_subsystem(args, 'hash', timer)
+    with timer.phase('verify blocks'):
+        report = hash_check.verify_blocks(args.paths, args.sample, args.seed)
+    _print_json(report, args.output)
+
+
+def hash_block_mismatches(args, timer):
+    hash_check = _open_subsystem(args, 'hash', timer)
+    with timer.phase('report'):
+        report = hash_check.get_block_mismatches()
+    _print_json(report, args.output)
+
+
+def hash_plan_shards(args, timer):
+    hash_check = _open_subsystem(args, 'hash', timer)
+    with timer.phase('plan'):
+        shards = hash_check.plan_shards(args.shard_folder, args.shards, args.replace)
+    if shards is None:
+        return 1
+    for shard in shards:
+        print('{0}: {1} files, {2:.1f} MB in {3} folders'.format(shard['shard_id'], shard['files'], shard['bytes'] / (1024 * 1024), len(shard['units'])))
+
+
+def _run_shard_worker(config_kwargs, shard_folder):
+    # Entry point of the worker processes started by hash worker --workers
+    from hashCheck.HashCheck import HashCheck
+    from utility.logSetup import stop_all
+    try:
+        HashCheck(**config_kwargs).scan_shards(shard_folder)
+    finally:
+        # Child processes skip the atexit hooks, the queued log lines are written out here
+        stop_all()
+
+
+def hash_worker(args, timer):
+    if args.workers > 1:
+        # Separate processes, the same as workers started on other hosts
+        config_kwargs = _get_subsystem_kwargs(args, 'hash')
+        with timer.phase('workers'):
+            processes = [multiprocessing.Process(target=_run_shard_worker, args=(config_kwargs, args.shard_folder)) for index in range(args.workers)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+        return 1 if any(process.exitcode for process in processes) else 0
+    hash_check = _open_subsystem(args, 'hash', timer)
+    with timer.phase('hash shards'):
+        hash_check.scan_shards(args.shard_folder)
+
+
+def hash_merge(args, timer):
+    hash_check = _open_subsystem(args, 'hash', timer)
+    with timer.phase('merge'):
+        merged = hash_check.merge_shards(args.shard_folder)
+    print('Merged {0} files of {1} shards'.format(merged['files'], merged['shards']))
+
+
+def hash_scale_test(args, timer):
+    from hashCheck.ScaleHarness import ScaleHarness, load_thresholds, check_thresholds
+    config_kwargs = _get_subsystem_kwargs(args, 'hash')
+    with timer.phase('setup'):
+        harness = ScaleHarness(args.work_folder, config_kwargs.get('config_path', 'hashCheck/default_config.json'), config_kwargs['config_overrides'])
+    with timer.phase('scale test'):
+        metrics = harness.run(args.rows, args.fanout, args.depth, args.files_per_folder, args.wide_files, args.report_rows)
+    _print_json(metrics, args.output)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+    failures = check_thresholds(metrics, load_thresholds(args.thresholds), baseline, args.tolerance)
+    for failure in failures:
+        print('FAILED: ' + failure, file=sys.stderr)
+    return 1 if failures else 0
+
+
+def photo_convert(args, timer):
+    photo = _open_subsystem(args, 'photo', timer)
+    if args.run_plan:
+        with timer.phase('run plan'):
+            photo.run_plan(args.run_plan)
+    elif args.dry_run or args.plan_file:
+        with timer.phase('plan'):
+            plan = photo.plan(args.input_formats, args.output_format, args.plan_file)
+        _print_plan(plan, 'photos')
+        if not args.dry_run:
+            with timer.phase('run plan'):
+                photo.run_plan(plan)
+    else:
+        with timer.phase('convert'):
+            photo.convert(args.input_formats, args.output_format)
+
+
+def video_convert(args, timer):
+    video = _open_subsystem(args, 'video', timer)
+    if args.resume:
+        with timer.phase('resume'):
+            video.resume()
+    elif args.run_plan:
+        with timer.phase('run plan'):
+            video.run_plan(args.run_plan)
+    elif args.dry_run or args.plan_file:
+        with timer.phase('plan'):
+            plan = video.plan(args.output_format, args.plan_file)
+        _print_plan(plan, 'videos')
+        if not args.dry_run:
+            with timer.phase('run plan'):
+                video.run_plan(plan)
+    else:
+        with timer.phase('convert'):
+            video.convert(args.output_format)
+
+
+def video_benchmark(args, timer):
+    video = _open_subsystem(args, 'video', timer)
+    with timer.phase('benchmark'):
+        report = video.benchmark_profiles(args.sample_file, args.output_folder, args.profiles, args.seconds, args.output_format)
+    _print_json(report)
+
+
+def pipeline(args, timer):
+    if args.dry_run:
+        print('The pipeline has no dry run, use the --dry-run of each tool', file=sys.stderr)
+        return 1
+    if not (args.photo_config or args.video_config or args.hash_config):
+        print('Give at least one of --photo-config, --video-config and --hash-config', file=sys.stderr)
+        return 1
+    concurrency = {kind : workers for kind, workers in (('photo', args.photo_workers), ('video', args.video_workers), ('hash', args.hash_workers)) if workers}
+    with timer.phase('setup'):
+        media_pipeline = MediaPipeline(args.photo_config, args.video_config, args.hash_config, concurrency,
+                                       {kind : _get_config_overrides(args, kind) for kind in ('photo', 'video', 'hash')})
+    with timer.phase('pipeline'):
+        summary = media_pipeline.run()
+    _print_json(summary, args.output)
+
+
+def reconcile(args, timer):
+    photo = _open_subsystem(args, 'photo', timer)
+    with timer.phase('reconcile'):
+        plan = photo.reconcile_converted_files(args.roots, not args.keep_depth_files, args.dry_run, args.plan_file)
+    if args.dry_run:
+        for action in plan:
+            print('{0}: {1}{2}'.format(action['action'], action['source'], ' -> ' + action['destination'] if action.get('destination') else ''))
+
+
+def _add_global_options(parser, suppress_defaults=False):
+    # The global options are accepted before and after the subcommand, subcommands only set the ones that were given
+    default = argparse.SUPPRESS if suppress_defaults else None
+    parser.add_argument('--jobs', type=int, default=default,
+                        help='parallel workers: photo processes, ffmpeg processes or hash threads (default: from the config)')
+    parser.add_argument('--io-limit', type=int, default=default,
+                        help='threads that read or move files at once: folder listings, hash workers, reconcile moves and metadata probes')
+    parser.add_argument('--dry-run', action='store_true', default=argparse.SUPPRESS if suppress_defaults else False,
+                        help='only report what would be done: conversion plans, reconcile moves or the files a scan would hash')
+    parser.add_argument('--profile', metavar='FOLDER', default=default,
+                        help='write cProfile stats of the main thread and wall clock phase timings of the run to FOLDER')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='media_management.py', description='Hash check, photo and video conversion of media folders')
+    _add_global_options(parser)
+    commands = parser.add_subparsers(dest='subsystem', required=True)
+
+    hash_parser = commands.add_parser('hash', help='file hash database')
+    hash_commands = hash_parser.add_subparsers(dest='command', required=True)
+    scan_parser = hash_commands.add_parser('scan', help='hash new and changed files and flag missing ones')
+    _add_global_options(scan_parser, suppress_defaults=True)
+    scan_parser.add_argument('--config', default=None, help='hash check config file')
+    scan_parser.add_argument('roots', nargs='*', help='folders to scan when the config has no rootFolderList')
+    scan_parser.set_defaults(handler=hash_scan)
+    report_parser = hash_commands.add_parser('report', help='print the hash database as json')
+    _add_global_options(report_parser, suppress_defaults=True)
+    report_parser.add_argument('--config', default=None, help='hash check config file')
+    report_parser.add_argument('--flagged', choices=['any', 'missing', 'mismatch'], default=None, help='only files flagged missing or mismatched')
+    report_parser.add_argument('--type', default=None, help='only files of this mime type, ex. image/jpeg')
+    report_parser.add_argument('--initial-date', default=None, help='only files first hashed at this date')
+    report_parser.add_argument('--output', default=None, help='write the report to this file instead of stdout')
+    report_parser.set_defaults(handler=hash_report)
+    summary_parser = hash_commands.add_parser('summary', help='print the number of files, bytes, missing and mismatched files by root and type')
+    _add_global_options(summary_parser, suppress_defaults=True)
+    summary_parser.add_argument('--config', default=None, help='hash check config file')
+    summary_parser.add_argument('--output', default=None, help='write the summary to this file instead of stdout')
+    summary_parser.set_defaults(handler=hash_summary)
+    verify_blocks_parser = hash_commands.add_parser('verify-blocks', help='spot check random blocks of the files that have a block manifest')
+    _add_global_options(verify_blocks_parser, suppress_defaults=True)
+    verify_blocks_parser.add_argument('--config', default=None, help='hash check config file')
+    verify_blocks_parser.add_argument('--sample', type=int, default=4, help='blocks to read of every file (default: 4)')
+    verify_blocks_parser.add_argument('--seed', type=int, default=None, help='seed of the block sample, to check the same blocks again')
+    verify_blocks_parser.add_argument('--output', default=None, help='write the result to this file instead of stdout')
+    verify_blocks_parser.add_argument('paths', nargs='*', help='only check the files in these files or folders')
+    verify_blocks_parser.set_defaults(handler=hash_verify_blocks)
+    block_mismatches_parser = hash_commands.add_parser('block-mismatches', help='print the changed byte ranges of the mismatched files that have a block manifest')
+    _add_global_options(block_mismatches_parser, suppress_defaults=True)
+    block_mismatches_parser.add_argument('--config', default=None, help='hash check config file')
+    block_mismatches_parser.add_argument('--output', default=None, help='write the report to this file instead of stdout')
+    block_mismatches_parser.set_defaults(handler=hash_block_mismatches)
+    plan_shards_parser = hash_commands.add_parser('plan-shards', help='split the roots into shards for hash workers on several hosts')
+    _add_global_options(plan_shards_parser, suppress_defaults=True)
+    plan_shards_parser.add_argument('--config', default=None, help='hash check config file')
+    plan_shards_parser.add_argument('--shard-folder', default=None, help='folder for the shard manifests and partial dbs, shared by every host (default: from the config)')
+    plan_shards_parser.add_argument('--shards', type=int, default=None, help='number of shards (default: from the config)')
+    plan_shards_parser.add_argument('--replace', action='store_true', help='plan again even though shards of the previous plan are not merged')
+    plan_shards_parser.set_defaults(handler=hash_plan_shards)
+    worker_parser = hash_commands.add_parser('worker', help='hash shards into partial dbs until every shard is hashed')
+    _add_global_options(worker_parser, suppress_defaults=True)
+    worker_parser.add_argument('--config', default=None, help='hash check config file')
+    worker_parser.add_argument('--shard-folder', default=None, help='folder of the planned shards (default: from the config)')
+    worker_parser.add_argument('--workers', type=int, default=1, help='worker processes to start on this host')
+    worker_parser.set_defaults(handler=hash_worker)
+    merge_parser = hash_commands.add_parser('merge', help='merge the partial dbs of the hashed shards into the hash db')
+    _add_global_options(merge_parser, suppress_defaults=True)
+    merge_parser.add_argument('--config', default=None, help='hash check config file')
+    merge_parser.add_argument('--shard-folder', default=None, help='folder of the planned shards (default: from the config)')
+    merge_parser.set_defaults(handler=hash_merge)
+    scale_parser = hash_commands.add_parser('scale-test', help='measure memory, db size and query times on synthetic rows and folders, fail on regressions')
+    _add_global_options(scale_parser, suppress_defaults=True)
+    scale_parser.add_argument('--config', default=None, help='hash check config file, its db and roots are replaced by synthetic ones')
+    scale_parser.add_argument('--work-folder', default='./scale-test', help='folder for the synthetic db and the log')
+    scale_parser.add_argument('--rows', type=int, default=1000000, help='synthetic rows in the db')
+    scale_parser.add_argument('--fanout', type=int, default=10, help='sub folders per folder of the synthetic tree')
+    scale_parser.add_argument('--depth', type=int, default=3, help='levels of the synthetic tree below its root')
+    scale_parser.add_argument('--files-per-folder', type=int, default=100, help='files in every folder of the synthetic tree')
+    scale_parser.add_argument('--wide-files', type=int, default=100000, help='files in the one wide folder of the synthetic tree')
+    scale_parser.add_argument('--report-rows', type=int, default=1000000, help='rows of the report whose memory is traced')
+    scale_parser.add_argument('--thresholds', default=None, help='json of metric upper limits (default: hashCheck/scale_thresholds.json)')
+    scale_parser.add_argument('--baseline', default=None, help='metrics json of an earlier run, metrics that grew beyond the tolerance fail')
+    scale_parser.add_argument('--tolerance', type=float, default=0.25, help='allowed growth over the baseline (default: 0.25)')
+    scale_parser.add_argument('--output', default=None, help='write the metrics to this file instead of stdout')
+    scale_parser.set_defaults(handler=hash_scale_test)
+
+    photo_parser = commands.add_parser('photo', help='photo conversion')
+    photo_commands = photo_parser.add_subparsers(dest='command', required=True)
+    photo_convert_parser = photo_commands.add_parser('convert', help='convert the photos of the roots')
+    _add_global_options(photo_convert_parser, suppress_defaults=True)
+    photo_convert_parser.add_argument('--config', default=None, help='photo converter config file')
+    photo_convert_parser.add_argument('--input-formats', nargs='+', default=None, help='extensions to convert (default: from the config)')
+    photo_convert_parser.add_argument('--output-format', default=None, help='output extension (default: from the config)')
+    photo_convert_parser.add_argument('--plan-file', default=None, help='save the conversion plan to this file before running it')
+    photo_convert_parser.add_argument('--run-plan', default=None, help='run a saved plan instead of walking the roots')
+    photo_convert_parser.set_defaults(handler=photo_convert)
+
+    video_parser = commands.add_parser('video', help='video conversion')
+    video_commands = video_parser.add_subparsers(dest='command', required=True)
+    video_convert_parser = video_commands.add_parser('convert', help='convert the videos of the roots')
+    _add_global_options(video_convert_parser, suppress_defaults=True)
+    video_convert_parser.add_argument('--config', default=None, help='video converter config file')
+    video_convert_parser.add_argument('--output-format', default=None, help='output extension (default: from the config)')
+    video_convert_parser.add_argument('--plan-file', default=None, help='save the conversion plan to this file before running it')
+    video_convert_parser.add_argument('--run-plan', default=None, help='run a saved plan instead of walking the roots')
+    video_convert_parser.add_argument('--resume', action='store_true', help='run the pending jobs of the job queue without walking the roots')
+    video_convert_parser.set_defaults(handler=video_convert)
+    benchmark_parser = video_commands.add_parser('benchmark', help='encode a sample with each encoder profile and compare speed and size')
+    _add_global_options(benchmark_parser, suppress_defaults=True)
+    benchmark_parser.add_argument('--config', default=None, help='video converter config file')
+    benchmark_parser.add_argument('sample_file', help='video to encode')
+    benchmark_parser.add_argument('output_folder', help='folder for the encoded samples')
+    benchmark_parser.add_argument('--profiles', nargs='+', default=None, help='profiles to compare (default: all)')
+    benchmark_parser.add_argument('--seconds', type=int, default=None, help='only encode the first seconds of the sample')
+    benchmark_parser.add_argument('--output-format', default=None, help='output extension (default: from the config)')
+    benchmark_parser.set_defaults(handler=video_benchmark)
+
+    reconcile_parser = commands.add_parser('reconcile', help='move converted photos whose original is gone back and remove depth files')
+    _add_global_options(reconcile_parser, suppress_defaults=True)
+    reconcile_parser.add_argument('--config', default=None, help='photo converter config file')
+    reconcile_parser.add_argument('--keep-depth-files', action='store_true', help='leave the depth files of converted photos')
+    reconcile_parser.add_argument('--plan-file', default=None, help='with --dry-run, write the planned moves to this file as json')
+    reconcile_parser.add_argument('roots', nargs='*', help='folders to reconcile (default: the config roots)')
+    reconcile_parser.set_defaults(handler=reconcile)
+
+    pipeline_parser = commands.add_parser('pipeline', help='walk the roots once and feed the photo conversion, video conversion and hashing together')
+    _add_global_options(pipeline_parser, suppress_defaults=True)
+    pipeline_parser.add_argument('--photo-config', default=None, help='photo converter config file, enables the photo stage')
+    pipeline_parser.add_argument('--video-config', default=None, help='video converter config file, enables the video stage')
+    pipeline_parser.add_argument('--hash-config', default=None, help='hash check config file, enables the hash stage')
+    pipeline_parser.add_argument('--photo-workers', type=int, default=None, help='photo stage threads (default: 1)')
+    pipeline_parser.add_argument('--video-workers', type=int, default=None, help='video stage threads (default: 1)')
+    pipeline_parser.add_argument('--hash-workers', type=int, default=None, help='hash stage threads (default: processing_threads of the hash config)')
+    pipeline_parser.add_argument('--output', default=None, help='write the per stage throughput to this file instead of stdout')
+    pipeline_parser.set_defaults(handler=pipeline)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    timer = PhaseTimer()
+    profiler = cProfile.Profile() if args.profile else None
+
+    started = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    try:
+        status = args.handler(args, timer)
+    finally:
+        if profiler:
+            profiler.disable()
+            # Worker threads and processes are not profiled, their time shows in the phase timings
+            name = '{0}-{1}-{2}'.format(args.subsystem, getattr(args, 'command', None) or 'run', time.strftime('%Y%m%d-%H%M%S'))
+            os.makedirs(args.profile, exist_ok=True)
+            profiler.dump_stats(os.path.join(args.profile, name + '.pstats'))
+            timings = {"command" : ' '.join(sys.argv[1:] if argv is None else argv), "total_seconds" : round(time.perf_counter() - started, 3),
+                       "phases" : timer.phases}
+            with open(os.path.join(args.profile, name + '.phases.json'), 'w') as file:
+                json.dump(timings, file, indent=4)
+            for phase in timer.phases:
+                print('{phase}: {seconds:.3f}s'.format(**phase), file=sys.stderr)
+            print('Profile written to {0}'.format(os.path.join(args.profile, name + '.pstats')), file=sys.stderr)
+    return status or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
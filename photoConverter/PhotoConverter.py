@@ -2,22 +2,37 @@ import sys
 DIR_NAME='photoConverter/'
 sys.path.append(DIR_NAME)
 import os
+import json
+import errno
 import shutil
 import subprocess
 import platform
 import logging
-import multiprocessing
-from PIL import Image
+import time
+from concurrent.futures import ThreadPoolExecutor
 # import sys
 # sys.path.insert(0, '/Users/prajanchauhan/Documents/Personal/Photos and Media/')
 from utility.util import get_configurations as getConfig 
 from utility.dateTime import get_current_datetime_string as currentDateTime
+from utility.exclusionMatcher import ExclusionMatcher
+from utility.fileWalker import walk as walkTree
+from utility.logSetup import configure_logger as configureLogger, PER_FILE
+from utility.conversionEngine import ConversionEngine, convert_img as convertImg, convert_heic_linux as convertHeicLinux, convert_heic_mac as convertHeicMac, remove_orientation as removeOrientation, benchmark_conversion as benchmarkConversion
+from utility.conversionManifest import ConversionManifest, OUTPUT_EXISTS
+from utility.metadataCache import MetadataCache
+from utility.conversionCache import get_settings_key as getSettingsKey
+from utility.conversionPlan import ThroughputModel, get_history_file as getHistoryFile, build_plan as buildPlan, save_plan as savePlan, load_plan as loadPlan
+
+# Conversion rate assumed by plans until a run has been timed
+DEFAULT_BYTES_PER_SECOND = 5 * 1024 * 1024
 
 class PhotoConverter:
-    def __init__(self, config_path=f"{DIR_NAME}config.json", root_path=None):
+    def __init__(self, config_path=f"{DIR_NAME}config.json", root_path=None, config_overrides=None):
 
         # Load configuration from the given path
         self.config = getConfig(config_path)
+        # Settings given on the command line win over the config file
+        self.config.update(config_overrides or {})
 
         # Get the log file path and name from the config file and setup logger
         self.log_file = os.path.join(self.config.get('logFolderParentFolderPath', None), self.config.get('logFileName', None))
@@ -35,12 +50,14 @@ class PhotoConverter:
         self.logger.debug('Converted Folder Path: {0}'.format(self.converted_folder_path))
         self.converted_folder_name = self.config.get('convertedFolderName', 'conversion')
 
-        # Get the exclusions from the config file
+        # Get the exclusions from the config file, the converted folders are always excluded
         self.exclusions = self.config.get('exclusions',{})
         self.logger.debug('Exclusions: {0}'.format(self.exclusions))
+        self.exclusion_matcher = ExclusionMatcher(self.exclusions, [self.converted_folder_name])
 
         # Get the input formats from the config file
         self.input_ext = self.config.get('queryExtensions',None)
+        self.input_formats = frozenset(f.lower().lstrip('.') for f in self.input_ext or [])
         self.logger.debug('Input Formats: {0}'.format(self.input_ext))
 
         # Get the output format from the config file
@@ -51,6 +68,55 @@ class PhotoConverter:
         self.root_path = root_path
         self.root_dir = None
 
+        # The platform decides how HEIC files are converted, look it up once
+        self.platform = platform.system()
+        self.capability_cache_file = self.config.get('capabilityCacheFile', None)
+
+        # Conversions run on a process pool, with a bounded number of jobs in flight and an optional memory budget
+        self.process_count = self.config.get('processing_processes', 1)
+        memory_budget = (self.config.get('memory_budget_mb', 0) or 0) * 1024 * 1024
+        self.conversion_engine = ConversionEngine(self.logger, self.process_count, self.config.get('max_in_flight_jobs', None), memory_budget)
+        # Folders listed at once by the walk, more than 1 helps on network filesystems
+        self.walk_threads = self.config.get('walk_threads', 1)
+
+        # HEIC is decoded in process with pillow-heif when it is installed ('auto'), 'tool' forces heif-convert or sips
+        self.heic_backend = self.config.get('heicBackend', 'auto')
+        # 'strip' removes all EXIF data from the output, 'keep' keeps it without the orientation
+        self.exif_policy = self.config.get('exifPolicy', 'strip')
+        self.output_quality = self.config.get('outputQuality', None)
+
+        # Optional conversion manifest, skip decisions are made from it instead of probing for every output
+        self.manifest = None
+        manifest_file = self.config.get('manifestFile', None)
+        if manifest_file:
+            manifest_path = os.path.join(self.config.get('manifestFileParentFolderPath', None) or './', manifest_file)
+            self.manifest = ConversionManifest(manifest_path, self._get_conversion_settings())
+            self.logger.debug('Conversion Manifest: {0}'.format(manifest_path))
+
+        # Optional metadata cache shared with the video converter and the hash check, photos are only probed again after they change
+        self.metadata_cache = None
+        metadata_cache_file = self.config.get('metadataCacheFile', None)
+        if metadata_cache_file:
+            metadata_cache_path = os.path.join(self.config.get('metadataCacheFileParentFolderPath', None) or './', metadata_cache_file)
+            self.metadata_cache = MetadataCache(metadata_cache_path, worker_count=self.config.get('metadata_threads', 4))
+            self.logger.debug('Metadata Cache: {0}'.format(metadata_cache_path))
+
+        # Optional content addressed cache of converted outputs, shared by duplicates and moved photos
+        self.cache_folder = self.config.get('conversionCacheFolder', None) or None
+        self.cache_key = getSettingsKey(self._get_conversion_settings())
+
+        # Throughput of recent runs, used to estimate how long a plan will take
+        self.throughput_model = ThroughputModel(getHistoryFile(self.config, 'photo'), DEFAULT_BYTES_PER_SECOND)
+        self.run_bytes = 0
+
+    def _get_conversion_settings(self):
+        # Settings that change the converted output, a change means every photo needs to be converted again
+        return {
+            "output_format" : (self.output_ext or '').lower(),
+            "exif_policy" : self.exif_policy,
+            "quality" : self.output_quality,
+        }
+
     def convert(self, input_formats = None, output_format = None):
 
             # if input_formats are not specified, use the input_ext attribute of the class
@@ -59,6 +125,10 @@ class PhotoConverter:
             # if output_format is not specified, use the output_ext attribute of the class
             if not output_format:
                 output_format = self.output_ext
+
+            if self.manifest:
+                self.manifest.begin_run()
+            converted_roots = []
                 
             # Check if root directories have been specified in the config
             if self.root_directories:
@@ -67,6 +137,7 @@ class PhotoConverter:
                     for root in self.root_directories:
                         self.root_dir = root
                         self._convert(input_formats, output_format)
+                        converted_roots.append(root)
                 else:
                     # If no root directories have been specified, log the error
                     self.logger.error('No root directories specified in config')
@@ -74,6 +145,24 @@ class PhotoConverter:
             elif self.root_path:
                 self.root_dir = self.root_path
                 self._convert(input_formats, output_format)
+                converted_roots.append(self.root_path)
+
+            if self.manifest:
+                self._flag_orphaned_outputs(converted_roots)
+
+    def _flag_orphaned_outputs(self, roots):
+        # Outputs whose source was not found by this run are flagged in the manifest for cleanup
+        flagged = self.manifest.flag_missing_sources([root for root in roots if root and os.path.exists(root)])
+        for source_path, output_path in flagged:
+            self.logger.warning('Source of converted photo is missing, flagged for cleanup: {0} (source {1})'.format(output_path, source_path))
+        self.manifest.commit()
+        return flagged
+
+    def _on_conversion_result(self, job, result):
+        if result['success']:
+            self.run_bytes += job.get('source_bytes', 0)
+        if self.manifest and result['success']:
+            self.manifest.record(job['input_file'], job['output_file'])
 
     def _configure_logger(self):
         # dump all log levels to file
@@ -83,8 +172,6 @@ class PhotoConverter:
         if not isinstance(numeric_log_level, int):
             raise ValueError("Invalid log level: %s" % log_level)
 
-        self.logger.setLevel(numeric_log_level)
-
         # create a file handler to log to a file
         file_handler = None
 
@@ -105,9 +192,9 @@ class PhotoConverter:
         console_formatter = logging.Formatter('%(asctime)s - %(funcName)s - %(lineno)d - %(levelname)s - %(message)s')
         file_handler.setFormatter(file_formatter)
         console_handler.setFormatter(console_formatter)
-        # add the file handler to the logger
-        self.logger.addHandler(file_handler)
-        self.logger.addHandler(console_handler)
+        # The handlers are written by a listener thread, per-file info lines can be sampled
+        configureLogger(self.logger, numeric_log_level, [file_handler, console_handler],
+                        self.config.get('perFileLogEvery', 1), self.config.get('perFileLogIntervalSeconds', 0))
 
     def install_dependencies(self):
         if platform.system() == "Darwin":
@@ -124,178 +211,284 @@ class PhotoConverter:
             raise Exception("libheif installation not supported on this platform.")
 
     def _convert(self, input_formats = None, output_format = None):
+        formats = self._check_formats(input_formats, output_format)
+        if not formats:
+            return
+
+        # The walk feeds the conversion engine one job at a time
+        self._run_jobs(self._collect_jobs(*formats))
+
+    def _check_formats(self, input_formats, output_format):
         # Check if there are no input formats defined
         if not input_formats or len(input_formats) == 0:
             self.logger.error('No input formats defined')
-            return
+            return None
         # Check if there is no output format defined
         elif output_format == None:
             self.logger.error('No output format defined')
-            return
+            return None
         # Check if the root directory does not exist
         elif not self.root_dir or not os.path.exists(self.root_dir):
             self.logger.error('Root directory not found')
-            return
+            return None
         
         # Make sure the output format is in lowercase
         output_format = output_format.lower()
         self.logger.debug('Output format: %s' % output_format)
         # Make sure all input formats are in lowercase
-        input_formats = [f.lower() for f in input_formats]
+        input_formats = frozenset(f.lower().lstrip('.') for f in input_formats)
         self.logger.debug('Input formats: %s' % input_formats)
+        return input_formats, output_format
+
+    def _run_jobs(self, jobs):
+        started = time.perf_counter()
+        self.run_bytes = 0
+        converted, failed = self.conversion_engine.run(self._announce_jobs(jobs), self._on_conversion_result)
+        # The manifest only commits every few hundred records on its own, the rest of the run is saved here
+        if self.manifest:
+            self.manifest.commit()
+        self.logger.info('Converted {0} photos, {1} failed'.format(converted, failed))
+        if self.cache_folder:
+            self.logger.info('{0} photos taken from the conversion cache'.format(self.conversion_engine.cache_hits))
+        if self.conversion_engine.peak_memory_bytes:
+            self.logger.info('Peak conversion memory: {0:.1f} MB'.format(self.conversion_engine.peak_memory_bytes / (1024 * 1024)))
+
+        # Every timed run calibrates the duration estimates of later plans
+        self.throughput_model.record_run(converted, self.run_bytes, time.perf_counter() - started)
+
+    def _announce_jobs(self, jobs):
+        for job in jobs:
+            self.logger.info('Converting Image %s to %s', job['input_file'], job['output_file'], extra=PER_FILE)
+            yield job
+
+    def plan(self, input_formats = None, output_format = None, plan_file = None):
+        """
+        Walks the roots with the exclusions and skip rules of convert and returns the jobs it would run, with the
+        job count, source bytes and estimated duration of each directory. plan_file saves the plan for run_plan.
+        Nothing is written to the manifest, existing outputs it would adopt are listed in the plan and adopted by run_plan.
+        """
+        if not input_formats:
+            input_formats = self.input_ext
+        if not output_format:
+            output_format = self.output_ext
+
+        roots = self.root_directories or ([self.root_path] if self.root_path else [])
+        jobs = []
+        adoptions = []
+        for root in roots:
+            self.root_dir = root
+            formats = self._check_formats(input_formats, output_format)
+            if formats:
+                jobs.extend(self._collect_jobs(*formats, adoptions=adoptions))
+
+        plan = buildPlan('photo', self._get_conversion_settings(), roots, jobs, self.throughput_model)
+        plan['adopt'] = adoptions
+        for directory in plan['directories']:
+            self.logger.info('Plan: {0} photos, {1:.1f} MB, about {2:.0f}s in {3}'.format(directory['jobs'], directory['bytes'] / (1024 * 1024),
+                                                                                        directory['estimated_seconds'], directory['path']))
+        self.logger.info('Plan: {0} photos, {1:.1f} MB in {2} folders, about {3:.0f}s{4}'.format(plan['total_jobs'], plan['total_bytes'] / (1024 * 1024),
+                                                                                              len(plan['directories']), plan['estimated_seconds'],
+                                                                                              '' if plan['calibrated'] else ' (no timed runs yet, default rate)'))
+        if plan_file:
+            savePlan(plan, plan_file)
+            self.logger.info('Plan written to {0}'.format(plan_file))
+        return plan
+
+    def run_plan(self, plan):
+        """
+        Runs the jobs of a plan made by plan(), or of a saved plan file, without walking the roots again
+        """
+        if isinstance(plan, str):
+            plan = loadPlan(plan)
+        if plan.get('kind') != 'photo':
+            self.logger.error('Not a photo conversion plan: {0}'.format(plan.get('kind')))
+            return
+        if plan.get('settings') != self._get_conversion_settings():
+            self.logger.warning('Converter settings changed since the plan was made, the planned settings are used')
 
-        # Start the directory walk
-        for dirpath, dirnames, filenames in os.walk(self.root_dir):
-            
-            dirnames = self._remove_excluded_folders_from_traverse_path(dirnames)
+        self._adopt_outputs(plan.get('adopt', []))
+        # Sources removed since the plan was made are skipped
+        self._run_jobs(job for job in plan['jobs'] if os.path.exists(job['input_file']))
 
-            dirnames = self._remove_excluded_files_from_traverse_path(filenames)
+    def _adopt_outputs(self, adoptions):
+        # Existing outputs a plan found for sources the manifest doesn't know yet
+        if not self.manifest or not adoptions:
+            return
+        for adoption in adoptions:
+            if os.path.exists(adoption['output_file']):
+                self.manifest.record(adoption['input_file'], adoption['output_file'], settings=adoption.get('settings'))
+        self.manifest.commit()
+        self.logger.info('Adopted {0} existing outputs into the manifest'.format(len(adoptions)))
 
-            self._convert_process_directories(dirpath, filenames, input_formats, output_format)
-            
-    def _convert_process_directories(self,dirpath,filenames, input_formats, output_format):
-        self.logger.debug('Processing Directories')
+    def _collect_jobs(self, input_formats, output_format, adoptions=None):
+        # Start the directory walk, excluded folders are pruned so their whole subtree is skipped and excluded files are left out
+        for dirpath, dir_entries, file_entries in walkTree(self.root_dir, self.exclusion_matcher, threads=self.walk_threads):
+
+            if self.metadata_cache:
+                # The photos of the directory that are not cached yet are probed in one parallel batch
+                self.metadata_cache.prefetch([entry.path for entry in file_entries
+                                              if os.path.splitext(entry.name)[1].lower()[1:] in input_formats])
+
+            yield from self._convert_process_directories(dirpath, file_entries, input_formats, output_format, adoptions)
+
+    def _get_output_folder(self, dirpath):
         # Get the converted folder path
         output_folder = os.path.join(dirpath, self.converted_folder_name)
         if self.config.get('convertedFolderParentFolderPath',None):
             output_folder = self.converted_folder_path
+        return output_folder
+
+    def accepts_file(self, dirpath, file):
+        """
+        Check if a file found by an external walk, such as the media pipeline, is a conversion candidate
+        """
+        extension = os.path.splitext(file)[1].lower()
+        if extension[1:] not in self.input_formats:
+            return False
+        return not self.exclusion_matcher.is_file_excluded(file, os.path.join(dirpath, file))
+
+    def convert_file(self, dirpath, file):
+        """
+        Converts a single file that was found by an external walk, such as the media pipeline
+        """
+        if not self.accepts_file(dirpath, file) or not self.output_ext:
+            return
+        self._convert_process_file(dirpath, file, self.input_formats, self.output_ext.lower(), self._get_output_folder(dirpath))
 
-        self.logger.debug('Output Folder Path: {0}'.format(output_folder))
+    def _convert_process_directories(self,dirpath,file_entries, input_formats, output_format, adoptions=None):
+        self.logger.debug('Processing Directories')
+        output_folder = self._get_output_folder(dirpath)
 
-        # Loop through all the files in the directory
-        for file in filenames:
-            self._convert_process_file(dirpath, file, input_formats, output_format, output_folder)
-        
-        if os.path.exists(output_folder):
-            for filename in os.listdir(output_folder):
-                if filename.endswith('-depth.jpeg'):
-                    file_path = os.path.join(directory, filename)
-                    self.logger.info(f"Removing depth file: {file_path}")
-                    os.remove(file_path)
+        self.logger.debug('Output Folder Path: %s', output_folder)
+
+        # Loop through all the files in the directory, depth files are removed by the conversion jobs
+        for entry in file_entries:
+            job = self._build_job(dirpath, entry.name, input_formats, output_format, output_folder, entry, adoptions)
+            if job:
+                yield job
 
     def _convert_process_file(self, dirpath, file, input_formats, output_format, output_folder):
+        # Converts a single file inline
+        job = self._build_job(dirpath, file, input_formats, output_format, output_folder)
+        for job in self._announce_jobs([job] if job else []):
+            self.conversion_engine.run_job(job, self._on_conversion_result)
+
+    def _build_job(self, dirpath, file, input_formats, output_format, output_folder, entry = None, adoptions = None):
         # Get the full path of the input file
         input_file = os.path.join(dirpath, file)
-        self.logger.debug('Input File Path: {0}'.format(input_file))
+        # Checked once per file, the debug lines below cost nothing when debug logging is off
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.logger.debug('Input File Path: %s', input_file)
 
         # Get file extension
         extension = os.path.splitext(file)[1].lower()
-        self.logger.debug('Extension: {0}'.format(extension))
+        if debug:
+            self.logger.debug('Extension: %s', extension)
 
-        if self._is_file_excluded(extension,input_file, input_formats):
-            self.logger.debug('File excluded: {0}'.format(input_file))
-            return
-        
-        # Create the converted photo folder if it doesn't exist
-        if not os.path.exists(output_folder):
-            os.mkdir(output_folder)
-            self.logger.info('Photo conversion folder created: {0}'.format(output_folder))
-            print('Photo conversion folder created')
+        if self._is_file_excluded(extension, input_formats):
+            if debug:
+                self.logger.debug('File excluded: %s', input_file)
+            return None
         
         # Get the output file name
         output_file = os.path.join(output_folder, file.replace(extension, '.' + output_format).replace(extension.upper(), '.' + output_format))
 
-        # Check if the output file already exists
-        if os.path.exists(output_file):
-            self.logger.debug('Output file already exists: {0}'.format(output_file))
-            return
-        self.logger.info('Converting Image')
-        self.logger.info('Input File Path: {0}'.format(input_file))
-        self.logger.info('Output file: {0}'.format(output_file))
-        # Convert the file based on the file extension
-        if(extension == '.heic'):
-            if platform.system() == "Darwin":
-                self.convert_heic_mac(input_file, output_file,output_format)
-            elif platform.system() == "Linux":
-                self.convert_heic_linux(input_file, output_file,output_format)
-        else:
-            self.convert_img(input_file, output_file, output_format)
-        
-        if(os.path.exists(output_file)):
-            self.logger.info('Successfully Converted Photo')
-            self._remove_orientation(output_file, output_format)
-        else:
-            self.logger.warning('Failed to convert file: {}'.format(input_file))
-
-    def _is_file_excluded(self, extension, input_file, input_formats):
-        # Check if the file needs to be excluded based on file extension
-        if extension in self.exclusions.get('extensions', []):
-            self.logger.debug('Excluded based on file extension')
-            return True
-
-        # Check if the file needs to be excluded based on exclusion paths provided
-        if self.exclusions.get('paths', None):
-            skipFlag = False
-            for path in self.exclusions.get('paths', []):
-                if os.path.commonpath([path, input_file]) == path:
-                    skipFlag = True
-                    break
-            if skipFlag:
-                self.logger.debug('Excluded. File path with exclusion path')
-                return True
-        
+        try:
+            # The stat of an entry from the walk is cached by the entry
+            source_stat = entry.stat() if entry else os.stat(input_file)
+        except OSError:
+            return None
+
+        # Check if the output file is up to date, from the manifest when there is one
+        # A plan passes adoptions and only reads the manifest, the outputs it would adopt are collected instead
+        if self.manifest:
+            needs_conversion, reason = self.manifest.needs_conversion(input_file, source_stat, output_file, record=adoptions is None)
+            if reason == OUTPUT_EXISTS and adoptions is not None:
+                adoptions.append({"input_file" : input_file, "output_file" : output_file})
+            if not needs_conversion:
+                if debug:
+                    self.logger.debug('Skipping %s: %s', input_file, reason)
+                return None
+            if debug:
+                self.logger.debug('Converting %s: %s', input_file, reason)
+        elif os.path.exists(output_file):
+            if debug:
+                self.logger.debug('Output file already exists: %s', output_file)
+            return None
+
+        # Jobs are plain dicts so they can be sent to the pool processes
+        job = {
+            "input_file" : input_file,
+            "output_file" : output_file,
+            "output_format" : output_format,
+            "extension" : extension,
+            "platform" : self.platform,
+            "capability_cache_file" : self.capability_cache_file,
+            "heic_backend" : self.heic_backend,
+            "exif_policy" : self.exif_policy,
+            "quality" : self.output_quality,
+            "source_bytes" : source_stat.st_size,
+            "cache_folder" : self.cache_folder,
+            "cache_key" : self.cache_key,
+        }
+
+        # The dimensions let the memory budget skip reading the header
+        if self.metadata_cache:
+            metadata = self.metadata_cache.get(input_file, source_stat)
+            if metadata and metadata['width'] and metadata['height']:
+                job['width'] = metadata['width']
+                job['height'] = metadata['height']
+        return job
+
+    def _is_file_excluded(self, extension, input_formats):
+        # Exclusion names, extensions and paths are already filtered out of the walk by the exclusion matcher
         # Check if the file extension is in the list of input formats
         if extension[1:] not in input_formats:
-            self.logger.debug('Skipping extension is not in input formats list')
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('Skipping extension is not in input formats list')
             return True
+        return False
 
-    def _remove_excluded_files_from_traverse_path(self, fileNames):
-        # Remove all the exclusion folders from the directory walk
-        exclusion_files = self.exclusions.get('fileNames',[])
-        for file in exclusion_files:
-            if file in fileNames:
-                fileNames.remove(file)
-        
-        self.logger.debug('Removed Excluded Files')
-
-        return fileNames
-    
-    def _remove_excluded_folders_from_traverse_path(self, folderNames):
-        exclusion_folders = self.exclusions.get('folderNames',[])
-        exclusion_folders.append(self.converted_folder_name)
-        for folder in exclusion_folders:
-            if folder in folderNames:
-                folderNames.remove(folder)
-        
-        self.logger.debug('Removed Excluded Folders')
-
-        return folderNames
+    def _log_messages(self, messages):
+        for level, message in messages:
+            self.logger.log(level, message)
 
     def _remove_orientation(self, file_path, img_format):
-        try:
-            img = Image.open(file_path)
-            img.save(file_path, img_format, exif=b"")
-            img.close()
-        except Exception as e:
-            self.logger.error(f'Error removing orientation information {file_path}')
+        messages = []
+        removeOrientation(file_path, img_format, messages)
+        self._log_messages(messages)
   
     def convert_heic_linux(self, input_file, output_file, output_format):
-        # Convert the HEIC file to JPG
-        self.logger.debug('Converting HEIC on Linux')
-        try:
-            if(output_format in ['png', 'jpg','jpeg']):
-                subprocess.run(['heif-convert', '-q', '100', input_file, output_file])
-            else:
-                self.logger.warning('conversion not supported')
-        except subprocess.CalledProcessError as e:
-            self.logger.error(f'Error converting {input_file} to {output_file}. Error: {e}\n')
+        messages = []
+        convertHeicLinux(input_file, output_file, output_format, messages, self.capability_cache_file)
+        self._log_messages(messages)
 
     def convert_heic_mac(self, input_file, output_file, output_format):
-        # Convert the HEIC file to JPG
-        self.logger.debug('Converting HEIC on Mac')
-        try:
-            subprocess.run(['sips', '-s', 'format', output_format, input_file, '--out', output_file])
-        except subprocess.CalledProcessError as e:
-            self.logger.error(f'Error converting {input_file} to {output_file}. Error: {e}\n')
+        messages = []
+        convertHeicMac(input_file, output_file, output_format, messages)
+        self._log_messages(messages)
     
     def convert_img(self, input_file, output_file, output_format):
-        # Convert the input file to the output format
-        try:
-            with Image.open(input_file) as img:
-                img.save(output_file, output_format)
-        except Exception as e:
-            self.logger.error(f'Error converting {input_file} to {output_file}. Error: {e}\n')
+        messages = []
+        convertImg(input_file, output_file, output_format, messages)
+        self._log_messages(messages)
     
+    def benchmark_conversion(self, sample_files, output_folder, output_format=None):
+        """
+        Converts the sample files with the legacy path (convert, then decode and encode again to drop EXIF)
+        and with the single pass path and logs how long each one took
+        """
+        output_format = (output_format or self.output_ext).lower()
+        report = benchmarkConversion(sample_files, output_folder, output_format, self.platform, self.exif_policy, self.output_quality, self.capability_cache_file)
+
+        for error in report['errors']:
+            self.logger.error(error)
+        self.logger.info('Legacy path: {0:.3f}s, single pass path: {1:.3f}s for {2} files'.format(report['legacy_seconds'], report['single_pass_seconds'], len(sample_files)))
+        if report.get('speedup'):
+            self.logger.info('Single pass speedup: {0:.2f}x'.format(report['speedup']))
+        return report
+
     def remove_all_converted_files(self, traversing_directories=[], removal_folder_name=None):
         if not traversing_directories and self.root_directories:
             traversing_directories = self.root_directories
@@ -341,6 +534,8 @@ class PhotoConverter:
             self.logger.info(f'Removing path and all contents from: {removal_path}')
 
             shutil.rmtree(removal_path)
+            if self.manifest:
+                self.manifest.forget_outputs_under(removal_path)
 
             if os.path.exists(removal_path):
                 self.logger.error(f'Path was not removed successfully')
@@ -348,41 +543,111 @@ class PhotoConverter:
                 self.logger.info(f'Path was successfully removed')
 
     def move_missing_files_from_converted_to_actual_directory(self, traversing_directories = [], removeDepthFiles = True):
+        """
+        Moves converted photos whose original is gone back into the original directory and removes depth files.
+        Kept for existing callers, see reconcile_converted_files.
+        """
+        return self.reconcile_converted_files(traversing_directories, removeDepthFiles)
+
+    def reconcile_converted_files(self, traversing_directories = None, remove_depth_files = True, dry_run = False, plan_file = None):
+        """
+        Plans every move of a converted photo whose original is gone back into the original directory, and every
+        depth file deletion, then runs them in parallel. With dry_run the plan is only logged (and written to
+        plan_file as json) and returned.
+        """
         if not traversing_directories and self.root_directories:
             traversing_directories = self.root_directories
-        
         elif not traversing_directories and self.root_path:
-                traversing_directories.append(self.root_path)
+            traversing_directories = [self.root_path]
         elif not traversing_directories:
             self.logger.warning(f'No directories to traverse')
-            return
+            return []
 
+        plan = []
         for traversing_directory in traversing_directories:
-
             if not os.path.exists(traversing_directory):
                 self.logger.warning(f'Traversing Directory does not exist: %s' % traversing_directory)
-                return
-            
-            for dirpath, dirnames, filenames in os.walk(traversing_directory):
-                if self.converted_folder_name in dirnames:
-                    converted_photos_dir = os.path.join(dirpath, self.converted_folder_name)
-                    parent_dir = dirpath
-                    
-                    for filename in os.listdir(converted_photos_dir):
-                        if removeDepthFiles:
-                            if filename.endswith('-depth.jpeg'):
-                                file_path = os.path.join(converted_photos_dir, filename)
-                                self.logger.info(f"Removing depth file: {file_path}")
-                                os.remove(file_path)
-                                continue
-                        filename_without_ext = os.path.splitext(filename)[0]
-                        matching_files = [
-                            f for f in os.listdir(parent_dir)
-                            if os.path.isfile(os.path.join(parent_dir, f)) and os.path.splitext(f)[0] == filename_without_ext
-                        ]
-                        
-                        if not matching_files:
-                            old_path = os.path.join(converted_photos_dir, filename)
-                            new_path = os.path.join(parent_dir, filename)
-                            self.logger.info(f'Moving {old_path} to {new_path}')
-                            os.rename(old_path, new_path)
+                continue
+            plan.extend(self._plan_reconcile(traversing_directory, remove_depth_files))
+
+        moves = sum(1 for action in plan if action['action'] == 'move')
+        self.logger.info('Reconcile plan: {0} moves, {1} depth file deletions'.format(moves, len(plan) - moves))
+
+        if plan_file:
+            with open(plan_file, 'w') as file:
+                json.dump(plan, file, indent=4)
+            self.logger.info('Reconcile plan written to {0}'.format(plan_file))
+
+        if dry_run:
+            for action in plan:
+                if action['action'] == 'move':
+                    self.logger.info('[dry run] Move {0} to {1}'.format(action['source'], action['destination']))
+                else:
+                    self.logger.info('[dry run] Remove depth file {0}'.format(action['source']))
+            return plan
+
+        self._run_reconcile_plan(plan)
+        # forget_output only commits every few hundred deletions on its own
+        if self.manifest:
+            self.manifest.commit()
+        return plan
+
+    def _plan_reconcile(self, traversing_directory, remove_depth_files):
+        plan = []
+        for dirpath, dirnames, filenames in os.walk(traversing_directory):
+            if self.converted_folder_name not in dirnames:
+                continue
+
+            # The converted folder is listed directly below, no need to walk into it
+            dirnames.remove(self.converted_folder_name)
+            converted_photos_dir = os.path.join(dirpath, self.converted_folder_name)
+
+            # Stems of the files in the parent directory, built from the listing the walk already made
+            parent_stems = set(os.path.splitext(f)[0] for f in filenames)
+
+            with os.scandir(converted_photos_dir) as entries:
+                converted_files = sorted(entry.name for entry in entries if entry.is_file())
+
+            for filename in converted_files:
+                stem = os.path.splitext(filename)[0]
+                old_path = os.path.join(converted_photos_dir, filename)
+
+                if remove_depth_files and filename.endswith('-depth.jpeg'):
+                    plan.append({"action" : "delete", "source" : old_path})
+                    continue
+
+                if stem not in parent_stems:
+                    plan.append({"action" : "move", "source" : old_path, "destination" : os.path.join(dirpath, filename)})
+                    # The moved file now holds this stem in the parent directory
+                    parent_stems.add(stem)
+        return plan
+
+    def _run_reconcile_plan(self, plan):
+        # The actions touch different files, so they can run in parallel
+        with ThreadPoolExecutor(max_workers=max(1, self.config.get('reconcile_threads', 8))) as executor:
+            for action, error in zip(plan, executor.map(self._run_reconcile_action, plan)):
+                if error:
+                    self.logger.error('Reconcile {0} failed for {1}: {2}'.format(action['action'], action['source'], error))
+
+    def _run_reconcile_action(self, action):
+        try:
+            if action['action'] == 'delete':
+                self.logger.info(f"Removing depth file: {action['source']}")
+                os.remove(action['source'])
+                return None
+
+            self.logger.info(f"Moving {action['source']} to {action['destination']}")
+            try:
+                os.rename(action['source'], action['destination'])
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # The converted folder is on another device, copy and delete instead
+                shutil.move(action['source'], action['destination'])
+
+            # The moved photo replaces its original, it is no longer a conversion output
+            if self.manifest:
+                self.manifest.forget_output(action['source'])
+        except Exception as e:
+            return e
+        return None
@@ -0,0 +1,71 @@
+import os
+import json
+import shutil
+import hashlib
+from utility.util import get_file_hash
+
+# ioctl that clones a file's extents on copy on write filesystems (btrfs, xfs)
+_FICLONE = 0x40049409
+
+
+def get_settings_key(settings):
+    """
+    Short digest of the conversion settings, outputs are only shared between runs with the same settings
+    """
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+
+def get_cache_path(cache_folder, source_hash, settings_key, output_format):
+    # Two level fan out so no folder of the cache gets too large
+    return os.path.join(cache_folder, source_hash[:2], '{0}-{1}.{2}'.format(source_hash, settings_key, output_format))
+
+
+def _reflink(source, destination):
+    import fcntl
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        fcntl.ioctl(destination_file.fileno(), _FICLONE, source_file.fileno())
+
+
+def link_file(source, destination):
+    """
+    Makes destination a copy of source without copying the data where the filesystem allows it: a reflink
+    (independent copy on write), otherwise a plain copy. Never a hardlink, so the two files never share an inode
+    and editing one in place can't change the other. Returns the method that was used.
+    """
+    temp_file = '{0}.{1}.tmp'.format(destination, os.getpid())
+    method = None
+    try:
+        _reflink(source, temp_file)
+        method = 'reflink'
+    except (ImportError, OSError):
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+    if not method:
+        shutil.copy2(source, temp_file)
+        method = 'copy'
+
+    # The rename makes the file appear complete, never half written
+    os.replace(temp_file, destination)
+    return method
+
+
+def lookup(cache_folder, source_file, settings_key, output_format):
+    """
+    Returns (source_hash, cached output path or None)
+    """
+    source_hash = get_file_hash(source_file)
+    cache_path = get_cache_path(cache_folder, source_hash, settings_key, output_format)
+    return source_hash, (cache_path if os.path.exists(cache_path) else None)
+
+
+def store(cache_folder, source_hash, settings_key, output_format, output_file):
+    """
+    Adds a converted output to the cache as a reflink or a copy, so nothing written to the output later reaches the cache.
+    """
+    cache_path = get_cache_path(cache_folder, source_hash, settings_key, output_format)
+    if os.path.exists(cache_path):
+        return cache_path
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    link_file(output_file, cache_path)
+    return cache_path
@@ -0,0 +1,477 @@
+import os
+import sys
+import time
+import logging
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from utility.capabilities import is_tool_available
+from utility.conversionCache import lookup as cacheLookup, store as cacheStore, link_file as linkFile
+from utility.logSetup import PER_FILE
+
+# The conversion functions run inside pool processes, so instead of logging they append
+# (level, message) tuples to a list that is handed back to the parent logger.
+
+# Output formats that can't store an alpha channel or palette
+_RGB_ONLY_FORMATS = ('jpeg', 'jpg')
+
+# EXIF tag that holds the orientation
+_ORIENTATION_TAG = 0x0112
+
+# Decoded pixels are held in about three copies (decode, orientation, mode conversion) of 4 bytes each
+_BYTES_PER_PIXEL = 12
+
+_heif_opener_registered = None
+
+
+def register_heif_opener():
+    """
+    Registers the optional pillow-heif plugin so PIL can decode HEIC in process.
+    Returns False when pillow-heif is not installed.
+    """
+    global _heif_opener_registered
+    if _heif_opener_registered is None:
+        try:
+            from pillow_heif import register_heif_opener as registerHeifOpener
+            registerHeifOpener()
+            _heif_opener_registered = True
+        except ImportError:
+            _heif_opener_registered = False
+    return _heif_opener_registered
+
+
+@contextmanager
+def _atomic_output(output_file):
+    """
+    Yields a temporary path next to output_file and moves what was written to it over output_file.
+    Outputs are replaced instead of written over, so a cache entry or duplicate linked to the old file keeps its content.
+    """
+    # The extension is kept, heif-convert picks the output format from it
+    name, extension = os.path.splitext(output_file)
+    temp_file = '{0}.{1}.tmp{2}'.format(name, os.getpid(), extension)
+    try:
+        yield temp_file
+        if os.path.exists(temp_file):
+            os.replace(temp_file, output_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+
+def uses_single_pass(extension, heic_backend='auto'):
+    """
+    Check if a file can be converted with a single decode and encode in PIL.
+    HEIC files need pillow-heif unless the backend is forced to the platform tool.
+    """
+    if extension != '.heic':
+        return True
+    if heic_backend == 'tool':
+        return False
+    return register_heif_opener()
+
+
+def convert_single_pass(input_file, output_file, output_format, messages, exif_policy='strip', quality=None):
+    """
+    Decodes the input once, applies the orientation and EXIF policy in memory and encodes the output once.
+
+    exif_policy 'strip' drops all EXIF data, 'keep' keeps it with the orientation reset
+    since the pixels are already rotated.
+    """
+    from PIL import Image, ImageOps
+    if os.path.splitext(input_file)[1].lower() == '.heic' and not register_heif_opener():
+        messages.append((logging.ERROR, f'Error converting {input_file} to {output_file}. Error: pillow-heif is not installed\n'))
+        return
+    try:
+        with Image.open(input_file) as img, _atomic_output(output_file) as temp_file:
+            # Rotate the pixels so the output looks right without an orientation tag
+            oriented = ImageOps.exif_transpose(img)
+
+            if output_format.lower() in _RGB_ONLY_FORMATS and oriented.mode not in ('RGB', 'L', 'CMYK'):
+                oriented = oriented.convert('RGB')
+
+            save_options = {}
+            if quality:
+                save_options['quality'] = quality
+
+            if exif_policy == 'keep':
+                exif = oriented.getexif()
+                if _ORIENTATION_TAG in exif:
+                    del exif[_ORIENTATION_TAG]
+                save_options['exif'] = exif.tobytes()
+            else:
+                save_options['exif'] = b""
+
+            oriented.save(temp_file, output_format, **save_options)
+    except Exception as e:
+        messages.append((logging.ERROR, f'Error converting {input_file} to {output_file}. Error: {e}\n'))
+
+
+def convert_img(input_file, output_file, output_format, messages):
+    # Convert the input file to the output format
+    # PIL is imported on first use so runs that never touch an image start fast
+    from PIL import Image
+    try:
+        with Image.open(input_file) as img, _atomic_output(output_file) as temp_file:
+            img.save(temp_file, output_format)
+    except Exception as e:
+        messages.append((logging.ERROR, f'Error converting {input_file} to {output_file}. Error: {e}\n'))
+
+
+def convert_heic_linux(input_file, output_file, output_format, messages, capability_cache_file=None):
+    # Convert the HEIC file to JPG
+    messages.append((logging.DEBUG, 'Converting HEIC on Linux'))
+    if not is_tool_available('heif-convert', capability_cache_file):
+        messages.append((logging.ERROR, 'heif-convert not installed: install using function install_dependencies or via cli for your platform'))
+        return
+    if output_format not in ['png', 'jpg','jpeg']:
+        messages.append((logging.WARNING, 'conversion not supported'))
+        return
+    with _atomic_output(output_file) as temp_file:
+        try:
+            subprocess.run(['heif-convert', '-q', '100', input_file, temp_file])
+        except subprocess.CalledProcessError as e:
+            messages.append((logging.ERROR, f'Error converting {input_file} to {output_file}. Error: {e}\n'))
+
+        # heif-convert writes the depth map of portrait photos next to the output, it is not needed
+        temp_name, temp_extension = os.path.splitext(temp_file)
+        depth_file = temp_name + '-depth' + temp_extension
+        if os.path.exists(depth_file):
+            messages.append((logging.INFO, f'Removing depth file: {depth_file}'))
+            os.remove(depth_file)
+
+
+def convert_heic_mac(input_file, output_file, output_format, messages):
+    # Convert the HEIC file to JPG
+    messages.append((logging.DEBUG, 'Converting HEIC on Mac'))
+    with _atomic_output(output_file) as temp_file:
+        try:
+            subprocess.run(['sips', '-s', 'format', output_format, input_file, '--out', temp_file])
+        except subprocess.CalledProcessError as e:
+            messages.append((logging.ERROR, f'Error converting {input_file} to {output_file}. Error: {e}\n'))
+
+
+def remove_orientation(file_path, img_format, messages):
+    from PIL import Image
+    try:
+        with Image.open(file_path) as img, _atomic_output(file_path) as temp_file:
+            img.save(temp_file, img_format, exif=b"")
+    except Exception as e:
+        messages.append((logging.ERROR, f'Error removing orientation information {file_path}'))
+
+
+def read_image_dimensions(input_file):
+    """
+    Returns (width, height) from the image header without decoding the pixels, or None when
+    the header can't be read (for example HEIC without pillow-heif)
+    """
+    from PIL import Image
+    if os.path.splitext(input_file)[1].lower() == '.heic' and not register_heif_opener():
+        return None
+    try:
+        # Image.open only parses the header, the pixels are decoded on first access
+        with Image.open(input_file) as img:
+            return img.size
+    except Exception:
+        return None
+
+
+def estimate_job_memory(job):
+    """
+    Estimated peak memory in bytes of converting a job, None when the dimensions are unknown
+    """
+    # Dimensions from the metadata cache save reading the header again
+    if job.get('width') and job.get('height'):
+        dimensions = (job['width'], job['height'])
+    else:
+        dimensions = read_image_dimensions(job['input_file'])
+    if not dimensions:
+        return None
+    width, height = dimensions
+    return width * height * _BYTES_PER_PIXEL
+
+
+def reset_peak_memory():
+    """
+    Resets the peak resident memory of this process so the next reading covers a single job.
+    Returns False when the platform can't reset it and the reading is the peak of the whole process.
+    """
+    try:
+        # Writing 5 to clear_refs resets VmHWM (Linux 4.0+)
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def read_peak_memory():
+    """
+    Returns the peak resident memory of this process in bytes, None when it is not available
+    """
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on Mac and in kilobytes elsewhere
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def run_conversion_job(job):
+    """
+    Converts a single photo. Runs inside a pool process or inline and returns a picklable result
+    with the messages for the parent logger.
+    """
+    started = time.perf_counter()
+    peak_memory_is_per_job = reset_peak_memory()
+    messages = []
+    input_file = job['input_file']
+    output_file = job['output_file']
+    output_format = job['output_format']
+    cache_folder = job.get('cache_folder')
+    cache_hit = False
+
+    try:
+        # Create the converted photo folder if it doesn't exist, other workers may create it at the same time
+        output_folder = os.path.dirname(output_file)
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder, exist_ok=True)
+            messages.append((logging.INFO, 'Photo conversion folder created: {0}'.format(output_folder)))
+
+        cached_file = None
+        if cache_folder:
+            # Moved and duplicate photos have the same content, their output is already in the cache
+            source_hash, cached_file = cacheLookup(cache_folder, input_file, job['cache_key'], output_format)
+
+        if cached_file:
+            method = linkFile(cached_file, output_file)
+            messages.append((logging.INFO, 'Output taken from the conversion cache ({0}): {1}'.format(method, cached_file)))
+            success = cache_hit = True
+        elif uses_single_pass(job['extension'], job.get('heic_backend', 'auto')):
+            # Decode once, orient and strip in memory, encode once
+            convert_single_pass(input_file, output_file, output_format, messages, job.get('exif_policy', 'strip'), job.get('quality'))
+            success = os.path.exists(output_file)
+        else:
+            # The platform tools write the output themselves, the EXIF data is stripped in a second pass
+            if job['platform'] == "Darwin":
+                convert_heic_mac(input_file, output_file, output_format, messages)
+            elif job['platform'] == "Linux":
+                convert_heic_linux(input_file, output_file, output_format, messages, job.get('capability_cache_file'))
+
+            success = os.path.exists(output_file)
+            if success:
+                remove_orientation(output_file, output_format, messages)
+
+        if cache_folder and success and not cache_hit:
+            cacheStore(cache_folder, source_hash, job['cache_key'], output_format, output_file)
+    except Exception as e:
+        success = False
+        messages.append((logging.ERROR, f'Error converting {input_file} to {output_file}. Error: {e}\n'))
+
+    return {
+        "input_file" : input_file,
+        "output_file" : output_file,
+        "success" : success,
+        "messages" : messages,
+        "seconds" : time.perf_counter() - started,
+        "cache_hit" : cache_hit,
+        # heif-convert and sips run in their own process and are not included
+        "peak_memory_bytes" : read_peak_memory(),
+        "peak_memory_is_per_job" : peak_memory_is_per_job,
+    }
+
+
+def run_legacy_conversion(input_file, output_file, output_format, platform_name, messages, capability_cache_file=None):
+    # The conversion path used before the single pass path: convert, then decode and encode again to drop EXIF
+    if os.path.splitext(input_file)[1].lower() == '.heic':
+        if platform_name == "Darwin":
+            convert_heic_mac(input_file, output_file, output_format, messages)
+        else:
+            convert_heic_linux(input_file, output_file, output_format, messages, capability_cache_file)
+    else:
+        convert_img(input_file, output_file, output_format, messages)
+    if os.path.exists(output_file):
+        remove_orientation(output_file, output_format, messages)
+
+
+def benchmark_conversion(input_files, output_folder, output_format, platform_name, exif_policy='strip', quality=None, capability_cache_file=None):
+    """
+    Converts every sample with the legacy two pass path and with the single pass path and
+    returns the time each path took per file and in total
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    report = {"files" : [], "legacy_seconds" : 0.0, "single_pass_seconds" : 0.0, "errors" : []}
+
+    for index, input_file in enumerate(input_files):
+        timings = {"input_file" : input_file}
+        for name, convert in (('legacy', lambda out, msgs: run_legacy_conversion(input_file, out, output_format, platform_name, msgs, capability_cache_file)),
+                              ('single_pass', lambda out, msgs: convert_single_pass(input_file, out, output_format, msgs, exif_policy, quality))):
+            output_file = os.path.join(output_folder, '{0}-{1}.{2}'.format(index, name, output_format))
+            messages = []
+            started = time.perf_counter()
+            convert(output_file, messages)
+            elapsed = time.perf_counter() - started
+
+            timings[name + '_seconds'] = elapsed
+            timings[name + '_bytes'] = os.path.getsize(output_file) if os.path.exists(output_file) else None
+            report[name + '_seconds'] += elapsed
+            report["errors"].extend(message for level, message in messages if level >= logging.ERROR)
+        report["files"].append(timings)
+
+    if report["single_pass_seconds"]:
+        report["speedup"] = report["legacy_seconds"] / report["single_pass_seconds"]
+    return report
+
+
+class ConversionEngine:
+    """
+    Runs photo conversion jobs on a process pool. Jobs are pulled lazily from the walk and at most
+    max_in_flight jobs are submitted at a time, so the walk never queues the whole tree in memory.
+    With a single process the jobs run inline.
+
+    With a memory budget (bytes) each job's memory is estimated from the image header and a job is
+    only submitted while the estimates of the jobs in flight fit the budget. Jobs larger than the
+    budget run alone.
+    """
+
+    def __init__(self, logger, process_count=1, max_in_flight=None, memory_budget=None):
+        self.logger = logger
+        self.process_count = max(1, process_count or 1)
+        self.max_in_flight = max(self.process_count, max_in_flight or self.process_count * 2)
+        self.memory_budget = memory_budget or None
+        self.converted = 0
+        self.failed = 0
+        self.cache_hits = 0
+        self.peak_memory_bytes = 0
+        self.in_flight_bytes = 0
+        self.oversized_in_flight = 0
+
+    def run(self, jobs, on_result=None):
+        """
+        Runs every job and reports each result to the parent logger, returns (converted, failed)
+        """
+        self.converted = 0
+        self.failed = 0
+        self.cache_hits = 0
+        self.peak_memory_bytes = 0
+
+        if self.process_count == 1:
+            for job in jobs:
+                self._handle_result(job, run_conversion_job(job), on_result)
+            return self.converted, self.failed
+
+        executor = ProcessPoolExecutor(max_workers=self.process_count)
+        self.generation = 0
+        self.in_flight_bytes = 0
+        self.oversized_in_flight = 0
+        pending = {}
+        try:
+            for job in jobs:
+                estimated_bytes = self._estimate_job_memory(job)
+                # Wait for a slot, and for the memory the job needs, before pulling the next job from the walk
+                while pending and not self._admits(estimated_bytes, len(pending)):
+                    executor = self._collect(executor, pending, on_result)
+                try:
+                    future = executor.submit(run_conversion_job, job)
+                except BrokenProcessPool:
+                    executor = self._restart_pool(executor)
+                    future = executor.submit(run_conversion_job, job)
+                pending[future] = (job, self.generation, estimated_bytes)
+                self._reserve(estimated_bytes, 1)
+
+            while pending:
+                executor = self._collect(executor, pending, on_result)
+        finally:
+            executor.shutdown(wait=True)
+
+        return self.converted, self.failed
+
+    def _estimate_job_memory(self, job):
+        if not self.memory_budget:
+            return 0
+        estimated_bytes = estimate_job_memory(job)
+        if estimated_bytes is None:
+            # Unknown dimensions get an even share of the budget
+            return self.memory_budget // self.process_count
+        return estimated_bytes
+
+    def _admits(self, estimated_bytes, pending_count):
+        if pending_count >= self.max_in_flight:
+            return False
+        if not self.memory_budget:
+            return True
+        # Nothing runs next to an oversized job, and an oversized job waits until it can run alone
+        if self.oversized_in_flight or estimated_bytes > self.memory_budget:
+            return False
+        return self.in_flight_bytes + estimated_bytes <= self.memory_budget
+
+    def _reserve(self, estimated_bytes, sign):
+        self.in_flight_bytes += sign * estimated_bytes
+        if self.memory_budget and estimated_bytes > self.memory_budget:
+            self.oversized_in_flight += sign
+
+    def run_job(self, job, on_result=None):
+        """
+        Runs a single job inline, used when the caller already manages the concurrency
+        """
+        result = run_conversion_job(job)
+        self._handle_result(job, result, on_result)
+        return result
+
+    def _collect(self, executor, pending, on_result):
+        done, not_done = wait(list(pending), return_when=FIRST_COMPLETED)
+        broken = False
+        for future in done:
+            job, generation, estimated_bytes = pending.pop(future)
+            self._reserve(estimated_bytes, -1)
+            try:
+                result = future.result()
+            except BrokenProcessPool as e:
+                # A worker died (for example killed by the OOM killer), the whole pool has to be replaced
+                broken = broken or generation == self.generation
+                result = {"input_file" : job['input_file'], "output_file" : job['output_file'], "success" : False,
+                          "messages" : [(logging.ERROR, f"Conversion process died while converting {job['input_file']}: {e}")], "seconds" : 0}
+            except Exception as e:
+                result = {"input_file" : job['input_file'], "output_file" : job['output_file'], "success" : False,
+                          "messages" : [(logging.ERROR, f"Error converting {job['input_file']}. Error: {e}")], "seconds" : 0}
+            self._handle_result(job, result, on_result)
+
+        if broken:
+            executor = self._restart_pool(executor)
+        return executor
+
+    def _restart_pool(self, executor):
+        self.logger.warning('Conversion process pool broke, starting a new pool')
+        executor.shutdown(wait=False, cancel_futures=True)
+        self.generation += 1
+        return ProcessPoolExecutor(max_workers=self.process_count)
+
+    def _handle_result(self, job, result, on_result):
+        for level, message in result['messages']:
+            self.logger.log(level, message)
+
+        peak_memory_bytes = result.get('peak_memory_bytes')
+        if peak_memory_bytes:
+            self.peak_memory_bytes = max(self.peak_memory_bytes, peak_memory_bytes)
+            self.logger.debug('Peak memory%s: %.1f MB for %s', '' if result.get('peak_memory_is_per_job') else ' of the process',
+                              peak_memory_bytes / (1024 * 1024), result['input_file'])
+
+        if result['success']:
+            self.converted += 1
+            if result.get('cache_hit'):
+                self.cache_hits += 1
+            self.logger.info('Successfully Converted Photo', extra=PER_FILE)
+        else:
+            self.failed += 1
+            self.logger.warning('Failed to convert file: %s', result['input_file'])
+
+        if on_result:
+            on_result(job, result)
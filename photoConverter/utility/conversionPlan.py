@@ -0,0 +1,115 @@
+import os
+import json
+from utility.dateTime import get_current_datetime_string as currentDateTime
+
+# Throughput history of recent runs, used to estimate how long a plan will take
+DEFAULT_HISTORY_FOLDER = os.path.join(os.path.expanduser('~'), '.cache', 'media_management')
+
+PLAN_VERSION = 1
+
+
+class ThroughputModel:
+    """
+    Seconds per byte and per file of the last max_runs conversion runs, stored as json.
+    Until a run has been recorded the default rate is used.
+    """
+
+    def __init__(self, history_file, default_bytes_per_second, max_runs=20):
+        self.history_file = history_file
+        self.default_bytes_per_second = default_bytes_per_second
+        self.max_runs = max_runs
+        self.runs = self._load()
+
+    def _load(self):
+        try:
+            with open(self.history_file, 'r') as file:
+                runs = json.load(file)
+            return runs if isinstance(runs, list) else []
+        except (OSError, ValueError):
+            return []
+
+    def record_run(self, files, total_bytes, seconds):
+        """
+        Adds a finished run to the history, runs that converted nothing are not recorded
+        """
+        if files <= 0 or seconds <= 0:
+            return
+        self.runs.append({"date" : currentDateTime(), "files" : files, "bytes" : total_bytes, "seconds" : seconds})
+        self.runs = self.runs[-self.max_runs:]
+        try:
+            os.makedirs(os.path.dirname(self.history_file) or '.', exist_ok=True)
+            temp_file = '{0}.{1}.tmp'.format(self.history_file, os.getpid())
+            with open(temp_file, 'w') as file:
+                json.dump(self.runs, file, indent=4)
+            os.replace(temp_file, self.history_file)
+        except OSError:
+            pass
+
+    def is_calibrated(self):
+        return bool(self.runs)
+
+    def estimate_seconds(self, files, total_bytes):
+        if not files:
+            return 0.0
+        if not self.runs:
+            return total_bytes / self.default_bytes_per_second
+
+        run_seconds = sum(run['seconds'] for run in self.runs)
+        run_bytes = sum(run['bytes'] for run in self.runs)
+        run_files = sum(run['files'] for run in self.runs)
+        # Byte rate for the bulk of the work, file rate when the runs had no size to go by
+        if run_bytes and total_bytes:
+            return total_bytes * run_seconds / run_bytes
+        return files * run_seconds / run_files
+
+
+def get_history_file(config, kind):
+    """
+    Returns the throughput history file of a converter, 'throughputHistoryFile' or the default cache folder
+    """
+    return config.get('throughputHistoryFile', None) or os.path.join(DEFAULT_HISTORY_FOLDER, '{0}_throughput.json'.format(kind))
+
+
+def build_plan(kind, settings, roots, jobs, model):
+    """
+    Groups the jobs by source directory and estimates the duration of each directory and of the whole plan.
+    The plan is plain json data, including the jobs, so it can be saved and run later without walking again.
+    """
+    directories = {}
+    for job in jobs:
+        directory = directories.setdefault(os.path.dirname(job['input_file']), {"jobs" : 0, "bytes" : 0})
+        directory['jobs'] += 1
+        directory['bytes'] += job.get('source_bytes', 0)
+
+    total_jobs = len(jobs)
+    total_bytes = sum(directory['bytes'] for directory in directories.values())
+    return {
+        "version" : PLAN_VERSION,
+        "kind" : kind,
+        "created" : currentDateTime(),
+        "settings" : settings,
+        "roots" : roots,
+        "total_jobs" : total_jobs,
+        "total_bytes" : total_bytes,
+        "estimated_seconds" : model.estimate_seconds(total_jobs, total_bytes),
+        "calibrated" : model.is_calibrated(),
+        "directories" : [
+            {"path" : path, "jobs" : directory['jobs'], "bytes" : directory['bytes'],
+             "estimated_seconds" : model.estimate_seconds(directory['jobs'], directory['bytes'])}
+            for path, directory in sorted(directories.items())
+        ],
+        "jobs" : jobs,
+    }
+
+
+def save_plan(plan, plan_file):
+    with open(plan_file, 'w') as file:
+        json.dump(plan, file, indent=4)
+
+
+def load_plan(plan_file):
+    with open(plan_file, 'r') as file:
+        plan = json.load(file)
+    if plan.get('version') != PLAN_VERSION:
+        raise ValueError('Unsupported conversion plan version: {0}'.format(plan.get('version')))
+    return plan
@@ -0,0 +1,106 @@
+import os
+
+
+def scan_directory(path, matcher=None, follow_symlinks=False, on_error=None):
+    """
+    Lists a single directory with os.scandir and returns (sub folder entries, file entries) without the
+    excluded ones. The DirEntry objects keep the file type from the listing, so is_dir() and is_file() don't
+    cost another system call per file outside of symlinks. stat() is a full system call the first time on POSIX
+    (only Windows fills it from the listing) and is cached on the entry after that.
+    """
+    dirs = []
+    files = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=follow_symlinks):
+                        if not matcher or not matcher.is_dir_excluded(entry.name, entry.path):
+                            dirs.append(entry)
+                    elif entry.is_file():
+                        if not matcher or not matcher.is_file_excluded(entry.name, entry.path):
+                            files.append(entry)
+                except OSError:
+                    # Removed while it was being listed
+                    continue
+    except OSError as e:
+        if on_error:
+            on_error(e)
+    return dirs, files
+
+
+def get_directory_key(entry):
+    """
+    Identifies a folder (a DirEntry or a path) across the symlinks that lead to it, None when it can't be read
+    """
+    try:
+        stat = entry.stat() if isinstance(entry, os.DirEntry) else os.stat(entry)
+    except OSError:
+        return None
+    return (stat.st_dev, stat.st_ino)
+
+
+def walk(root, matcher=None, follow_symlinks=False, on_error=None, threads=1):
+    """
+    Walks root top down like os.walk and yields (dirpath, sub folder entries, file entries) of every directory.
+    Excluded folders are pruned before they are listed, and removing entries from the yielded sub folder list
+    keeps the walk out of them. Symlinked folders are only followed with follow_symlinks, each folder is then
+    visited once so symlink loops end.
+
+    With threads above 1 up to that many directories are listed at once, which hides the latency of network
+    filesystems. The directories are then yielded as their listing finishes instead of in walk order.
+    """
+    if threads and threads > 1:
+        yield from _walk_parallel(root, matcher, follow_symlinks, on_error, threads)
+        return
+
+    visited = set()
+    if follow_symlinks:
+        visited.add(get_directory_key(root))
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        dirs, files = scan_directory(path, matcher, follow_symlinks, on_error)
+        yield path, dirs, files
+        # Pushed in reverse so the sub folders are walked in listing order
+        for entry in reversed(dirs):
+            if _should_descend(entry, follow_symlinks, visited):
+                stack.append(entry.path)
+
+
+def _walk_parallel(root, matcher, follow_symlinks, on_error, threads):
+    # Only parallel walks need the thread pool
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+    visited = set()
+    if follow_symlinks:
+        visited.add(get_directory_key(root))
+    executor = ThreadPoolExecutor(max_workers=threads)
+    try:
+        pending = {executor.submit(_scan, root, matcher, follow_symlinks, on_error)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, dirs, files = future.result()
+                yield path, dirs, files
+                for entry in dirs:
+                    if _should_descend(entry, follow_symlinks, visited):
+                        pending.add(executor.submit(_scan, entry.path, matcher, follow_symlinks, on_error))
+    finally:
+        # A walk that is abandoned halfway doesn't wait for the listings still queued
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _scan(path, matcher, follow_symlinks, on_error):
+    dirs, files = scan_directory(path, matcher, follow_symlinks, on_error)
+    return path, dirs, files
+
+
+def _should_descend(entry, follow_symlinks, visited):
+    if not follow_symlinks:
+        # Symlinked folders are already listed as neither folder nor file, so there is no loop to find
+        return True
+    key = get_directory_key(entry)
+    if key is None or key in visited:
+        return False
+    visited.add(key)
+    return True
@@ -4,16 +4,37 @@ import os
 import subprocess
 import platform
 import mimetypes
+import re
 import logging
+import time
+import shutil
 from utility.util import get_configurations as getConfig 
 from utility.dateTime import get_current_datetime_string as currentDateTime
+from utility.exclusionMatcher import ExclusionMatcher
+from utility.fileWalker import walk as walkTree
+from utility.logSetup import configure_logger as configureLogger, PER_FILE
+from utility.capabilities import get_tool_version
+from utility.conversionManifest import ConversionManifest, OUTPUT_EXISTS
+from utility.metadataCache import MetadataCache
+from utility.ffmpegScheduler import FfmpegJobScheduler
+from utility.jobQueue import VideoJobQueue
+from utility.encoderProfiles import build_encoder_arguments as buildEncoderArguments, select_profile_name as selectProfileName, allows_remux as allowsRemux
+from utility.ffmpegProgress import ProgressMonitor, PROGRESS_ARGUMENTS
+from utility.mediaProbe import probe_media as probeMedia, can_remux as canRemux, get_remux_arguments as getRemuxArguments, select_default_streams as selectDefaultStreams, get_map_arguments as getMapArguments
+from utility.segmentedEncode import get_segment_count as getSegmentCount, get_split_times as getSplitTimes, get_split_command as getSplitCommand, list_segments as listSegments, get_segment_arguments as getSegmentArguments, write_concat_list as writeConcatList, get_concat_command as getConcatCommand, count_video_frames as countVideoFrames
+from utility.conversionPlan import ThroughputModel, get_history_file as getHistoryFile, build_plan as buildPlan, save_plan as savePlan, load_plan as loadPlan
+
+# Conversion rate assumed by plans until a run has been timed
+DEFAULT_BYTES_PER_SECOND = 2 * 1024 * 1024
 
 
 class VideoConverter:
-    def __init__(self, config_path="../default_config.json", root_path=None):
+    def __init__(self, config_path="../default_config.json", root_path=None, config_overrides=None):
         
         # Load configuration from the given path
         self.config = getConfig(config_path)
+        # Settings given on the command line win over the config file
+        self.config.update(config_overrides or {})
         # Get the log file path and name from the config file and setup logger
         self.log_file = os.path.join(self.config.get('logFolderParentFolderPath', None), self.config.get('logFileName', None))
 
@@ -21,15 +42,93 @@ class VideoConverter:
         self._configure_logger()
         self.logger.debug('Log File Path: {0}'.format(self.log_file))
 
+        self.capability_cache_file = self.config.get('capabilityCacheFile', None)
+        # ffmpeg can be pointed at another binary, for example a stub script
+        self.ffmpeg_binary = self.config.get('ffmpegBinary', None) or 'ffmpeg'
+        self.ffprobe_binary = self.config.get('ffprobeBinary', None) or 'ffprobe'
+        # Sources whose streams the output container can hold are remuxed (-c copy) instead of transcoded
+        self.remux_when_possible = self.config.get('remuxWhenPossible', True)
+
+        # Optional metadata cache shared with the photo converter and the hash check, videos are only probed again after they change
+        self.metadata_cache = None
+        metadata_cache_file = self.config.get('metadataCacheFile', None)
+        if metadata_cache_file:
+            metadata_cache_path = os.path.join(self.config.get('metadataCacheFileParentFolderPath', None) or './', metadata_cache_file)
+            self.metadata_cache = MetadataCache(metadata_cache_path, self.ffprobe_binary, self.config.get('metadata_threads', 4))
+            self.logger.debug('Metadata Cache: {0}'.format(metadata_cache_path))
+
+        # Named encoder profiles, chosen per root, per source resolution or by default. Without a profile ffmpeg's defaults are used
+        self.encoder_profiles = self.config.get('encoderProfiles', {})
+        self.default_encoder_profile = self.config.get('defaultEncoderProfile', None) or None
+        self.root_encoder_profiles = self.config.get('rootEncoderProfiles', {})
+        self.resolution_encoder_profiles = self.config.get('resolutionEncoderProfiles', [])
         self.check_requirements()
         self.root_directories = self.config.get('rootFolderList', [root_path])
         self.converted_folder_path = os.path.join(self.config.get('convertedFolderParentFolderPath', ''), self.config.get('convertedFolderName', None))
         self.converted_folder_name = self.config.get('convertedFolderName', 'conversion')
         self.exclusions = self.config.get('exclusions',{})
+        # The converted folders are always excluded from the walk
+        self.exclusion_matcher = ExclusionMatcher(self.exclusions, [self.converted_folder_name])
         self.root_path = root_path
         self.root_dir = None
+        # Folders listed at once by the walk, more than 1 helps on network filesystems
+        self.walk_threads = self.config.get('walk_threads', 1)
         self.output_ext = self.config.get('outputExtension',None)
-        
+
+        # Optional conversion manifest, skip decisions are made from it instead of probing for every output
+        self.manifest = None
+        manifest_file = self.config.get('manifestFile', None)
+        if manifest_file:
+            manifest_path = os.path.join(self.config.get('manifestFileParentFolderPath', None) or './', manifest_file)
+            self.manifest = ConversionManifest(manifest_path, self._get_conversion_settings(), {"output_format" : (self.output_ext or '').lower()})
+            self.logger.debug('Conversion Manifest: {0}'.format(manifest_path))
+
+        # Throughput of recent runs, used to estimate how long a plan will take
+        self.throughput_model = ThroughputModel(getHistoryFile(self.config, 'video'), DEFAULT_BYTES_PER_SECOND)
+
+        # Optional persistent job queue, an interrupted run is resumed from it
+        self.job_queue = None
+        job_queue_file = self.config.get('jobQueueFile', None)
+        if job_queue_file:
+            job_queue_path = os.path.join(self.config.get('jobQueueFileParentFolderPath', None) or './', job_queue_file)
+            self.job_queue = VideoJobQueue(job_queue_path)
+            self.logger.debug('Video Job Queue: {0}'.format(job_queue_path))
+            self._reclaim_jobs()
+
+        # Progress of the running encodes, logged at a bounded rate and written to an optional metrics file
+        self.progress_monitor = ProgressMonitor(self.logger, self.config.get('progressMetricsFile', None),
+                                                self.config.get('progressLogIntervalSeconds', 30), self.config.get('ffmpegStallSeconds', 0))
+
+        # Several ffmpeg processes run at once, each with a share of the cores (ffmpeg_threads 0 splits them evenly)
+        self.scheduler = FfmpegJobScheduler(self.logger, self.config.get('ffmpeg_processes', 1), self.config.get('ffmpeg_threads', 0),
+                                            self.config.get('ffmpegTimeoutSeconds', 0), monitor=self.progress_monitor)
+
+        # Long transcodes can be split at keyframes and the parts encoded in parallel, segment_threads threads each
+        self.segmented_encoding = self.config.get('segmentedEncoding', False)
+        self.segment_min_duration = self.config.get('segmentMinDurationSeconds', 900)
+        self.segment_min_seconds = self.config.get('segmentMinSeconds', 60)
+        self.segment_threads = max(1, self.config.get('segment_threads', 4))
+        self.segment_processes = max(1, (os.cpu_count() or 1) // self.segment_threads)
+
+    def _get_conversion_settings(self, profile_name=None):
+        # Settings that change the converted output of a video, a change means it needs to be converted again.
+        # Only the profile the video is encoded with is part of them, editing or mapping other profiles converts nothing again.
+        # Rows recorded before profiles existed only hold the output format, the manifest keeps them as converted
+        return {
+            "output_format" : (self.output_ext or '').lower(),
+            "encoder_profile" : {"name" : profile_name, "options" : self.encoder_profiles[profile_name]} if profile_name in self.encoder_profiles else None,
+        }
+
+    def _get_plan_settings(self):
+        # Every setting a plan's jobs may be encoded with, so running a plan warns when any of them changed
+        return {
+            "output_format" : (self.output_ext or '').lower(),
+            "encoder_profiles" : self.encoder_profiles,
+            "default_encoder_profile" : self.default_encoder_profile,
+            "root_encoder_profiles" : self.root_encoder_profiles,
+            "resolution_encoder_profiles" : self.resolution_encoder_profiles,
+        }
+
     def _configure_logger(self):
         # dump all log levels to file
         log_level = self.config.get('logLevel', "INFO")
@@ -38,8 +137,6 @@ class VideoConverter:
         if not isinstance(numeric_log_level, int):
             raise ValueError("Invalid log level: %s" % log_level)
 
-        self.logger.setLevel(numeric_log_level)
-
         # create a file handler to log to a file
         file_handler = None
 
@@ -55,15 +152,16 @@ class VideoConverter:
         formatter = logging.Formatter('%(asctime)s - %(process)d - %(thread)d - %(name)s - %(funcName)s - %(lineno)d - %(levelname)s - %(message)s')
         file_handler.setFormatter(formatter)
 
-        # add the file handler to the logger
-        self.logger.addHandler(file_handler)
+        # The handler is written by a listener thread, per-file info lines can be sampled
+        configureLogger(self.logger, numeric_log_level, [file_handler],
+                        self.config.get('perFileLogEvery', 1), self.config.get('perFileLogIntervalSeconds', 0))
 
     def check_requirements(self):
-        try:
-            # Check if ffmpeg is installed
-            subprocess.run(['ffmpeg', '-version'], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            self.logger.info('ffmpeg is installed')
-        except Exception as e:
+        # Check if ffmpeg is installed, the version is probed once per binary and cached on disk
+        self.ffmpeg_version = get_tool_version(self.ffmpeg_binary, self.capability_cache_file)
+        if self.ffmpeg_version is not None:
+            self.logger.debug('ffmpeg is installed: %s', self.ffmpeg_version)
+        else:
             # Log a warning if ffmpeg is not installed
             self.logger.warning('ffmpeg not installed: install using function install_requirements or via cli for your platform')
             print('ffmpeg not installed: install using function install_requirements or via cli for your platform')
@@ -101,7 +199,15 @@ class VideoConverter:
     def is_video_file(self,file_path):
         # Check if the file is a video file
         mime = mimetypes.guess_type(file_path)[0]
-        return mime and mime.startswith('video/')
+        if not mime or not mime.startswith('video/'):
+            return False
+
+        # The probe in the metadata cache tells if the file really has a video stream
+        if self.metadata_cache and os.path.isabs(file_path):
+            metadata = self.metadata_cache.get_or_probe(file_path)
+            if metadata:
+                return metadata['kind'] == 'video'
+        return True
 
     def convert(self, output_format = None):
         # Check if output format is provided as parameter
@@ -109,102 +215,550 @@ class VideoConverter:
             output_format = self.output_ext
             self.logger.info(f'No output format defined, defaulting to {output_format}')
 
+        if self.manifest:
+            self.manifest.begin_run()
+        converted_roots = []
+
         # Use root directories defined in config. If not defined used directory that initialized the instance
         if self.root_directories:
             for root in self.root_directories:
                 self.root_dir = root
                 self.logger.debug(f'Converting files in root directory: {root}')
                 self._convert(output_format)
+                converted_roots.append(root)
         elif self.root_path:
             self.root_dir = self.root_path
             self.logger.debug(f'Converting files in root path: {self.root_path}')
             self._convert(output_format)
+            converted_roots.append(self.root_path)
+
+        if self.manifest:
+            self._flag_orphaned_outputs(converted_roots)
+
+    def _flag_orphaned_outputs(self, roots):
+        # Outputs whose source was not found by this run are flagged in the manifest for cleanup
+        flagged = self.manifest.flag_missing_sources([root for root in roots if root and os.path.exists(root)])
+        for source_path, output_path in flagged:
+            self.logger.warning('Source of converted video is missing, flagged for cleanup: {0} (source {1})'.format(output_path, source_path))
+        self.manifest.commit()
+        return flagged
 
     def _convert(self, output_format = None):
+        if not self._check_root(output_format):
+            return
+        self._run_jobs(self._collect_jobs(output_format))
+
+    def _check_root(self, output_format):
         if not self.root_dir or not os.path.exists(self.root_dir):
             # Log a warning message
             self.logger.warning('Root directory not found')
-            return
+            return False
 
         if not output_format:
             # Log a warning message
             self.logger.warning('No output format defined')
-            return
+            return False
+        return True
 
+    def _collect_jobs(self, output_format, adoptions=None):
         # Iterate through all files in the root directory and its subdirectories
-        for subdir, dirs, files in os.walk(self.root_dir):
-
-            exclusion_folders = self.exclusions.get('folderNames',[])
-            exclusion_folders.append(self.converted_folder_name)
-            for folder in exclusion_folders:
-                if folder in dirs:
-                    dirs.remove(folder)
-
-            exclusion_files = self.exclusions.get('fileNames',[])
-            for file in exclusion_files:
-                if file in files:
-                    files.remove(file)
-
-            self.logger.debug('All excluded folders and files removed from iteration')
-
-            for file in files:
-                # Get the file path
-                file_path = os.path.join(subdir, file)
-                self.logger.debug('file_path: %s' % file_path)
-                # Create the output file path
-                if self.config.get('convertedFolderParentFolderPath',None):
-                    target_file_path = os.path.join(self.converted_folder_path, file) + '.' + output_format
-                else:
-                    target_file_path = os.path.join(subdir,self.converted_folder_name, file) + '.' + output_format
-                self.logger.debug('target_file_path: {}'.format(target_file_path))
-                # Get file extension
-                extension = os.path.splitext(file)[1].lower()
-                self.logger.debug('file extension: {}'.format(extension))
-
-                # Check if the file is a video file and if it is already in the specified format
-                if not self.is_video_file(file_path):
-                    # Log a debug message
-                    self.logger.debug('Skipping file: {} as it is not a video file'.format(file_path))
-                    continue
-
-                if extension[1:] in [f.lower() for f in self.exclusions.get("extensions", [])]:
-                    # Log a debug message
-                    self.logger.debug('Skipping file: {} as it has an excluded extension'.format(file_path))
-                    continue
-
-                # Check if the file needs to be excluded based on exclusion paths provided
-                if self.exclusions.get('paths', None):
-                    skipFlag = False
-                    for path in self.exclusions.get('paths', []):
-                        if os.path.commonpath([path, file_path]) == path:
-                            skipFlag = True
-                            break
-                    if skipFlag:
-                        # Log a debug message
-                        self.logger.debug('Skipping file: {} as it is in an excluded path'.format(file_path))
-                        continue
-
-                if os.path.exists(target_file_path):
-                    # Log a debug message
-                    self.logger.debug('Skipping file: {} as it is already converted'.format(file_path))
-                    continue
-
-                # Create the subdirectory for the converted files if it doesn't already exist
-                if self.config.get('convertedFolderParentFolderPath',None) and not os.path.exists(self.converted_folder_path):
-                    os.mkdir(self.converted_folder_path)
-                    self.logger.debug('Converted folder created at %s', self.converted_folder_path)
-                elif not os.path.exists(os.path.join(subdir, self.converted_folder_name)):
-                    os.mkdir(os.path.join(subdir, self.converted_folder_name))
-                    self.logger.debug("Converted folder created at %s" % self.converted_folder_name)
-
-                # Use ffmpeg to convert the video file to the specified format
-                try:
-                    self.logger.info("Converting video file {}".format(file_path))
-                    subprocess.run(['ffmpeg', '-i', file_path, target_file_path], check=True)
-                except subprocess.CalledProcessError as e:
-                    self.logger.error('Error while converting Error: {e}\n')
-
-                if(os.path.exists(target_file_path)):
-                    self.logger.info('Successfully Converted Video')
-                else:
-                    self.logger.warning('Failed to convert file: {}'.format(file_path))
\ No newline at end of file
+        # Excluded folders are pruned so their whole subtree is skipped, excluded names, extensions and paths are dropped
+        for subdir, dir_entries, file_entries in walkTree(self.root_dir, self.exclusion_matcher, threads=self.walk_threads):
+
+            if self.metadata_cache:
+                # The videos of the directory that are not cached yet are probed in one parallel batch
+                self.metadata_cache.prefetch([entry.path for entry in file_entries if (mimetypes.guess_type(entry.name)[0] or '').startswith('video/')])
+
+            for entry in file_entries:
+                job = self._build_job(subdir, entry.name, output_format, entry, adoptions)
+                if job:
+                    yield job
+
+    def _run_jobs(self, jobs):
+        started = time.perf_counter()
+        self.scheduler.reset()
+
+        if self.job_queue:
+            # Queued jobs are run together with the pending jobs of earlier runs that didn't finish
+            self.job_queue.add_jobs(jobs)
+            jobs = self._get_queued_jobs()
+
+        converted, converted_bytes = self._schedule(jobs)
+        # The manifest only commits every few hundred records on its own, the rest of the run is saved here
+        if self.manifest:
+            self.manifest.commit()
+        self.logger.info('Converted {0} videos'.format(converted))
+        if self.job_queue:
+            self.logger.info('Video job queue: {0}'.format(self.job_queue.get_counts()))
+
+        # Every timed run calibrates the duration estimates of later plans
+        self.throughput_model.record_run(converted, converted_bytes, time.perf_counter() - started)
+
+    def plan(self, output_format = None, plan_file = None):
+        """
+        Walks the roots with the exclusions and skip rules of convert and returns the jobs it would run, with the
+        job count, source bytes and estimated duration of each directory. plan_file saves the plan for run_plan.
+        Nothing is written to the manifest, existing outputs it would adopt are listed in the plan and adopted by run_plan.
+        """
+        if not output_format:
+            output_format = self.output_ext
+
+        roots = self.root_directories or ([self.root_path] if self.root_path else [])
+        jobs = []
+        adoptions = []
+        for root in roots:
+            self.root_dir = root
+            if self._check_root(output_format):
+                jobs.extend(self._collect_jobs(output_format, adoptions))
+
+        plan = buildPlan('video', self._get_plan_settings(), roots, jobs, self.throughput_model)
+        plan['adopt'] = adoptions
+        for directory in plan['directories']:
+            self.logger.info('Plan: {0} videos, {1:.1f} MB, about {2:.0f}s in {3}'.format(directory['jobs'], directory['bytes'] / (1024 * 1024),
+                                                                                        directory['estimated_seconds'], directory['path']))
+        self.logger.info('Plan: {0} videos, {1:.1f} MB in {2} folders, about {3:.0f}s{4}'.format(plan['total_jobs'], plan['total_bytes'] / (1024 * 1024),
+                                                                                              len(plan['directories']), plan['estimated_seconds'],
+                                                                                              '' if plan['calibrated'] else ' (no timed runs yet, default rate)'))
+        if plan_file:
+            savePlan(plan, plan_file)
+            self.logger.info('Plan written to {0}'.format(plan_file))
+        return plan
+
+    def run_plan(self, plan):
+        """
+        Runs the jobs of a plan made by plan(), or of a saved plan file, without walking the roots again
+        """
+        if isinstance(plan, str):
+            plan = loadPlan(plan)
+        if plan.get('kind') != 'video':
+            self.logger.error('Not a video conversion plan: {0}'.format(plan.get('kind')))
+            return
+        if plan.get('settings') != self._get_plan_settings():
+            self.logger.warning('Converter settings changed since the plan was made, the planned settings are used')
+
+        self._adopt_outputs(plan.get('adopt', []))
+        # Sources removed since the plan was made are skipped
+        self._run_jobs(job for job in plan['jobs'] if os.path.exists(job['input_file']))
+
+    def _adopt_outputs(self, adoptions):
+        # Existing outputs a plan found for sources the manifest doesn't know yet
+        if not self.manifest or not adoptions:
+            return
+        for adoption in adoptions:
+            if os.path.exists(adoption['output_file']):
+                self.manifest.record(adoption['input_file'], adoption['output_file'], settings=adoption.get('settings'))
+        self.manifest.commit()
+        self.logger.info('Adopted {0} existing outputs into the manifest'.format(len(adoptions)))
+
+    def convert_file(self, dirpath, file, output_format = None):
+        """
+        Converts a single file that was found by an external walk, such as the media pipeline
+        """
+        if not output_format:
+            output_format = self.output_ext
+        if not self.accepts_file(dirpath, file):
+            return
+        self._convert_process_file(dirpath, file, output_format)
+
+    def accepts_file(self, dirpath, file):
+        """
+        Check if a file found by an external walk, such as the media pipeline, is a conversion candidate
+        """
+        if not self.is_video_file(file):
+            return False
+        return not self.exclusion_matcher.is_file_excluded(file, os.path.join(dirpath, file))
+
+    def _convert_process_file(self, subdir, file, output_format):
+        job = self._build_job(subdir, file, output_format)
+        if job:
+            self._run_job(job)
+
+    def _build_job(self, subdir, file, output_format, entry = None, adoptions = None):
+        # Get the file path
+        file_path = os.path.join(subdir, file)
+        # Checked once per file, the debug lines below cost nothing when debug logging is off
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.logger.debug('file_path: %s', file_path)
+        # Create the output file path
+        if self.config.get('convertedFolderParentFolderPath',None):
+            target_file_path = os.path.join(self.converted_folder_path, file) + '.' + output_format
+        else:
+            target_file_path = os.path.join(subdir,self.converted_folder_name, file) + '.' + output_format
+        # Get file extension
+        extension = os.path.splitext(file)[1].lower()
+        if debug:
+            self.logger.debug('target_file_path: %s', target_file_path)
+            self.logger.debug('file extension: %s', extension)
+
+        # Check if the file is a video file and if it is already in the specified format
+        if not self.is_video_file(file_path):
+            # Log a debug message
+            if debug:
+                self.logger.debug('Skipping file: %s as it is not a video file', file_path)
+            return None
+
+        try:
+            # The stat of an entry from the walk is cached by the entry
+            source_stat = entry.stat() if entry else os.stat(file_path)
+        except OSError:
+            return None
+
+        # Check if the output file is up to date, from the manifest when there is one
+        if self.manifest:
+            # Resolution rules need the streams, the probe is kept in the metadata cache for the encode
+            streams = self._probe_source(file_path)[0] if self.resolution_encoder_profiles else None
+            profile_name = self._get_encoder_profile(file_path, streams)[0]
+            settings = self._get_conversion_settings(profile_name)
+            # A plan passes adoptions and only reads the manifest, the outputs it would adopt are collected instead
+            needs_conversion, reason = self.manifest.needs_conversion(file_path, source_stat, target_file_path, settings, record=adoptions is None)
+            if reason == OUTPUT_EXISTS and adoptions is not None:
+                adoptions.append({"input_file" : file_path, "output_file" : target_file_path, "settings" : settings})
+            if not needs_conversion:
+                if debug:
+                    self.logger.debug('Skipping file: %s (%s)', file_path, reason)
+                return None
+            if debug:
+                self.logger.debug('Converting file: %s (%s)', file_path, reason)
+        elif os.path.exists(target_file_path):
+            # Log a debug message
+            if debug:
+                self.logger.debug('Skipping file: %s as it is already converted', file_path)
+            return None
+
+        # Jobs are plain dicts so they can be saved in a plan and run later
+        return {
+            "input_file" : file_path,
+            "output_file" : target_file_path,
+            "output_format" : output_format,
+            "source_bytes" : source_stat.st_size,
+        }
+
+    def _run_job(self, job):
+        if self.job_queue:
+            self.job_queue.add_jobs([job])
+        converted, converted_bytes = self._schedule([job])
+        return converted == 1
+
+    def _reclaim_jobs(self):
+        # Jobs left running by a run that was killed are pending again, their partial outputs are removed.
+        # Jobs whose output was already in place are done, only the manifest still has to record them
+        reclaimed, finished = self.job_queue.reclaim_running(self._get_temp_file)
+        for job in finished:
+            if self.manifest:
+                self.manifest.record(job['input_file'], job['output_file'], settings=self._get_conversion_settings(job.get('encoder_profile')))
+        if finished:
+            if self.manifest:
+                self.manifest.commit()
+            self.logger.info('Found {0} video jobs finished by an earlier run that was stopped'.format(len(finished)))
+        for job in reclaimed:
+            temp_file = self._get_temp_file(job['output_file'])
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            shutil.rmtree(self._get_segment_folder(job['output_file']), ignore_errors=True)
+        if reclaimed:
+            self.logger.info('Reclaimed {0} video jobs left running by an earlier run'.format(len(reclaimed)))
+        return reclaimed
+
+    def _get_queued_jobs(self):
+        jobs = []
+        for job in self.job_queue.get_pending_jobs():
+            if os.path.exists(job['input_file']):
+                jobs.append(job)
+            else:
+                self.job_queue.mark_failed(job, 'source missing')
+        return jobs
+
+    def resume(self):
+        """
+        Runs the pending jobs of the job queue without walking the roots
+        """
+        if not self.job_queue:
+            self.logger.error('No video job queue configured')
+            return
+        self._run_jobs([])
+
+    def _get_temp_file(self, target_file_path):
+        # ffmpeg picks the container from the extension, so the temp name keeps it
+        folder, name = os.path.split(target_file_path)
+        base, extension = os.path.splitext(name)
+        return os.path.join(folder, '.{0}.partial{1}'.format(base, extension))
+
+    def _get_segment_folder(self, target_file_path):
+        # The parts of a segmented encode are kept next to the output until they are joined
+        folder, name = os.path.split(target_file_path)
+        return os.path.join(folder, '.{0}.segments'.format(os.path.splitext(name)[0]))
+
+    def cancel(self):
+        """
+        Stops the running ffmpeg processes and starts no new ones
+        """
+        self.scheduler.cancel()
+
+    def cancel_job(self, input_file):
+        """
+        Stops the encode of a single source, for example one the progress metrics show as too slow
+        """
+        return self.scheduler.cancel_job(input_file)
+
+    def get_progress(self):
+        """
+        Returns the progress of the running encodes and of the whole queue
+        """
+        return self.progress_monitor.snapshot()
+
+    def _schedule(self, jobs):
+        # Returns the number of converted videos and their source bytes
+        totals = {"converted" : 0, "bytes" : 0}
+
+        def on_finished(job, status, stderr_tail):
+            if self._finish_job(job, status, stderr_tail):
+                totals['converted'] += 1
+                totals['bytes'] += job.get('source_bytes', 0)
+
+        if self.segmented_encoding and self.segment_processes > 1:
+            # Long transcodes run one at a time with every core on their parts, the rest run side by side afterwards
+            single_jobs = []
+            for job in jobs:
+                if self.scheduler.cancel_event.is_set() or not self._encode_segmented(job, on_finished):
+                    single_jobs.append(job)
+            jobs = single_jobs
+
+        self.scheduler.run(jobs, self._build_command, on_finished)
+        return totals['converted'], totals['bytes']
+
+    def _encode_segmented(self, job, on_finished):
+        """
+        Splits a long source at keyframes, encodes the parts in parallel with the job's profile and joins them
+        with the concat demuxer. Returns False when the job should run as a single encode instead.
+        """
+        streams, profile_name, profile = self._probe_job(job)
+        if job['mode'] != 'transcode' or not job['duration'] or job['duration'] < self.segment_min_duration:
+            return False
+        segment_count = getSegmentCount(job['duration'], self.segment_processes, self.segment_min_seconds)
+        if segment_count < 2:
+            return False
+
+        # The parts and the join map the streams the single pass encode maps
+        selected = selectDefaultStreams(streams, job['output_format'])
+        if selected['video'] is None:
+            return False
+
+        file_path = job['input_file']
+        target_file_path = job['output_file']
+        segment_folder = self._get_segment_folder(target_file_path)
+        shutil.rmtree(segment_folder, ignore_errors=True)
+        os.makedirs(segment_folder)
+        try:
+            split = subprocess.run(getSplitCommand(self.ffmpeg_binary, file_path, getSplitTimes(job['duration'], segment_count), segment_folder, selected['video']),
+                                   stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            sources = listSegments(segment_folder)
+            if split.returncode != 0 or len(sources) < 2:
+                self.logger.warning('Could not split {0} at keyframes, converting it in one piece'.format(file_path))
+                return False
+
+            if self.job_queue:
+                self.job_queue.mark_running(job)
+            self.logger.info("Converting video file {0} in {1} segments{2}".format(file_path, len(sources), ' with profile ' + profile_name if profile_name else ''))
+
+            segment_jobs = []
+            for index, source in enumerate(sources):
+                segment_jobs.append({
+                    "input_file" : source,
+                    "output_file" : os.path.join(segment_folder, 'encoded_{0:04d}.{1}'.format(index, job['output_format'])),
+                    "source_bytes" : os.path.getsize(source),
+                    "duration" : probeMedia(source, self.ffprobe_binary)[1],
+                    "mode" : 'segment',
+                })
+            segment_arguments = getSegmentArguments(profile or {})
+            statuses = []
+
+            def build_segment_command(segment_job, threads):
+                return [self.ffmpeg_binary, '-y'] + PROGRESS_ARGUMENTS + ['-i', segment_job['input_file']] + segment_arguments + ['-threads', str(threads), segment_job['output_file']]
+
+            self.scheduler.run(segment_jobs, build_segment_command, lambda segment_job, status, stderr_tail: statuses.append((status, stderr_tail)),
+                               self.segment_processes, self.segment_threads)
+
+            failures = [(status, stderr_tail) for status, stderr_tail in statuses if status != 'success']
+            if failures:
+                # A failed part fails the job, a cancel that stopped or skipped parts leaves it for the next run
+                status, stderr_tail = next((failure for failure in failures if failure[0] not in ('cancelled', 'skipped')), failures[0])
+                on_finished(job, 'cancelled' if status == 'skipped' else status, stderr_tail)
+                return True
+
+            list_file = os.path.join(segment_folder, 'segments.txt')
+            writeConcatList([segment_job['output_file'] for segment_job in segment_jobs], list_file)
+            temp_file = self._get_temp_file(target_file_path)
+            concat = subprocess.run(getConcatCommand(self.ffmpeg_binary, list_file, file_path, profile or {}, temp_file, selected),
+                                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if concat.returncode != 0:
+                on_finished(job, 'failed', '\n'.join(concat.stderr.decode('utf-8', errors='replace').splitlines()[-20:]))
+                return True
+
+            # Every frame of the source has to be in the output exactly once and the output has to last as long as the
+            # source to within a frame, otherwise the video is converted in one piece
+            source_frames = countVideoFrames(file_path, self.ffprobe_binary, stream=selected['video'])
+            output_frames = countVideoFrames(temp_file, self.ffprobe_binary)
+            if not source_frames or source_frames != output_frames:
+                self.logger.warning('Segmented output of {0} has {1} frames instead of {2}, converting it in one piece'.format(file_path, output_frames, source_frames))
+                os.remove(temp_file)
+                return False
+            output_duration = probeMedia(temp_file, self.ffprobe_binary)[1]
+            if output_duration is None or abs(output_duration - job['duration']) > job['duration'] / source_frames:
+                self.logger.warning('Segmented output of {0} lasts {1}s instead of {2}s, converting it in one piece'.format(file_path, output_duration, job['duration']))
+                os.remove(temp_file)
+                return False
+
+            on_finished(job, 'success', '')
+            return True
+        finally:
+            shutil.rmtree(segment_folder, ignore_errors=True)
+
+    def _build_command(self, job, threads):
+        file_path = job['input_file']
+        target_file_path = job['output_file']
+
+        # Create the subdirectory for the converted files if it doesn't already exist, other workers may create it at the same time
+        output_folder = os.path.dirname(target_file_path)
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder, exist_ok=True)
+            self.logger.debug('Converted folder created at %s', output_folder)
+
+        # ffmpeg writes to a temp file that is renamed when the encode finished, so the output is never half written
+        # -y: temp files of stopped encodes are overwritten instead of prompting
+        # -progress: frame, fps, speed and position are written to stdout for the progress monitor
+        command = [self.ffmpeg_binary, '-y'] + PROGRESS_ARGUMENTS + ['-i', file_path]
+        temp_file = self._get_temp_file(target_file_path)
+
+        streams, profile_name, profile = self._probe_job(job)
+        # Marked after the probe, so the queue keeps the profile the output is encoded with
+        if self.job_queue:
+            self.job_queue.mark_running(job)
+        if job['mode'] == 'remux':
+            self.logger.info("Remuxing video file %s", file_path, extra=PER_FILE)
+            return command + getRemuxArguments(streams, job['output_format']) + [temp_file]
+
+        # Use ffmpeg to convert the video file to the specified format
+        self.logger.info("Converting video file %s%s", file_path, ' with profile ' + profile_name if profile_name else '', extra=PER_FILE)
+        # The streams ffmpeg would pick are mapped explicitly, a segmented encode of the same source maps the same ones
+        map_arguments = getMapArguments(selectDefaultStreams(streams, job['output_format'])) if streams else []
+        return command + map_arguments + buildEncoderArguments(profile or {}) + ['-threads', str(threads), temp_file]
+
+    def _probe_job(self, job):
+        # Reads the streams of the source and picks remux or transcode, returns (streams, profile name, profile)
+        file_path = job['input_file']
+
+        # The duration lets the progress monitor work out the percentage and ETA
+        streams, job['duration'] = self._probe_source(file_path)
+        profile_name, profile = self._get_encoder_profile(file_path, streams)
+        # The manifest records the profile the output was encoded with
+        job['encoder_profile'] = profile_name
+
+        # Copy the streams when only the container changes, a full transcode only runs when it is needed
+        remux = self.remux_when_possible and streams and canRemux(streams, job['output_format']) and allowsRemux(profile, streams)
+        job['mode'] = 'remux' if remux else 'transcode'
+        return streams, profile_name, profile
+
+    def _probe_source(self, file_path):
+        # Returns (streams, duration), from the metadata cache when there is one
+        metadata = self.metadata_cache.get_or_probe(file_path) if self.metadata_cache else None
+        if metadata:
+            return metadata['streams'], metadata['duration']
+        return probeMedia(file_path, self.ffprobe_binary)
+
+    def _get_encoder_profile(self, file_path, streams):
+        # Returns (name, profile), (None, None) when no profile applies
+        profile_name = selectProfileName(file_path, self.default_encoder_profile, self.root_encoder_profiles,
+                                         self.resolution_encoder_profiles, streams)
+        if not profile_name:
+            return None, None
+        if profile_name not in self.encoder_profiles:
+            self.logger.warning('Encoder profile not found: {0}, using ffmpeg defaults'.format(profile_name))
+            return None, None
+        return profile_name, self.encoder_profiles[profile_name]
+
+    def benchmark_profiles(self, sample_file, output_folder, profile_names = None, seconds = None, output_format = None):
+        """
+        Encodes a sample clip (optionally only its first seconds) with each encoder profile and
+        returns and logs the encoding speed in fps and the output size of each one
+        """
+        output_format = output_format or self.output_ext
+        profile_names = profile_names or sorted(self.encoder_profiles)
+        os.makedirs(output_folder, exist_ok=True)
+
+        report = []
+        for profile_name in profile_names:
+            profile = self.encoder_profiles.get(profile_name)
+            if profile is None:
+                self.logger.warning('Encoder profile not found: {0}'.format(profile_name))
+                continue
+            output_file = os.path.join(output_folder, '{0}.{1}'.format(profile_name, output_format))
+            command = [self.ffmpeg_binary, '-y', '-i', sample_file]
+            if seconds:
+                command += ['-t', str(seconds)]
+            command += buildEncoderArguments(profile) + [output_file]
+
+            started = time.perf_counter()
+            output = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            elapsed = time.perf_counter() - started
+
+            # ffmpeg reports the frames it encoded on its last status line
+            frames = re.findall(r'frame=\s*(\d+)', output.stderr.decode('utf-8', errors='replace'))
+            frame_count = int(frames[-1]) if frames else None
+            result = {
+                "profile" : profile_name,
+                "success" : output.returncode == 0,
+                "seconds" : round(elapsed, 3),
+                "frames" : frame_count,
+                "fps" : round(frame_count / elapsed, 2) if frame_count and elapsed else None,
+                "output_bytes" : os.path.getsize(output_file) if os.path.exists(output_file) else None,
+            }
+            report.append(result)
+
+            if result['success']:
+                self.logger.info('{profile}: {fps} fps, {output_bytes} bytes in {seconds}s'.format(**result))
+            else:
+                self.logger.error('{0}: encode failed'.format(profile_name))
+        return report
+
+    def _finish_job(self, job, status, stderr_tail):
+        file_path = job['input_file']
+        target_file_path = job['output_file']
+
+        temp_file = self._get_temp_file(target_file_path)
+
+        if status == 'skipped':
+            self.logger.info('Conversion cancelled before it started: {}'.format(file_path))
+            if self.job_queue:
+                self.job_queue.mark_pending(job)
+            return False
+
+        if status == 'success' and os.path.exists(temp_file):
+            os.replace(temp_file, target_file_path)
+            self.logger.info('Successfully Converted Video (%s)', job.get('mode', 'transcode'), extra=PER_FILE)
+            if self.manifest:
+                self.manifest.record(file_path, target_file_path, settings=self._get_conversion_settings(job.get('encoder_profile')))
+            if self.job_queue:
+                self.job_queue.mark_done(job)
+            return True
+
+        if status == 'timeout':
+            self.logger.error('Conversion timed out: {}'.format(file_path))
+        elif status == 'stalled':
+            self.logger.error('Conversion stalled, no progress for {0}s: {1}'.format(self.progress_monitor.stall_seconds, file_path))
+        elif status == 'cancelled':
+            self.logger.warning('Conversion cancelled: {}'.format(file_path))
+        else:
+            self.logger.error('Error while converting {0}:\n{1}'.format(file_path, stderr_tail))
+
+        # A stopped or failed ffmpeg leaves a partial output behind
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        if self.job_queue:
+            # Cancelled jobs are picked up again by the next run
+            if status == 'cancelled':
+                self.job_queue.mark_pending(job)
+            else:
+                self.job_queue.mark_failed(job, status if status != 'failed' else stderr_tail[-1000:])
+        self.logger.warning('Failed to convert file: {}'.format(file_path))
+        return False
\ No newline at end of file
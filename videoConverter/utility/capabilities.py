@@ -0,0 +1,100 @@
+import os
+import json
+import shutil
+import subprocess
+import threading
+
+# Versions of the external tools are cached on disk so short runs don't have to spawn them
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'media_management', 'capabilities.json')
+
+# Arguments that make each tool print its version
+VERSION_ARGUMENTS = {
+    'ffmpeg' : ['-version'],
+    'ffprobe' : ['-version'],
+    'heif-convert' : ['--version'],
+    'sips' : ['--help'],
+}
+
+_lock = threading.Lock()
+_memory_cache = {}
+
+
+def _load_cache(cache_file):
+    try:
+        with open(cache_file, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(cache_file, cache):
+    # Write to a temp file and rename so concurrent runs never read a half written cache
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        temp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+        with open(temp_file, 'w') as file:
+            json.dump(cache, file, indent=4)
+        os.replace(temp_file, cache_file)
+    except OSError:
+        pass
+
+
+def _run_version_command(binary_path, tool):
+    try:
+        # Tools can be configured by path, the arguments are looked up by name
+        output = subprocess.run([binary_path] + VERSION_ARGUMENTS.get(os.path.basename(tool), ['--version']),
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=30)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    for line in output.stdout.decode('utf-8', errors='replace').splitlines():
+        if line.strip():
+            return line.strip()
+    return ''
+
+
+def probe_tool(tool, cache_file=None):
+    """
+    Returns {'path', 'mtime', 'version'} for an external tool, or None if it is not installed.
+    The version command only runs when the binary path or its mtime changed since the cached probe.
+    """
+    cache_file = cache_file or DEFAULT_CACHE_FILE
+    binary_path = shutil.which(tool)
+    if not binary_path:
+        return None
+    binary_path = os.path.realpath(binary_path)
+
+    try:
+        mtime = os.stat(binary_path).st_mtime
+    except OSError:
+        return None
+
+    with _lock:
+        key = (cache_file, tool)
+        entry = _memory_cache.get(key)
+        if entry and entry['path'] == binary_path and entry['mtime'] == mtime:
+            return entry
+
+        cache = _load_cache(cache_file)
+        entry = cache.get(tool)
+        if entry and entry.get('path') == binary_path and entry.get('mtime') == mtime:
+            _memory_cache[key] = entry
+            return entry
+
+        version = _run_version_command(binary_path, tool)
+        if version is None:
+            return None
+
+        entry = {'path' : binary_path, 'mtime' : mtime, 'version' : version}
+        cache[tool] = entry
+        _save_cache(cache_file, cache)
+        _memory_cache[key] = entry
+        return entry
+
+
+def get_tool_version(tool, cache_file=None):
+    entry = probe_tool(tool, cache_file)
+    return entry['version'] if entry else None
+
+
+def is_tool_available(tool, cache_file=None):
+    return probe_tool(tool, cache_file) is not None
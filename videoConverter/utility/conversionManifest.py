@@ -0,0 +1,165 @@
+import os
+import json
+import sqlite3
+import threading
+from utility.dateTime import get_current_datetime_string as currentDateTime
+
+MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversions (
+    source_path TEXT PRIMARY KEY,
+    source_size INTEGER,
+    source_mtime_ns INTEGER,
+    output_path TEXT,
+    settings TEXT,
+    converted_date TIMESTAMP,
+    source_missing_date TIMESTAMP
+);
+"""
+
+# Writes are committed in batches instead of once per file
+COMMIT_INTERVAL = 500
+
+# Reason given for an unknown source whose output already exists, the output is adopted instead of converted
+OUTPUT_EXISTS = 'output already exists'
+
+
+class ConversionManifest:
+    """
+    SQLite record of every conversion, keyed by source path, with the size and mtime of the source,
+    the output path and the converter settings. A source only needs (re)conversion when one of those
+    changed, so skip decisions need one stat of the source and one indexed lookup, no probing of the output.
+
+    settings are the settings of every source unless a call passes the settings of its own source. Rows recorded
+    with legacy_settings (the settings of an older version) count as converted with the current ones.
+    """
+
+    def __init__(self, db_path, settings, legacy_settings=None):
+        self.db_path = db_path
+        self.settings = json.dumps(settings, sort_keys=True)
+        self.legacy_settings = json.dumps(legacy_settings, sort_keys=True) if legacy_settings is not None else None
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.conn.executescript(MANIFEST_SCHEMA)
+        self.conn.commit()
+        self.pending_writes = 0
+        # Sources found by the current run, used to flag outputs whose source went away
+        self.seen_sources = set()
+
+    def begin_run(self):
+        with self.lock:
+            self.seen_sources = set()
+
+    def _get_settings(self, settings):
+        return self.settings if settings is None else json.dumps(settings, sort_keys=True)
+
+    def needs_conversion(self, source_path, source_stat, output_path, settings=None, record=True):
+        """
+        Returns (needs_conversion, reason). Unknown sources whose output already exists are adopted
+        into the manifest, so switching the manifest on doesn't reconvert everything.
+        With record False nothing is written, such outputs are only reported with the reason OUTPUT_EXISTS.
+        """
+        settings = self._get_settings(settings)
+        with self.lock:
+            if record:
+                self.seen_sources.add(source_path)
+            row = self.conn.execute("SELECT source_size, source_mtime_ns, output_path, settings, source_missing_date FROM conversions WHERE source_path=?", (source_path,)).fetchone()
+
+            if not row:
+                if os.path.exists(output_path):
+                    if record:
+                        self._record(source_path, source_stat, output_path, settings)
+                    return False, OUTPUT_EXISTS
+                return True, 'not converted yet'
+
+            size, mtime_ns, recorded_output_path, recorded_settings, missing_date = row
+            if missing_date and record:
+                # The source came back
+                self.conn.execute("UPDATE conversions SET source_missing_date=NULL WHERE source_path=?", (source_path,))
+                self._count_write()
+
+            if size != source_stat.st_size or mtime_ns != source_stat.st_mtime_ns:
+                return True, 'source changed since it was converted'
+            if recorded_output_path != output_path:
+                return True, 'output path changed'
+            if recorded_settings != settings and recorded_settings != self.legacy_settings:
+                return True, 'converter settings changed'
+            return False, 'already converted'
+
+    def record(self, source_path, output_path, source_stat=None, settings=None):
+        """
+        Records a finished conversion
+        """
+        settings = self._get_settings(settings)
+        if source_stat is None:
+            try:
+                source_stat = os.stat(source_path)
+            except OSError:
+                return
+        with self.lock:
+            self._record(source_path, source_stat, output_path, settings)
+
+    def _record(self, source_path, source_stat, output_path, settings):
+        self.conn.execute("""INSERT OR REPLACE INTO conversions (source_path, source_size, source_mtime_ns, output_path, settings, converted_date, source_missing_date)
+                             VALUES (?, ?, ?, ?, ?, ?, NULL)""",
+                          (source_path, source_stat.st_size, source_stat.st_mtime_ns, output_path, settings, currentDateTime()))
+        self._count_write()
+
+    def _count_write(self):
+        self.pending_writes += 1
+        if self.pending_writes >= COMMIT_INTERVAL:
+            self.conn.commit()
+            self.pending_writes = 0
+
+    def forget_outputs_under(self, folder_path):
+        """
+        Removes the records of every output inside a folder, used when converted folders are deleted
+        """
+        prefix = folder_path.rstrip(os.sep) + os.sep
+        with self.lock:
+            self.conn.execute("DELETE FROM conversions WHERE substr(output_path, 1, ?) = ?", (len(prefix), prefix))
+            self.conn.commit()
+
+    def forget_output(self, output_path):
+        """
+        Removes the record of a single output
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM conversions WHERE output_path=?", (output_path,))
+            self._count_write()
+
+    def flag_missing_sources(self, root_directories):
+        """
+        Flags the records under the roots whose source was not found by this run and returns their
+        (source_path, output_path) so the outputs can be cleaned up
+        """
+        flagged = []
+        with self.lock:
+            for root in root_directories:
+                if not root:
+                    continue
+                prefix = root.rstrip(os.sep) + os.sep
+                rows = self.conn.execute("SELECT source_path, output_path FROM conversions WHERE source_missing_date IS NULL AND substr(source_path, 1, ?) = ?",
+                                         (len(prefix), prefix)).fetchall()
+                missing = [row for row in rows if row[0] not in self.seen_sources]
+                self.conn.executemany("UPDATE conversions SET source_missing_date=? WHERE source_path=?",
+                                      [(currentDateTime(), source_path) for source_path, output_path in missing])
+                flagged.extend(missing)
+            self.conn.commit()
+        return flagged
+
+    def get_orphaned_outputs(self):
+        """
+        Returns (source_path, output_path, source_missing_date) of every output whose source is gone
+        """
+        with self.lock:
+            return self.conn.execute("SELECT source_path, output_path, source_missing_date FROM conversions WHERE source_missing_date IS NOT NULL").fetchall()
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.pending_writes = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
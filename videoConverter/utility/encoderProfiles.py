@@ -0,0 +1,73 @@
+import os
+
+# Profile keys and the ffmpeg output option each one sets
+_PROFILE_OPTIONS = (
+    ('videoCodec', '-c:v'),
+    ('preset', '-preset'),
+    ('crf', '-crf'),
+    ('pixelFormat', '-pix_fmt'),
+    ('tag', '-tag:v'),
+)
+
+
+def build_encoder_arguments(profile):
+    """
+    Returns the ffmpeg output arguments of an encoder profile. The frame rate and resolution are never set,
+    so the output keeps those of the source.
+
+    Profile keys: videoCodec, preset, crf, pixelFormat, tag, audio ('copy', 'none' or an encoder such as 'aac'),
+    audioBitrate and extraArguments (a list passed to ffmpeg as is).
+    """
+    arguments = []
+    for key, option in _PROFILE_OPTIONS:
+        if profile.get(key) not in (None, ''):
+            arguments += [option, str(profile[key])]
+
+    audio = profile.get('audio', None)
+    if audio == 'none':
+        arguments += ['-an']
+    elif audio:
+        arguments += ['-c:a', audio]
+        if audio != 'copy' and profile.get('audioBitrate'):
+            arguments += ['-b:a', str(profile['audioBitrate'])]
+
+    arguments += [str(argument) for argument in profile.get('extraArguments', [])]
+    return arguments
+
+
+def get_video_height(streams):
+    heights = [stream.get('height') or 0 for stream in streams or [] if stream.get('codec_type') == 'video']
+    return max(heights) if heights else None
+
+
+def select_profile_name(file_path, default_profile, root_profiles=None, resolution_profiles=None, streams=None):
+    """
+    Picks the profile of a source: the profile of the deepest root it lives in, then the first resolution
+    rule whose minHeight the source reaches (rules are checked from the highest minHeight down), then the default
+    """
+    best_root = None
+    for root, profile_name in (root_profiles or {}).items():
+        prefix = os.path.normpath(root) + os.sep
+        if file_path.startswith(prefix) and (best_root is None or len(prefix) > len(best_root[0])):
+            best_root = (prefix, profile_name)
+    if best_root:
+        return best_root[1]
+
+    height = get_video_height(streams)
+    if height and resolution_profiles:
+        for rule in sorted(resolution_profiles, key=lambda rule: rule.get('minHeight', 0), reverse=True):
+            if height >= rule.get('minHeight', 0):
+                return rule.get('profile')
+
+    return default_profile
+
+
+def allows_remux(profile, streams):
+    """
+    Check if the profile accepts the source video as it is. 'remuxCodecs' lists the source video codecs
+    that may be copied, when it is missing any codec the container can hold is copied.
+    """
+    remux_codecs = profile.get('remuxCodecs', None) if profile else None
+    if remux_codecs is None:
+        return True
+    return all(stream.get('codec_name') in remux_codecs for stream in streams if stream.get('codec_type') == 'video')
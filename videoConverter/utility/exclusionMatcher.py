@@ -0,0 +1,130 @@
+import os
+import re
+import fnmatch
+
+# Marks the end of an excluded path inside the path trie
+_EXCLUDED = object()
+
+
+class ExclusionMatcher:
+    """
+    Compiled form of the 'exclusions' config. It is built once per run and answers
+    every file and folder check without rebuilding lists or calling os.path.commonpath.
+
+    Supported keys:
+        extensions    - file extensions, with or without the leading dot, case insensitive
+        folderNames   - folder names, the whole subtree is pruned
+        fileNames     - exact file names
+        paths         - absolute paths, everything under them is excluded
+        globPatterns  - optional fnmatch patterns matched against file and folder names
+        regexPatterns - optional regular expressions searched in the full path
+    """
+
+    def __init__(self, exclusions=None, extra_folder_names=()):
+        exclusions = exclusions or {}
+
+        self.extensions = frozenset(ext.lower().lstrip('.') for ext in exclusions.get('extensions', []) if ext)
+        self.folder_names = frozenset(list(exclusions.get('folderNames', [])) + [name for name in extra_folder_names if name])
+        self.file_names = frozenset(exclusions.get('fileNames', []))
+        self.path_trie = self._build_path_trie(exclusions.get('paths', []))
+        self.name_pattern = self._compile_patterns([fnmatch.translate(pattern) for pattern in exclusions.get('globPatterns', [])])
+        self.path_pattern = self._compile_patterns(exclusions.get('regexPatterns', []))
+
+        # Paths only have to be built for the checks when there are path based rules
+        self.needs_path = bool(self.path_trie or self.path_pattern)
+
+    def _build_path_trie(self, paths):
+        trie = {}
+        for path in paths:
+            if not path:
+                continue
+            node = trie
+            for part in self._split_path(path):
+                node = node.setdefault(part, {})
+            node[_EXCLUDED] = True
+        return trie
+
+    def _compile_patterns(self, patterns):
+        patterns = [pattern for pattern in patterns if pattern]
+        if not patterns:
+            return None
+        return re.compile('|'.join('(?:{0})'.format(pattern) for pattern in patterns))
+
+    def _split_path(self, path):
+        if not os.path.isabs(path):
+            path = os.path.abspath(path)
+        return os.path.normcase(os.path.normpath(path)).split(os.sep)
+
+    def is_path_excluded(self, path):
+        """
+        Check if the path is one of the excluded paths or lives underneath one
+        """
+        if not self.path_trie:
+            return False
+
+        node = self.path_trie
+        for part in self._split_path(path):
+            node = node.get(part)
+            if node is None:
+                return False
+            if _EXCLUDED in node:
+                return True
+        return False
+
+    def is_extension_excluded(self, name):
+        if not self.extensions:
+            return False
+        base, dot, extension = name.rpartition('.')
+        return bool(dot) and extension.lower() in self.extensions
+
+    def is_file_excluded(self, name, path=None):
+        """
+        Check if a file should be skipped. The path is only needed for path and regex exclusions.
+        """
+        if name in self.file_names:
+            return True
+        if self.is_extension_excluded(name):
+            return True
+        if self.name_pattern and self.name_pattern.match(name):
+            return True
+        if path:
+            if self.path_pattern and self.path_pattern.search(path):
+                return True
+            if self.is_path_excluded(path):
+                return True
+        return False
+
+    def is_dir_excluded(self, name, path=None):
+        """
+        Check if a folder and its whole subtree should be skipped
+        """
+        if name in self.folder_names:
+            return True
+        if self.name_pattern and self.name_pattern.match(name):
+            return True
+        if path:
+            if self.path_pattern and self.path_pattern.search(path):
+                return True
+            if self.is_path_excluded(path):
+                return True
+        return False
+
+    def prune_dirnames(self, dirpath, dirnames):
+        """
+        Removes excluded folders from an os.walk dirnames list in place so they are never descended into
+        """
+        if self.needs_path:
+            dirnames[:] = [name for name in dirnames if not self.is_dir_excluded(name, os.path.join(dirpath, name))]
+        else:
+            dirnames[:] = [name for name in dirnames if not self.is_dir_excluded(name)]
+        return dirnames
+
+    def filter_filenames(self, dirpath, filenames):
+        """
+        Removes excluded files from an os.walk filenames list in place
+        """
+        if self.needs_path:
+            filenames[:] = [name for name in filenames if not self.is_file_excluded(name, os.path.join(dirpath, name))]
+        else:
+            filenames[:] = [name for name in filenames if not self.is_file_excluded(name)]
+        return filenames
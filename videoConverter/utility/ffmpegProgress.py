@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import threading
+
+# Arguments that make ffmpeg write key=value progress blocks to stdout instead of its status line
+PROGRESS_ARGUMENTS = ['-progress', 'pipe:1', '-nostats']
+
+
+def parse_out_time(progress):
+    # out_time_us is in microseconds, older ffmpeg versions write the same value as out_time_ms
+    for key in ('out_time_us', 'out_time_ms'):
+        try:
+            return int(progress[key]) / 1000000.0
+        except (KeyError, ValueError):
+            continue
+    return None
+
+
+def parse_speed(value):
+    # speed=1.23x, or N/A at the start
+    try:
+        return float(value.rstrip('x'))
+    except (AttributeError, ValueError):
+        return None
+
+
+class ProgressMonitor:
+    """
+    Collects the progress of the running ffmpeg jobs, logs it at most every log_interval seconds,
+    writes it to a metrics json file and finds jobs whose output stopped advancing for stall_seconds.
+    """
+
+    def __init__(self, logger, metrics_file=None, log_interval=30, stall_seconds=None):
+        self.logger = logger
+        self.metrics_file = metrics_file or None
+        self.log_interval = log_interval
+        self.stall_seconds = stall_seconds or None
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.started = time.monotonic()
+        self.last_report = 0.0
+        self.total_jobs = 0
+        self.total_bytes = 0
+        self.finished_jobs = 0
+        self.finished_bytes = 0
+        self.failed_jobs = 0
+
+    def begin(self, jobs):
+        with self.lock:
+            # Runs that overlap (such as the media pipeline's single job runs) add to the running totals
+            if not self.jobs:
+                self.started = time.monotonic()
+                self.last_report = self.started
+                self.total_jobs = self.total_bytes = 0
+                self.finished_jobs = self.finished_bytes = self.failed_jobs = 0
+            self.total_jobs += len(jobs)
+            self.total_bytes += sum(job.get('source_bytes', 0) for job in jobs)
+
+    def job_started(self, job):
+        now = time.monotonic()
+        with self.lock:
+            self.jobs[job['input_file']] = {"job" : job, "started" : now, "last_advance" : now, "progress" : {}, "out_time" : None}
+
+    def read_progress(self, job, stream):
+        """
+        Reads the progress blocks of a job from ffmpeg's stdout until it closes, runs on its own thread
+        """
+        block = {}
+        for raw_line in stream:
+            key, separator, value = raw_line.decode('utf-8', errors='replace').strip().partition('=')
+            if not separator:
+                continue
+            block[key] = value
+            # Every block ends with progress=continue or progress=end
+            if key == 'progress':
+                self._update(job, block)
+                block = {}
+
+    def _update(self, job, block):
+        now = time.monotonic()
+        out_time = parse_out_time(block)
+        with self.lock:
+            entry = self.jobs.get(job['input_file'])
+            if not entry:
+                return
+            if out_time is not None and (entry['out_time'] is None or out_time > entry['out_time']):
+                entry['out_time'] = out_time
+                entry['last_advance'] = now
+            entry['progress'] = block
+
+    def job_finished(self, job, status):
+        with self.lock:
+            self.jobs.pop(job['input_file'], None)
+            self.finished_jobs += 1
+            self.finished_bytes += job.get('source_bytes', 0)
+            if status != 'success':
+                self.failed_jobs += 1
+
+    def is_stalled(self, job):
+        if not self.stall_seconds:
+            return False
+        with self.lock:
+            entry = self.jobs.get(job['input_file'])
+            return bool(entry) and time.monotonic() - entry['last_advance'] > self.stall_seconds
+
+    def snapshot(self):
+        """
+        Progress of every running job and of the whole queue, with the ETAs
+        """
+        now = time.monotonic()
+        with self.lock:
+            running = []
+            done_bytes = float(self.finished_bytes)
+            for input_file, entry in self.jobs.items():
+                job = entry['job']
+                progress = entry['progress']
+                duration = job.get('duration')
+                out_time = entry['out_time']
+                speed = parse_speed(progress.get('speed'))
+
+                fraction = min(out_time / duration, 1.0) if duration and out_time is not None else None
+                if fraction is not None:
+                    done_bytes += fraction * job.get('source_bytes', 0)
+
+                eta = None
+                if duration and out_time is not None and speed:
+                    eta = max(duration - out_time, 0) / speed
+                running.append({
+                    "input_file" : input_file,
+                    "mode" : job.get('mode'),
+                    "frame" : progress.get('frame'),
+                    "fps" : progress.get('fps'),
+                    "speed" : progress.get('speed'),
+                    "out_time" : progress.get('out_time'),
+                    "percent" : round(fraction * 100, 1) if fraction is not None else None,
+                    "eta_seconds" : round(eta) if eta is not None else None,
+                    "seconds_since_progress" : round(now - entry['last_advance'], 1),
+                    "elapsed_seconds" : round(now - entry['started'], 1),
+                })
+
+            elapsed = now - self.started
+            # The queue ETA comes from the bytes of source converted so far, partly finished jobs included
+            rate = done_bytes / elapsed if elapsed > 0 else 0
+            remaining_bytes = max(self.total_bytes - done_bytes, 0)
+            return {
+                "updated" : time.strftime('%Y-%m-%d %H:%M:%S'),
+                "elapsed_seconds" : round(elapsed, 1),
+                "total_jobs" : self.total_jobs,
+                "finished_jobs" : self.finished_jobs,
+                "failed_jobs" : self.failed_jobs,
+                "total_bytes" : self.total_bytes,
+                "done_bytes" : int(done_bytes),
+                "mb_per_second" : round(rate / (1024 * 1024), 2),
+                "eta_seconds" : round(remaining_bytes / rate) if rate else None,
+                "running" : running,
+            }
+
+    def report(self, force=False):
+        """
+        Logs the progress and writes the metrics file, at most once every log_interval seconds
+        """
+        now = time.monotonic()
+        if not force and now - self.last_report < self.log_interval:
+            return
+        self.last_report = now
+        snapshot = self.snapshot()
+
+        for job in snapshot['running']:
+            self.logger.info('%s: frame %s, %s fps, speed %s, at %s (%s%%, eta %ss)', job['input_file'], job['frame'], job['fps'],
+                             job['speed'], job['out_time'], job['percent'], job['eta_seconds'])
+        self.logger.info('Video queue: %d/%d jobs finished (%d failed), %.2f MB/s, eta %ss', snapshot['finished_jobs'], snapshot['total_jobs'],
+                         snapshot['failed_jobs'], snapshot['mb_per_second'], snapshot['eta_seconds'])
+
+        if self.metrics_file:
+            try:
+                temp_file = '{0}.{1}.tmp'.format(self.metrics_file, os.getpid())
+                with open(temp_file, 'w') as file:
+                    json.dump(snapshot, file, indent=4)
+                os.replace(temp_file, self.metrics_file)
+            except OSError as e:
+                self.logger.warning('Could not write the progress metrics file %s: %s', self.metrics_file, e)
@@ -0,0 +1,172 @@
+import os
+import time
+import signal
+import tempfile
+import threading
+import subprocess
+
+# How many lines of ffmpeg's stderr are logged when a job fails
+STDERR_TAIL_LINES = 20
+
+
+class FfmpegJobScheduler:
+    """
+    Runs up to process_count ffmpeg processes at once. Each one gets an even share of the cores
+    through -threads, so the encodes together use the whole machine without oversubscribing it.
+    The largest jobs start first so the short ones fill the gaps at the end.
+
+    Jobs that run longer than timeout seconds are killed. cancel() stops every running job
+    and starts no new ones, cancel_job() stops a single one.
+
+    With a progress monitor the commands are expected to write ffmpeg -progress blocks to stdout,
+    which are read on a thread per job. Jobs the monitor finds stalled are killed.
+    """
+
+    def __init__(self, logger, process_count=1, threads_per_job=None, timeout=None, poll_interval=0.2, monitor=None):
+        self.logger = logger
+        self.process_count = max(1, process_count or 1)
+        cpu_count = os.cpu_count() or 1
+        self.threads_per_job = threads_per_job or max(1, cpu_count // self.process_count)
+        self.timeout = timeout or None
+        self.poll_interval = poll_interval
+        self.cancel_event = threading.Event()
+        self.running_lock = threading.Lock()
+        self.running = {}
+        self.cancelled_jobs = set()
+        self.monitor = monitor
+
+    def reset(self):
+        # Allows new runs after a cancel
+        self.cancel_event.clear()
+
+    def cancel(self):
+        self.cancel_event.set()
+        with self.running_lock:
+            processes = list(self.running.values())
+        for process in processes:
+            self._stop_process(process)
+
+    def cancel_job(self, input_file):
+        """
+        Stops the running job of a source, returns False when it is not running
+        """
+        with self.running_lock:
+            process = self.running.get(input_file)
+            if process:
+                self.cancelled_jobs.add(input_file)
+        if not process:
+            return False
+        self._stop_process(process)
+        return True
+
+    def run(self, jobs, build_command, on_finished, process_count=None, threads_per_job=None):
+        """
+        Runs the jobs, build_command(job, threads) returns the ffmpeg arguments of a job and
+        on_finished(job, status, stderr_tail) is called with 'success', 'failed', 'timeout', 'cancelled'
+        or 'skipped' for jobs that were never started because of a cancel.
+        process_count and threads_per_job override the scheduler's own for this run.
+        """
+        process_count = process_count or self.process_count
+        threads_per_job = threads_per_job or self.threads_per_job
+        # Sorted smallest to largest so pop() starts the largest first, jobs without a size go last
+        queued = sorted(jobs, key=lambda job: job.get('source_bytes', 0))
+        active = []
+        if self.monitor:
+            self.monitor.begin(queued)
+
+        try:
+            while queued or active:
+                while queued and len(active) < process_count and not self.cancel_event.is_set():
+                    job = queued.pop()
+                    active.append(self._start(job, build_command(job, threads_per_job)))
+
+                if self.cancel_event.is_set():
+                    for job in reversed(queued):
+                        on_finished(job, 'skipped', '')
+                    queued = []
+
+                time.sleep(self.poll_interval if active else 0)
+                still_active = []
+                for entry in active:
+                    status = self._poll(entry)
+                    if status:
+                        self._finish(entry, status, on_finished)
+                    else:
+                        still_active.append(entry)
+                active = still_active
+
+                if self.monitor:
+                    self.monitor.report()
+        except BaseException:
+            # Interrupted (for example ctrl-c), no ffmpeg process is left running
+            for entry in active:
+                self._stop_process(entry['process'])
+                self._finish(entry, 'cancelled', on_finished)
+            raise
+        finally:
+            if self.monitor:
+                self.monitor.report(force=True)
+
+    def _start(self, job, command):
+        self.logger.debug('Running: %s', ' '.join(command))
+        stderr_file = tempfile.TemporaryFile()
+        process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE if self.monitor else subprocess.DEVNULL, stderr=stderr_file)
+        with self.running_lock:
+            self.running[job['input_file']] = process
+
+        reader = None
+        if self.monitor:
+            self.monitor.job_started(job)
+            reader = threading.Thread(target=self.monitor.read_progress, args=(job, process.stdout), daemon=True)
+            reader.start()
+        return {"job" : job, "process" : process, "stderr_file" : stderr_file, "started" : time.monotonic(), "reader" : reader}
+
+    def _poll(self, entry):
+        process = entry['process']
+        returncode = process.poll()
+        if returncode is not None:
+            if entry['job']['input_file'] in self.cancelled_jobs:
+                return 'cancelled'
+            if self.cancel_event.is_set() and returncode != 0:
+                return 'cancelled'
+            return 'success' if returncode == 0 else 'failed'
+        if self.cancel_event.is_set():
+            self._stop_process(process)
+            return 'cancelled'
+        if self.timeout and time.monotonic() - entry['started'] > self.timeout:
+            self._stop_process(process)
+            return 'timeout'
+        if self.monitor and self.monitor.is_stalled(entry['job']):
+            self._stop_process(process)
+            return 'stalled'
+        return None
+
+    def _stop_process(self, process):
+        if process.poll() is not None:
+            return
+        try:
+            # ffmpeg stops cleanly on SIGINT, it is killed if it doesn't exit in time
+            process.send_signal(signal.SIGINT)
+            process.wait(timeout=5)
+        except (OSError, ValueError, subprocess.TimeoutExpired):
+            process.kill()
+            process.wait()
+
+    def _finish(self, entry, status, on_finished):
+        process = entry['process']
+        with self.running_lock:
+            self.running.pop(entry['job']['input_file'], None)
+            self.cancelled_jobs.discard(entry['job']['input_file'])
+        process.wait()
+        if entry['reader']:
+            entry['reader'].join()
+            process.stdout.close()
+            self.monitor.job_finished(entry['job'], status)
+
+        stderr_tail = ''
+        if status != 'success':
+            entry['stderr_file'].seek(0)
+            lines = entry['stderr_file'].read().decode('utf-8', errors='replace').splitlines()
+            stderr_tail = '\n'.join(lines[-STDERR_TAIL_LINES:])
+        entry['stderr_file'].close()
+        on_finished(entry['job'], status, stderr_tail)
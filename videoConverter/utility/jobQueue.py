@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from utility.dateTime import get_current_datetime_string as currentDateTime
+
+QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    input_file TEXT PRIMARY KEY,
+    output_file TEXT,
+    job TEXT,
+    state TEXT,
+    attempts INTEGER DEFAULT 0,
+    host TEXT,
+    pid INTEGER,
+    error TEXT,
+    started REAL,
+    updated_date TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+"""
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        # The pid exists but belongs to someone else
+        return True
+    return True
+
+
+class VideoJobQueue:
+    """
+    SQLite record of every video job and its state (pending, running, done, failed), so a run that was
+    interrupted can be resumed. Jobs left running by a process that is gone are reclaimed as pending,
+    or as done when their output was already in place.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.host = socket.gethostname()
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.conn.executescript(QUEUE_SCHEMA)
+        # Queues made by an older version have no start time
+        if 'started' not in [row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")]:
+            self.conn.execute("ALTER TABLE jobs ADD COLUMN started REAL")
+        self.conn.commit()
+
+    def reclaim_running(self, get_temp_file):
+        """
+        Handles the jobs left running by a process that no longer exists and returns (pending jobs, done jobs).
+        A job whose temp file (get_temp_file(output_file)) is gone and whose output was written after the job
+        started was finished before the process died, it is marked done. Every other job is pending again.
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT job, host, pid, started FROM jobs WHERE state=?", (RUNNING,)).fetchall()
+            pending = []
+            done = []
+            for job, host, pid, started in rows:
+                # Jobs of another host can't be checked, they are only reclaimed by that host
+                if host != self.host or (pid and _is_process_alive(pid)):
+                    continue
+                job = json.loads(job)
+                output_file = job['output_file']
+                try:
+                    finished = (started is not None and not os.path.exists(get_temp_file(output_file))
+                                and os.path.getmtime(output_file) >= started)
+                except OSError:
+                    finished = False
+                (done if finished else pending).append(job)
+            self.conn.executemany("UPDATE jobs SET state=?, pid=NULL, updated_date=? WHERE input_file=?",
+                                  [(PENDING, currentDateTime(), job['input_file']) for job in pending]
+                                  + [(DONE, currentDateTime(), job['input_file']) for job in done])
+            self.conn.commit()
+        return pending, done
+
+    def add_jobs(self, jobs):
+        """
+        Queues the jobs as pending, jobs that are running in a live process are left alone. Returns the number queued.
+        """
+        # The walk behind the jobs runs before the lock is taken
+        jobs = list(jobs)
+        count = 0
+        with self.lock:
+            for job in jobs:
+                cursor = self.conn.execute("""INSERT INTO jobs (input_file, output_file, job, state, updated_date) VALUES (?, ?, ?, ?, ?)
+                                              ON CONFLICT(input_file) DO UPDATE SET output_file=excluded.output_file, job=excluded.job,
+                                              state=excluded.state, error=NULL, updated_date=excluded.updated_date WHERE jobs.state != ?""",
+                                           (job['input_file'], job['output_file'], json.dumps(job), PENDING, currentDateTime(), RUNNING))
+                count += cursor.rowcount
+            self.conn.commit()
+        return count
+
+    def get_pending_jobs(self):
+        with self.lock:
+            return [json.loads(job) for (job,) in self.conn.execute("SELECT job FROM jobs WHERE state=?", (PENDING,)).fetchall()]
+
+    def mark_running(self, job):
+        # The job is saved again with what was probed for it, such as its encoder profile
+        self._set_state(job, RUNNING, pid=os.getpid(), attempt=True, started=time.time(), saved_job=json.dumps(job))
+
+    def mark_done(self, job):
+        self._set_state(job, DONE)
+
+    def mark_failed(self, job, error=None):
+        self._set_state(job, FAILED, error=error)
+
+    def mark_pending(self, job):
+        self._set_state(job, PENDING)
+
+    def _set_state(self, job, state, pid=None, error=None, attempt=False, started=None, saved_job=None):
+        with self.lock:
+            self.conn.execute("""UPDATE jobs SET state=?, host=?, pid=?, error=?, attempts=attempts+?, updated_date=?,
+                                 started=COALESCE(?, started), job=COALESCE(?, job) WHERE input_file=?""",
+                              (state, self.host, pid, error, 1 if attempt else 0, currentDateTime(), started, saved_job, job['input_file']))
+            self.conn.commit()
+
+    def get_counts(self):
+        """
+        Returns the number of jobs in each state
+        """
+        with self.lock:
+            return dict(self.conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
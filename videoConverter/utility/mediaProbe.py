@@ -0,0 +1,131 @@
+import json
+import subprocess
+
+# Codecs each container can hold without re-encoding, by codec type
+REMUX_COMPATIBLE_CODECS = {
+    'mp4' : {
+        'video' : {'h264', 'hevc', 'av1', 'mpeg4'},
+        'audio' : {'aac', 'mp3', 'alac', 'ac3', 'eac3'},
+        'subtitle' : {'mov_text'},
+    },
+    'mov' : {
+        'video' : {'h264', 'hevc', 'mpeg4', 'prores', 'mjpeg'},
+        'audio' : {'aac', 'mp3', 'alac', 'ac3', 'eac3', 'pcm_s16le', 'pcm_s24le'},
+        'subtitle' : {'mov_text'},
+    },
+    'mkv' : {
+        'video' : {'h264', 'hevc', 'av1', 'vp8', 'vp9', 'mpeg4', 'mpeg2video'},
+        'audio' : {'aac', 'mp3', 'opus', 'vorbis', 'flac', 'ac3', 'eac3', 'dts', 'pcm_s16le', 'pcm_s24le'},
+        'subtitle' : {'subrip', 'ass', 'webvtt', 'hdmv_pgs_subtitle', 'dvd_subtitle'},
+    },
+    'webm' : {
+        'video' : {'vp8', 'vp9', 'av1'},
+        'audio' : {'opus', 'vorbis'},
+        'subtitle' : {'webvtt'},
+    },
+}
+REMUX_COMPATIBLE_CODECS['m4v'] = REMUX_COMPATIBLE_CODECS['mp4']
+
+# Stream types that are left out of the output, such as camera timecode tracks
+IGNORED_STREAM_TYPES = ('data', 'attachment')
+
+# Subtitle codecs stored as text, the only ones ffmpeg picks by default for the containers below
+TEXT_SUBTITLE_CODECS = {'subrip', 'srt', 'ass', 'ssa', 'webvtt', 'mov_text', 'text'}
+TEXT_SUBTITLE_CONTAINERS = ('mp4', 'm4v', 'mov', 'mkv', 'webm')
+
+
+def probe_media(file_path, ffprobe_binary='ffprobe', timeout=60):
+    """
+    Returns (streams, duration in seconds) of a media file, streams is a list of
+    {'index', 'codec_type', 'codec_name', 'width', 'height', 'channels'}. (None, None) when ffprobe is missing or can't read the file.
+    """
+    command = [ffprobe_binary, '-v', 'error', '-show_entries', 'stream=index,codec_type,codec_name,width,height,channels:format=duration',
+               '-of', 'json', file_path]
+    try:
+        output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=timeout, check=True)
+        info = json.loads(output.stdout.decode('utf-8', errors='replace'))
+    except (OSError, ValueError, subprocess.SubprocessError):
+        return None, None
+
+    try:
+        duration = float(info.get('format', {}).get('duration'))
+    except (TypeError, ValueError):
+        duration = None
+    return info.get('streams', []), duration
+
+
+def probe_streams(file_path, ffprobe_binary='ffprobe', timeout=60):
+    """
+    Returns the streams of a media file, or None when ffprobe is missing or can't read the file
+    """
+    return probe_media(file_path, ffprobe_binary, timeout)[0]
+
+
+def can_remux(streams, container):
+    """
+    Check if every audio, video and subtitle stream can be copied into the container as is
+    """
+    compatible = REMUX_COMPATIBLE_CODECS.get(container.lower())
+    if not compatible or not streams:
+        return False
+
+    has_video = False
+    for stream in streams:
+        codec_type = stream.get('codec_type')
+        if codec_type in IGNORED_STREAM_TYPES:
+            continue
+        if stream.get('codec_name') not in compatible.get(codec_type, ()):
+            return False
+        has_video = has_video or codec_type == 'video'
+    return has_video
+
+
+def select_default_streams(streams, container):
+    """
+    Returns {'video', 'audio', 'subtitle'} with the index of the stream ffmpeg picks by default for each type, or None:
+    the video with the most pixels, the audio with the most channels (the first on a tie) and the first text subtitle
+    when the container takes subtitles. Transcodes map these explicitly, so a segmented encode gets the same streams.
+    """
+    selected = {"video" : None, "audio" : None, "subtitle" : None}
+    best = {"video" : -1, "audio" : -1}
+    for stream in streams or []:
+        codec_type = stream.get('codec_type')
+        if codec_type == 'video':
+            score = (stream.get('width') or 0) * (stream.get('height') or 0)
+        elif codec_type == 'audio':
+            score = stream.get('channels') or 0
+        elif codec_type == 'subtitle':
+            if selected['subtitle'] is None and container.lower() in TEXT_SUBTITLE_CONTAINERS and stream.get('codec_name') in TEXT_SUBTITLE_CODECS:
+                selected['subtitle'] = stream['index']
+            continue
+        else:
+            continue
+        if score > best[codec_type]:
+            best[codec_type] = score
+            selected[codec_type] = stream['index']
+    return selected
+
+
+def get_map_arguments(selected, input_index=0, codec_types=('video', 'audio', 'subtitle')):
+    # -map options of the selected streams of one input
+    arguments = []
+    for codec_type in codec_types:
+        if selected.get(codec_type) is not None:
+            arguments += ['-map', '{0}:{1}'.format(input_index, selected[codec_type])]
+    return arguments
+
+
+def get_remux_arguments(streams, container):
+    """
+    Output arguments that copy the streams into the container
+    """
+    arguments = []
+    # Every checked stream is mapped, not only the one video and audio stream ffmpeg picks by default
+    for stream in streams:
+        if stream.get('codec_type') not in IGNORED_STREAM_TYPES:
+            arguments += ['-map', '0:{0}'.format(stream['index'])]
+    arguments += ['-c', 'copy']
+    # Apple players only play HEVC in mp4 and mov with the hvc1 tag
+    if container.lower() in ('mp4', 'm4v', 'mov') and any(stream.get('codec_name') == 'hevc' for stream in streams):
+        arguments += ['-tag:v', 'hvc1']
+    return arguments
@@ -0,0 +1,220 @@
+import os
+import json
+import sqlite3
+import mimetypes
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from utility.dateTime import get_current_datetime_string as currentDateTime
+
+METADATA_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    file_type TEXT,
+    kind TEXT,
+    codec TEXT,
+    width INTEGER,
+    height INTEGER,
+    duration REAL,
+    capture_date TEXT,
+    streams TEXT,
+    probed_date TIMESTAMP
+);
+"""
+
+COLUMNS = ('path', 'size', 'mtime_ns', 'file_type', 'kind', 'codec', 'width', 'height', 'duration', 'capture_date', 'streams', 'probed_date')
+
+# EXIF tags of the capture date: DateTimeOriginal in the Exif IFD, DateTime in the main IFD
+_EXIF_IFD = 0x8769
+_DATE_TIME_ORIGINAL = 36867
+_DATE_TIME = 306
+
+
+def _probe_video(path, ffprobe_binary):
+    command = [ffprobe_binary, '-v', 'error', '-show_entries',
+               'stream=index,codec_type,codec_name,width,height,channels:format=duration:format_tags=creation_time', '-of', 'json', path]
+    try:
+        output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=60, check=True)
+        info = json.loads(output.stdout.decode('utf-8', errors='replace'))
+    except (OSError, ValueError, subprocess.SubprocessError):
+        return None
+
+    streams = info.get('streams', [])
+    video_streams = [stream for stream in streams if stream.get('codec_type') == 'video']
+    result = {"streams" : streams}
+    if video_streams:
+        result['kind'] = 'video'
+        result['codec'] = video_streams[0].get('codec_name')
+        result['width'] = video_streams[0].get('width')
+        result['height'] = video_streams[0].get('height')
+    else:
+        # Audio only files and broken videos are not converted as videos
+        result['kind'] = 'other'
+    try:
+        result['duration'] = float(info.get('format', {}).get('duration'))
+    except (TypeError, ValueError):
+        pass
+    result['capture_date'] = info.get('format', {}).get('tags', {}).get('creation_time')
+    return result
+
+
+def _probe_image(path):
+    try:
+        from PIL import Image
+    except ImportError:
+        return {"kind" : "image"}
+    if os.path.splitext(path)[1].lower() == '.heic':
+        try:
+            from pillow_heif import register_heif_opener
+            register_heif_opener()
+        except ImportError:
+            return {"kind" : "image"}
+
+    try:
+        # Only the header is read, the pixels are never decoded
+        with Image.open(path) as img:
+            result = {"kind" : "image", "codec" : img.format, "width" : img.width, "height" : img.height}
+            exif = img.getexif()
+            capture_date = exif.get_ifd(_EXIF_IFD).get(_DATE_TIME_ORIGINAL) or exif.get(_DATE_TIME)
+            if capture_date:
+                result['capture_date'] = str(capture_date)
+            return result
+    except Exception:
+        return {"kind" : "image"}
+
+
+def probe_file(path, ffprobe_binary='ffprobe'):
+    """
+    Reads the metadata of a file: mime type, kind ('video', 'image' or 'other'), codec, dimensions,
+    duration and capture date. Videos are read with ffprobe and images from their header.
+    None when ffprobe is missing or can't read the video, so the failure is not cached.
+    """
+    file_type = mimetypes.guess_type(path)[0]
+    if os.path.splitext(path)[1].lower() == '.heic':
+        file_type = file_type or 'image/heic'
+
+    result = {"file_type" : file_type, "kind" : "other"}
+    if file_type and file_type.startswith('video/'):
+        video = _probe_video(path, ffprobe_binary)
+        if video is None:
+            return None
+        result.update(video)
+    elif file_type and file_type.startswith('image/'):
+        result.update(_probe_image(path))
+    return result
+
+
+class MetadataCache:
+    """
+    SQLite cache of probe results keyed by path, size and mtime. A file is only probed again when its size
+    or mtime changed, so repeat runs serve the mime type, codec, dimensions, duration and capture date
+    without spawning ffprobe or opening the file. Missing entries are probed in parallel batches with prefetch.
+    """
+
+    def __init__(self, db_path, ffprobe_binary='ffprobe', worker_count=4):
+        self.db_path = db_path
+        self.ffprobe_binary = ffprobe_binary
+        self.worker_count = max(1, worker_count)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.conn.executescript(METADATA_SCHEMA)
+        self.conn.commit()
+
+    def _stat(self, path, stat):
+        if stat is not None:
+            return stat
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
+
+    def get(self, path, stat=None):
+        """
+        Returns the cached metadata of a file, None when it is not cached or changed since it was probed
+        """
+        stat = self._stat(path, stat)
+        if stat is None:
+            return None
+        with self.lock:
+            row = self.conn.execute("SELECT {0} FROM metadata WHERE path=?".format(', '.join(COLUMNS)), (path,)).fetchone()
+        if not row:
+            return None
+        entry = dict(zip(COLUMNS, row))
+        if entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            return None
+        entry['streams'] = json.loads(entry['streams']) if entry['streams'] else None
+        return entry
+
+    def get_or_probe(self, path, stat=None):
+        """
+        Returns the metadata of a file, probing it when the cache has no current entry
+        """
+        stat = self._stat(path, stat)
+        if stat is None:
+            return None
+        entry = self.get(path, stat)
+        if entry is None:
+            result = probe_file(path, self.ffprobe_binary)
+            if result is None:
+                return None
+            entry = self._store([(path, stat, result)])[0]
+        return entry
+
+    def prefetch(self, paths):
+        """
+        Probes the files without a current entry in parallel and stores the results in one transaction
+        """
+        missing = []
+        for path in paths:
+            stat = self._stat(path, None)
+            if stat is not None and self.get(path, stat) is None:
+                missing.append((path, stat))
+        return len(self._probe_missing(missing))
+
+    def get_many(self, files):
+        """
+        Returns {path: metadata} of (path, stat) pairs with a single lookup per file, the files without
+        a current entry are probed in parallel and stored in one transaction
+        """
+        entries = {}
+        missing = []
+        for path, stat in files:
+            entry = self.get(path, stat)
+            if entry is None:
+                missing.append((path, stat))
+            else:
+                entries[path] = entry
+        for entry in self._probe_missing(missing):
+            entries[entry['path']] = entry
+        return entries
+
+    def _probe_missing(self, missing):
+        if not missing:
+            return []
+        with ThreadPoolExecutor(max_workers=self.worker_count) as executor:
+            results = list(executor.map(lambda item: probe_file(item[0], self.ffprobe_binary), missing))
+        return self._store([(path, stat, result) for (path, stat), result in zip(missing, results) if result is not None])
+
+    def _store(self, probes):
+        entries = []
+        if not probes:
+            return entries
+        for path, stat, result in probes:
+            entry = dict.fromkeys(COLUMNS)
+            entry.update(result)
+            entry.update(path=path, size=stat.st_size, mtime_ns=stat.st_mtime_ns, probed_date=currentDateTime())
+            entries.append(entry)
+
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO metadata ({0}) VALUES ({1})".format(', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                                  [tuple(json.dumps(entry[column]) if column == 'streams' and entry[column] is not None else entry[column]
+                                         for column in COLUMNS) for entry in entries])
+            self.conn.commit()
+        return entries
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
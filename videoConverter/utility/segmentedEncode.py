@@ -0,0 +1,80 @@
+import os
+import subprocess
+from utility.encoderProfiles import build_encoder_arguments
+from utility.mediaProbe import get_map_arguments
+
+# Parts of the source are cut into matroska, which holds any video codec
+SPLIT_PATTERN = 'source_%04d.mkv'
+
+# Profile keys that only apply to the final output, the parts are encoded without audio
+_OUTPUT_PROFILE_KEYS = ('tag', 'audio', 'audioBitrate')
+
+
+def get_segment_count(duration, process_count, min_segment_seconds, segments_per_process=2):
+    """
+    Number of parts to split a source of duration seconds into: a few per encoder process so short parts
+    fill the gaps at the end, but none shorter than min_segment_seconds. Less than 2 means don't split.
+    """
+    if not duration or process_count < 2:
+        return 0
+    return min(int(duration // max(min_segment_seconds, 1)), process_count * segments_per_process)
+
+
+def get_split_times(duration, segment_count):
+    # Evenly spaced, the segment muxer moves every cut to the first keyframe at or after it
+    return [round(duration * index / segment_count, 3) for index in range(1, segment_count)]
+
+
+def get_split_command(ffmpeg_binary, input_file, split_times, segment_folder, video_index):
+    """
+    Cuts the video stream video_index of the source into parts without re-encoding. Stream copy can only cut
+    at keyframes, so every part starts on one and every frame lands in exactly one part.
+    """
+    return [ffmpeg_binary, '-y', '-i', input_file, '-map', '0:{0}'.format(video_index), '-c', 'copy', '-f', 'segment',
+            '-segment_times', ','.join(str(split_time) for split_time in split_times), '-reset_timestamps', '1',
+            os.path.join(segment_folder, SPLIT_PATTERN)]
+
+
+def list_segments(segment_folder):
+    prefix, extension = SPLIT_PATTERN.split('%04d')
+    return sorted(os.path.join(segment_folder, name) for name in os.listdir(segment_folder)
+                  if name.startswith(prefix) and name.endswith(extension))
+
+
+def get_segment_arguments(profile):
+    # The video settings of the profile, audio is taken from the source when the parts are joined
+    video_profile = {key: value for key, value in profile.items() if key not in _OUTPUT_PROFILE_KEYS}
+    return build_encoder_arguments(video_profile) + ['-an']
+
+
+def write_concat_list(segment_files, list_file):
+    # Concat demuxer list, quotes in paths are closed, escaped and reopened
+    with open(list_file, 'w') as file:
+        for segment_file in segment_files:
+            file.write("file '{0}'\n".format(os.path.abspath(segment_file).replace("'", "'\\''")))
+
+
+def get_concat_command(ffmpeg_binary, list_file, input_file, profile, output_file, selected):
+    """
+    Joins the encoded parts without re-encoding and adds the selected audio and subtitle streams (see
+    select_default_streams), the metadata and the chapters of the source, the streams the single pass encode maps.
+    The audio is converted once as the profile says.
+    """
+    output_profile = {key: profile[key] for key in _OUTPUT_PROFILE_KEYS if key in profile}
+    return ([ffmpeg_binary, '-y', '-f', 'concat', '-safe', '0', '-i', list_file, '-i', input_file, '-map', '0:v:0']
+            + get_map_arguments(selected, 1, ('audio', 'subtitle')) + ['-map_metadata', '1', '-map_chapters', '1', '-c:v', 'copy']
+            + build_encoder_arguments(output_profile) + [output_file])
+
+
+def count_video_frames(file_path, ffprobe_binary='ffprobe', timeout=600, stream='v:0'):
+    """
+    Number of frames of a video stream (the first one by default), from its packets so nothing is decoded.
+    None when ffprobe can't read the file.
+    """
+    command = [ffprobe_binary, '-v', 'error', '-select_streams', str(stream), '-count_packets',
+               '-show_entries', 'stream=nb_read_packets', '-of', 'csv=p=0', file_path]
+    try:
+        output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=timeout, check=True)
+        return int(output.stdout.decode('utf-8', errors='replace').strip().split(',')[0])
+    except (OSError, ValueError, IndexError, subprocess.SubprocessError):
+        return None
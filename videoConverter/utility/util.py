@@ -2,6 +2,10 @@ import mimetypes
 import hashlib
 import json
 import os
+import copy
+
+# Parsed configs keyed by (path, mtime, size)
+_config_cache = {}
 
 
 def determine_file_type(file_path):
@@ -67,9 +71,22 @@ def validateConfig(config_file_path):
         print("Error loading configuration file: " + str(e))
 
 def get_configurations(config_file_path):
+    # Each config file is parsed and validated once per version, callers get their own copy
+    try:
+        stat = os.stat(config_file_path)
+        key = (os.path.abspath(config_file_path), stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        key = None
+
+    if key in _config_cache:
+        return copy.deepcopy(_config_cache[key])
+
     config = validateConfig(config_file_path)
+    config = _remove_duplicates_from_lists(config)
 
-    return _remove_duplicates_from_lists(config)
+    if key and config:
+        _config_cache[key] = copy.deepcopy(config)
+    return config
 
 def _remove_duplicates_from_lists(config):
     extensions = config.get('exclustions',{}).get('extensions',[])